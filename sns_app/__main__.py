@@ -0,0 +1,230 @@
+"""Command line entry point: `python -m sns_app <command>`.
+
+Commands:
+  serve               multi-process waitress server (default when no command is given)
+  reconcile-counters  recompute post counters and repair drift
+  backfill-images     hash uploads and compute their size/colour/blurhash placeholders
+  recompress-images   orient, strip and re-encode existing uploads on all cores
+  gc-uploads          quarantine (or delete) uploaded files nothing references
+  backup              online backup of sns.db plus an upload manifest (--list to show backups)
+  restore             verify a backup and write it into sns.db (--check only verifies)
+  archive-posts       move old posts to the archive database now
+"""
+import os
+import sys
+import time
+import argparse
+
+
+def cmd_serve(args):
+    if args.asgi:
+        from .asgi import serve as asgi_serve
+        return asgi_serve(host=args.host, port=args.port, workers=args.workers, threads=args.threads)
+    from .serve import serve
+    serve(host=args.host, port=args.port, workers=args.workers, threads=args.threads)
+
+
+def cmd_reconcile_counters(args):
+    from .app import connect_db, init_db
+    from . import counters
+    init_db()
+    conn = connect_db()
+    try:
+        drift = counters.reconcile(conn, fix=not args.dry_run)
+    finally:
+        conn.close()
+    for name, stored, actual in drift:
+        print(f'{name}: stored={stored} actual={actual}')
+    verb = 'found' if args.dry_run else 'repaired'
+    print(f'{len(drift)} counter(s) {verb}')
+    return 0
+
+
+def cmd_backfill_images(args):
+    from .app import connect_db, init_db, UPLOAD_DIR
+    from . import images
+    init_db()
+    conn = connect_db()
+    try:
+        with conn:
+            hashed, dups, described = images.backfill(conn, UPLOAD_DIR)
+    finally:
+        conn.close()
+    print(f'{hashed} image(s) hashed, {dups} duplicate(s) found, {described} placeholder(s) computed')
+    return 0
+
+
+def cmd_recompress_images(args):
+    from .app import connect_db, init_db, UPLOAD_DIR, THUMB_DIR, ORIGINALS_DIR
+    from . import images
+    init_db()
+    conn = connect_db()
+    try:
+        files, before, after, failed = images.recompress(
+            conn, UPLOAD_DIR, THUMB_DIR, ORIGINALS_DIR if images.KEEP_ORIGINALS else None,
+            workers=args.workers, force=args.force, dry_run=args.dry_run)
+    finally:
+        conn.close()
+    saved = before - after
+    pct = saved * 100 / before if before else 0
+    verb = 'would save' if args.dry_run else 'saved'
+    print(f'{files} image(s): {before / 1048576:.1f} MB -> {after / 1048576:.1f} MB, {verb} {saved / 1048576:.1f} MB ({pct:.0f}%), {failed} failed')
+    return 1 if failed else 0
+
+
+def cmd_gc_uploads(args):
+    from .app import connect_db, init_db, UPLOAD_DIR, THUMB_DIR, AVATAR_DIR, QUARANTINE_DIR
+    from . import orphans
+    init_db()
+    conn = connect_db()
+    try:
+        grace = args.grace_hours * 3600 if args.grace_hours is not None else None
+        reports = orphans.sweep(conn, orphans.roots(UPLOAD_DIR, THUMB_DIR, AVATAR_DIR, archived=True), QUARANTINE_DIR,
+                                mode='delete' if args.delete else None, grace=grace, dry_run=args.dry_run)
+    finally:
+        conn.close()
+    verb = 'would be' if args.dry_run else ('deleted' if args.delete or orphans.MODE == 'delete' else 'quarantined')
+    for label, rep in reports.items():
+        if args.dry_run:
+            for name in rep['orphans']:
+                print(f'{label}: orphan {name}')
+            for name in rep['missing']:
+                print(f'{label}: missing {name}')
+        print(f"{label}: {rep['files']} file(s), {len(rep['orphans'])} orphan(s) {verb} ({rep['bytes'] / 1048576:.1f} MB), "
+              f"{rep['young']} within grace, {len(rep['missing'])} missing, {rep['restored']} restored, {rep['purged']} purged")
+    return 0
+
+
+def _print_backup(manifest):
+    st = manifest['stats']
+    duty = st['step_time'] / st['duration'] * 100 if st['duration'] else 0
+    print(f"{manifest['db']}: {manifest['bytes'] / 1048576:.1f} MB, {st['pages']} pages in {st['duration']:.2f}s "
+          f"({st['steps']} steps, DB locked {st['step_time'] * 1000:.0f} ms total / {duty:.0f}% of the time, "
+          f"longest step {st['max_step'] * 1000:.1f} ms, {st['restarts']} restart(s)"
+          f"{', finished in one step' if st.get('one_step') else ''}), {len(manifest['uploads'])} upload(s) in manifest")
+
+
+def cmd_backup(args):
+    from .app import init_db, DB_PATH, ARCHIVE_DB_PATH, BACKUP_DIR, UPLOAD_DIR, THUMB_DIR, AVATAR_DIR
+    from . import backup, orphans
+    if args.list:
+        for path in backup.backups(BACKUP_DIR):
+            problems = backup.verify(path)
+            print(f"{os.path.basename(path)}  {os.path.getsize(path) / 1048576:.1f} MB  {'ok' if not problems else '; '.join(problems)}")
+        return 0
+    init_db()
+    manifest = backup.backup(DB_PATH, BACKUP_DIR, orphans.roots(UPLOAD_DIR, THUMB_DIR, AVATAR_DIR, archived=True),
+                             keep=args.keep, attached={'archive': ARCHIVE_DB_PATH})
+    _print_backup(manifest)
+    for path in manifest['removed']:
+        print(f'rotated out {os.path.basename(path)}')
+    return 0
+
+
+def cmd_restore(args):
+    from .app import DB_PATH, ARCHIVE_DB_PATH, BACKUP_DIR, UPLOAD_DIR, THUMB_DIR, AVATAR_DIR
+    from . import backup
+    path = args.backup
+    if path == 'latest':
+        found = [p for p in backup.backups(BACKUP_DIR) if not p.endswith('-pre-restore.db')]
+        if not found:
+            print('no backups found')
+            return 1
+        path = found[-1]
+    elif not os.path.exists(path):
+        path = os.path.join(BACKUP_DIR, path)
+    problems = backup.verify(path, {'uploads': UPLOAD_DIR, 'thumbs': THUMB_DIR, 'avatars': AVATAR_DIR})
+    for p in problems:
+        print(p)
+    if args.check:
+        print(f"{os.path.basename(path)}: {'ok' if not problems else f'{len(problems)} problem(s)'}")
+        return 1 if problems else 0
+    try:
+        safety = backup.restore(path, DB_PATH, BACKUP_DIR, attached={'archive': ARCHIVE_DB_PATH})
+    except backup.BackupError as e:
+        print(f'restore refused: {e}')
+        return 1
+    print(f"restored {os.path.basename(path)}; previous DB saved as {safety['db']}")
+    return 0
+
+
+def cmd_archive_posts(args):
+    from .app import connect_db, init_db
+    from . import archive
+    init_db()
+    days = args.days if args.days is not None else archive.AFTER_DAYS
+    if days <= 0:
+        print('archiving is disabled (SNS_ARCHIVE_AFTER_DAYS=0); pass --days')
+        return 1
+    conn = connect_db()
+    try:
+        before = archive.cutoff(days)
+        if args.dry_run:
+            n = conn.execute('SELECT COUNT(*) FROM main.posts WHERE created_at < ?', (before,)).fetchone()[0]
+            print(f'{n} post(s) older than {days} day(s) would be archived')
+            return 0
+        started = time.time()
+        moved = archive.move(conn, before, batch=args.batch)
+        live = conn.execute('SELECT COUNT(*) FROM main.posts').fetchone()[0]
+        archived = conn.execute('SELECT COUNT(*) FROM archive.posts').fetchone()[0]
+    finally:
+        conn.close()
+    print(f'{moved} post(s) archived in {time.time() - started:.1f}s; {live} live, {archived} archived')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m sns_app')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('serve', help='run the multi-process server')
+    p.add_argument('--host', help='listen host (env SNS_HOST)')
+    p.add_argument('--port', type=int, help='listen port (env SNS_PORT)')
+    p.add_argument('--workers', type=int, help='worker processes (env SNS_WORKERS)')
+    p.add_argument('--threads', type=int, help='threads per worker (env SNS_THREADS)')
+    p.add_argument('--asgi', action='store_true', help='serve sns_app.asgi under uvicorn (address lookups do not hold a thread)')
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser('reconcile-counters', help='recompute post counters and repair drift')
+    p.add_argument('--dry-run', action='store_true', help='report drift without fixing it')
+    p.set_defaults(func=cmd_reconcile_counters)
+
+    p = sub.add_parser('backfill-images', aliases=['hash-images'], help='hash existing uploads and compute their placeholders')
+    p.set_defaults(func=cmd_backfill_images)
+
+    p = sub.add_parser('recompress-images', help='re-encode existing uploads with the ingest settings')
+    p.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    p.add_argument('--force', action='store_true', help='also redo uploads that were already ingested')
+    p.add_argument('--dry-run', action='store_true', help='report the savings without replacing files')
+    p.set_defaults(func=cmd_recompress_images)
+
+    p = sub.add_parser('gc-uploads', help='collect uploaded files no post or user references')
+    p.add_argument('--dry-run', action='store_true', help='only report orphans and missing files')
+    p.add_argument('--delete', action='store_true', help='delete orphans instead of quarantining them')
+    p.add_argument('--grace-hours', type=float, help='minimum orphan age (env SNS_GC_GRACE_HOURS)')
+    p.set_defaults(func=cmd_gc_uploads)
+
+    p = sub.add_parser('backup', help='online backup of the database')
+    p.add_argument('--keep', type=int, help='backups to keep (env SNS_BACKUP_KEEP)')
+    p.add_argument('--list', action='store_true', help='list existing backups and verify them')
+    p.set_defaults(func=cmd_backup)
+
+    p = sub.add_parser('restore', help='restore the database from a backup')
+    p.add_argument('backup', help="backup file (path or name in the backup dir) or 'latest'")
+    p.add_argument('--check', action='store_true', help='only verify the backup')
+    p.set_defaults(func=cmd_restore)
+
+    p = sub.add_parser('archive-posts', help='move posts older than N days to the archive database')
+    p.add_argument('--days', type=int, help='archive posts older than this (env SNS_ARCHIVE_AFTER_DAYS)')
+    p.add_argument('--batch', type=int, help='posts per transaction (env SNS_ARCHIVE_BATCH)')
+    p.add_argument('--dry-run', action='store_true', help='only count the posts that would move')
+    p.set_defaults(func=cmd_archive_posts)
+
+    args = parser.parse_args(argv)
+    if not args.command:
+        args = parser.parse_args(['serve'] + list(argv if argv is not None else sys.argv[1:]))
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
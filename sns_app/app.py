@@ -1,16 +1,18 @@
 import os
 import re
+import sys
 import sqlite3
 from datetime import datetime
-from flask import Flask, g, render_template, request, redirect, url_for, session, flash
-from flask_wtf.csrf import CSRFProtect, CSRFError
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, g, render_template, stream_template, get_flashed_messages, request, redirect, url_for, session, flash, abort, send_file
+from flask_wtf.csrf import CSRFProtect, CSRFError, generate_csrf
 from werkzeug.utils import secure_filename
 import time
 from PIL import Image
-import requests
-import math
 import random
+import secrets
+import json
+import base64
+import unicodedata
 import smtplib
 from email.message import EmailMessage
 import stripe
@@ -19,14 +21,33 @@ try:
 except Exception:
     validate_email = None
     EmailNotValidError = Exception
+try:
+    from . import ranks, tasks, events, notify, auth, ratelimit, counters, trending, shops, clusters, suggest, images, orphans, backup, archive, derivatives, streaming, geo, metrics, storage, chunked, records
+except ImportError:
+    # running as a plain script (python app.py)
+    import ranks, tasks, events, notify, auth, ratelimit, counters, trending, shops, clusters, suggest, images, orphans, backup, archive, derivatives, streaming, geo, metrics, storage, chunked, records
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'sns.db')
+ARCHIVE_DB_PATH = os.environ.get('SNS_ARCHIVE_DB') or os.path.join(BASE_DIR, 'sns_archive.db')
+TASKS_LOCK_PATH = os.path.join(BASE_DIR, 'sns_tasks.lock')  # held by the one process that runs the periodic jobs
 UPLOAD_DIR = os.path.join(BASE_DIR, 'static', 'uploads')
 THUMB_DIR = os.path.join(UPLOAD_DIR, 'thumbs')
 AVATAR_DIR = os.path.join(UPLOAD_DIR, 'avatars')
+ORIGINALS_DIR = os.path.join(BASE_DIR, 'originals')  # uploads as sent; only written when SNS_KEEP_ORIGINALS=1
+QUARANTINE_DIR = os.path.join(BASE_DIR, 'quarantine')  # orphaned uploads waiting to be deleted
+BACKUP_DIR = os.environ.get('SNS_BACKUP_DIR') or os.path.join(BASE_DIR, 'backups')
+IMAGE_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'img')  # /img derivatives (derivatives.py)
+UPLOAD_STAGING_DIR = os.path.join(BASE_DIR, 'staging')  # chunked upload sessions (chunked.py)
+IMAGE_MAX_AGE = 7 * 86400
 ALLOWED_EXT = {'png', 'jpg', 'jpeg'}
 MAX_IMAGE_SIZE_MB = 6
+# direct-to-storage uploads (POST /api/uploads): accepted content types per kind
+UPLOAD_TYPES = {
+    'post': {'image/jpeg': 'jpg', 'image/png': 'png'},
+    'avatar': {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp', 'image/gif': 'gif'},
+}
+INCOMING_MAX_AGE = 86400  # unclaimed direct uploads are deleted after this
 MIN_WIDTH, MIN_HEIGHT = 200, 200
 MAX_WIDTH, MAX_HEIGHT = 4096, 4096
 SHOP_CATEGORIES = ['和食', '洋食', '中華', 'カフェ', '居酒屋', 'ラーメン', 'スイーツ']
@@ -34,6 +55,13 @@ URL_MAX_LEN = 300
 TEXT_MAX_LEN = 200
 MIN_LAT, MAX_LAT = -90.0, 90.0
 MIN_LNG, MAX_LNG = -180.0, 180.0
+BOOKMARK_PAGE_SIZE = 20
+BOOKMARK_UNFILED = '__unfiled__'  # folder filter value for bookmarks without a folder
+NOTIFICATION_PAGE_SIZE = 20
+TRENDING_PAGE_SIZE = 6
+TRENDING_LIMIT = 60  # trending lists stop after this many posts
+# header carrying the real client address when behind a proxy/tunnel (e.g. CF-Connecting-IP)
+CLIENT_IP_HEADER = os.environ.get('SNS_CLIENT_IP_HEADER', '')
 
 try:
     from dotenv import load_dotenv
@@ -68,20 +96,427 @@ os.environ.setdefault('SMTP_FROM', '')
 os.environ.setdefault('SMTP_UTF8', '1')
 
 
+# credential endpoint throttles (token buckets; shared across workers with the sqlite backend)
+login_ip_limiter = ratelimit.create('login_ip', rate=10 / 60, capacity=10)
+login_user_limiter = ratelimit.create('login_user', rate=5 / 300, capacity=5)  # failed attempts per username
+register_ip_limiter = ratelimit.create('register_ip', rate=5 / 600, capacity=5)
+# admission control: one budget per client IP, expensive endpoints cost more of it
+admission_limiter = ratelimit.create('admission', rate=2, capacity=60)
+ROUTE_COSTS = {
+    'geocode': 10,      # outbound Nominatim call
+    'near': 3,
+    'shop_clusters': 2,
+    'shop_suggest': 1,  # per keystroke (debounced)
+    'image_derivative': 1,
+    'create_upload': 2,
+    'create_chunked_upload': 2,
+    'upload_chunk': 1,
+    'finalize_chunked_upload': 2,
+    'like': 1,
+    'post': 5,          # upload + image processing
+    'verify_resend': 10,  # sends mail
+}
+
+
+def client_ip() -> str:
+    if CLIENT_IP_HEADER:
+        v = request.headers.get(CLIENT_IP_HEADER, '').split(',')[0].strip()
+        if v:
+            return v
+    return request.remote_addr or ''
+
+
+def request_cost() -> int:
+    if request.endpoint == 'search':
+        return 10 if request.args.get('address', '').strip() else 1
+    return ROUTE_COSTS.get(request.endpoint, 0)
+
+
+@app.before_request
+def start_timer():
+    # first hook, so shed requests are timed too (metrics.py)
+    g._started = time.perf_counter()
+
+
+@app.after_request
+def record_metrics(response):
+    started = g.get('_started')
+    if started is not None and request.endpoint != 'metrics_json':
+        metrics.record(time.perf_counter() - started, response.status_code)
+    return response
+
+
+@app.before_request
+def admission_control():
+    # registered before ensure_db so shed requests never touch the DB or the network
+    if request.environ.get('sns.geocoded') is not None:
+        # replay of a request that waited for an address lookup (asgi.py): charged on its first pass
+        return None
+    cost = request_cost()
+    if not cost:
+        return None
+    allowed, retry = admission_limiter.consume(client_ip(), cost)
+    if allowed:
+        return None
+    headers = {'Retry-After': str(int(retry) + 1)}
+    if request.endpoint == 'geocode' or request.path.startswith('/api/'):
+        return {'error': 'rate_limited'}, 429, headers
+    return render_template('rate_limited.html', retry_after=int(retry) + 1), 429, headers
+
+
+class LookupPending(Exception):
+    # raised under asgi.py instead of blocking on nominatim; see lookup_address()
+    def __init__(self, query):
+        super().__init__(query)
+        self.query = query
+
+
+@app.errorhandler(chunked.ChunkError)
+def handle_chunk_error(e):
+    return {'error': str(e), **e.info}, e.status
+
+
+@app.errorhandler(LookupPending)
+def handle_lookup_pending(e):
+    request.environ['sns.lookup'] = e.query
+    return '', 202
+
+
+def lookup_address(query):
+    # (lat, lng) or None. Under the ASGI entry point the view gives its thread
+    # back instead of waiting: asgi.py awaits the lookup and replays the
+    # request with the result in the environ (GET only, views read nothing
+    # they would write twice)
+    done = request.environ.get('sns.geocoded')
+    if done is not None and query in done:
+        if isinstance(done[query], Exception):
+            raise done[query]
+        return done[query]
+    if request.environ.get('sns.async_lookup'):
+        raise LookupPending(query)
+    return geo.lookup(query)
+
+
 def smtp_configured() -> bool:
     host = os.environ.get('SMTP_HOST')
     # treat dev-null fallback as not configured for UI notices
     return bool(host) and host != 'dev-null'
 
 
+_archive_failed = False
+
+
+def connect_db(lazy_archive=False):
+    # standalone connection (background tasks, CLI); requests use get_db(), which
+    # skips the archive until it holds posts (archive.has_rows)
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    if lazy_archive and not archive.has_rows(ARCHIVE_DB_PATH):
+        return conn
+    try:
+        archive.attach(conn, ARCHIVE_DB_PATH)
+    except sqlite3.DatabaseError as e:
+        global _archive_failed
+        if not _archive_failed:
+            print(f'[archive] cannot attach {ARCHIVE_DB_PATH} ({e}); serving live posts only', file=sys.stderr)
+            _archive_failed = True
+        archive.attach_empty(conn)
+    return conn
+
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
+        started = time.perf_counter()
+        db = g._database = connect_db(lazy_archive=True)
+        metrics.db_opened(time.perf_counter() - started)
     return db
 
 
+notify.configure(connect_db)
+
+
+def shop_key(name):
+    # normalized shop name used to follow a shop across posts
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', name or '')).casefold()
+
+
+app.jinja_env.filters['shop_key'] = shop_key
+
+
+def image_meta_for(rows):
+    # placeholders (size, colour, blurhash) for the images of a page of posts, in one query
+    return images.meta_for(get_db(), [r['image'] for r in rows])
+
+
+app.jinja_env.globals['image_meta_for'] = image_meta_for
+
+
+def thumb_url(name):
+    # the upload-time thumbnail when there is one, else an on-demand derivative
+    if not upload_store.local:
+        return upload_store.url(f'uploads/thumbs/thumb_{name}')
+    if os.path.exists(os.path.join(THUMB_DIR, f'thumb_{name}')):
+        return url_for('static', filename=f'uploads/thumbs/thumb_{name}')
+    return url_for('image_derivative', name=name, kind='posts', w=images.THUMB_SIZE)
+
+
+app.jinja_env.globals['thumb_url'] = thumb_url
+derivative_cache = derivatives.DerivativeCache(IMAGE_CACHE_DIR)
+upload_store = storage.from_env(os.path.join(BASE_DIR, 'static'), app.secret_key, os.path.join(BASE_DIR, 'incoming'))
+
+
+def upload_url(key):
+    # URL of an upload by its storage key ('uploads/...'): the static route or the bucket
+    return upload_store.url(key) or url_for('static', filename=key)
+
+
+app.jinja_env.globals['upload_url'] = upload_url
+upload_staging = chunked.Staging(UPLOAD_STAGING_DIR)
+
+
+def direct_upload_mode():
+    # how static/direct_upload.js sends form files: 'presigned' straight to
+    # storage (pointless when storage is this app's disk), else 'chunked' to
+    # /api/uploads/chunked, resumable; '' leaves plain multipart forms
+    if not upload_store.local or os.environ.get('SNS_DIRECT_UPLOADS') == '1':
+        return 'presigned'
+    return '' if os.environ.get('SNS_CHUNKED_UPLOADS') == '0' else 'chunked'
+
+
+app.jinja_env.globals['direct_uploads'] = direct_upload_mode()
+
+
+class StoredUpload:
+    # a direct upload standing in for request.files[...]: same .filename and .save()
+    def __init__(self, key):
+        self.key = key
+        self.filename = key.rsplit('/', 1)[-1]
+
+    def save(self, dest):
+        upload_store.take(self.key, dest)
+
+
+def claimed_upload(user, kind):
+    # the form's upload_key, if it names an object this user uploaded through /api/uploads
+    key = request.form.get('upload_key', '').strip()
+    if not key or not user or not key.startswith(f"{storage.INCOMING}{kind}/{user['id']}/") or '..' in key:
+        return None
+    if upload_store.stat(key) is None:
+        return None
+    return StoredUpload(key)
+
+
+def ingest_upload(img, save_path):
+    # stored form + thumbnail of a checked upload: (basename, meta), or (None, None) once a failure is cleaned up
+    made = [save_path, save_path + '.tmp']
+    try:
+        path, img = images.ingest(img, save_path, ORIGINALS_DIR if images.KEEP_ORIGINALS else None, THUMB_DIR)
+        made.append(path)
+        meta = images.describe(img)
+        meta['ingested_at'] = datetime.utcnow().isoformat()
+        img.thumbnail((images.THUMB_SIZE, images.THUMB_SIZE))
+        thumb_path = os.path.join(THUMB_DIR, f'thumb_{os.path.basename(path)}')
+        made.append(thumb_path)
+        img.save(thumb_path)
+        return os.path.basename(path), meta
+    except Exception as e:
+        print(f'[images] storing {os.path.basename(save_path)} failed: {e!r}', file=sys.stderr)
+        for p in made:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        return None, None
+
+
+def publish_image(name):
+    # move an ingested image and its thumbnail to their storage keys (no-op on the local disk)
+    for key, path in ((f'uploads/{name}', os.path.join(UPLOAD_DIR, name)),
+                      (f'uploads/thumbs/thumb_{name}', os.path.join(THUMB_DIR, f'thumb_{name}'))):
+        if os.path.exists(path):
+            upload_store.put_file(key, path)
+
+
+def backfill_bookmark_ranks(conn):
+    # assign rank keys to bookmarks created before rank_key existed, keeping the old position order
+    users = [r[0] for r in conn.execute('SELECT DISTINCT user_id FROM bookmarks WHERE rank_key IS NULL').fetchall()]
+    for uid in users:
+        rows = conn.execute('SELECT post_id FROM bookmarks WHERE user_id = ? ORDER BY rank_key IS NULL, rank_key, position, created_at', (uid,)).fetchall()
+        keys = ranks.spread_keys(len(rows))
+        conn.executemany('UPDATE bookmarks SET rank_key = ? WHERE user_id = ? AND post_id = ?', [(k, uid, r[0]) for k, r in zip(keys, rows)])
+
+
+def create_notification_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        post_id INTEGER,
+        actor_id INTEGER,
+        count INTEGER NOT NULL DEFAULT 1,
+        created_at TEXT NOT NULL,
+        is_read INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_unread_like ON notifications(user_id, post_id) WHERE kind = 'like' AND is_read = 0")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS shop_follows (
+        user_id INTEGER NOT NULL,
+        shop_key TEXT NOT NULL,
+        shop_name TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY(user_id, shop_key)
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shop_follows_shop ON shop_follows(shop_key, user_id)")
+
+
+def create_bookmark_indexes(conn):
+    # one index per bookmark sort mode (see BOOKMARK_SORTS), plus folder-scoped ones
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookmarks_user_rank ON bookmarks(user_id, rank_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookmarks_user_created ON bookmarks(user_id, created_at, post_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookmarks_user_likes ON bookmarks(user_id, post_likes DESC, post_id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookmarks_user_category ON bookmarks(user_id, post_category, created_at DESC, post_id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookmarks_folder_rank ON bookmarks(user_id, folder, rank_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookmarks_folder_created ON bookmarks(user_id, folder, created_at, post_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookmarks_post ON bookmarks(post_id)")
+
+
+def rebuild_bookmark_folders(conn):
+    # recompute the per-folder bookmark counts ('' = no folder)
+    conn.execute('DELETE FROM bookmark_folders')
+    conn.execute("INSERT INTO bookmark_folders (user_id, folder, count) SELECT user_id, COALESCE(folder, ''), COUNT(*) FROM bookmarks GROUP BY user_id, COALESCE(folder, '')")
+
+
+def bump_bookmark_folder(db, user_id, folder, delta):
+    # maintain bookmark_folders inside the caller's transaction
+    db.execute('INSERT INTO bookmark_folders (user_id, folder, count) VALUES (?, ?, ?) ON CONFLICT(user_id, folder) DO UPDATE SET count = count + excluded.count',
+               (user_id, folder or '', delta))
+    db.execute('DELETE FROM bookmark_folders WHERE user_id = ? AND folder = ? AND count <= 0', (user_id, folder or ''))
+
+
+# sort mode -> [(column alias in the listing query, direction)]; the last column makes the order total
+BOOKMARK_SORTS = {
+    'position': [('bm_rank', 'ASC'), ('bm_post_id', 'ASC')],
+    'created_desc': [('bm_created', 'DESC'), ('bm_post_id', 'DESC')],
+    'created_asc': [('bm_created', 'ASC'), ('bm_post_id', 'ASC')],
+    'likes_desc': [('bm_likes', 'DESC'), ('bm_post_id', 'DESC')],
+    'category': [('bm_category', 'ASC'), ('bm_created', 'DESC'), ('bm_post_id', 'DESC')],
+}
+BOOKMARK_COLUMNS = {
+    'bm_rank': 'b.rank_key',
+    'bm_created': 'b.created_at',
+    'bm_likes': 'b.post_likes',
+    'bm_category': 'b.post_category',
+    'bm_post_id': 'b.post_id',
+}
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except Exception:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+
+def keyset_clause(order, values):
+    # rows strictly after `values` in `order`; the leading inclusive bound lets SQLite seek the index
+    col0, dir0 = order[0]
+    parts = [f"{BOOKMARK_COLUMNS[col0]} {'>=' if dir0 == 'ASC' else '<='} ?"]
+    params = [values[0]]
+    alts = []
+    for i, (col, direction) in enumerate(order):
+        conds = [f"{BOOKMARK_COLUMNS[c]} = ?" for c, _ in order[:i]]
+        conds.append(f"{BOOKMARK_COLUMNS[col]} {'>' if direction == 'ASC' else '<'} ?")
+        alts.append('(' + ' AND '.join(conds) + ')')
+        params.extend(values[:i + 1])
+    parts.append('(' + ' OR '.join(alts) + ')')
+    return ' AND '.join(parts), params
+
+
+def rebalance_bookmark_ranks(user_id):
+    # background job: rewrite one user's rank keys evenly once they got too long
+    conn = connect_db()
+    try:
+        with conn:
+            rows = conn.execute('SELECT post_id FROM bookmarks WHERE user_id = ? ORDER BY rank_key', (user_id,)).fetchall()
+            keys = ranks.spread_keys(len(rows))
+            conn.executemany('UPDATE bookmarks SET rank_key = ? WHERE user_id = ? AND post_id = ?', [(k, user_id, r['post_id']) for k, r in zip(keys, rows)])
+    finally:
+        conn.close()
+
+
+def rescore_shop(shop_id):
+    # background job: a liked shop's score in its map tiles (clusters.rescore)
+    conn = connect_db()
+    try:
+        with conn:
+            clusters.rescore(conn, shop_id)
+    finally:
+        conn.close()
+
+
+def schedule_rank_rebalance(user_id, key):
+    if key and len(key) > ranks.MAX_KEY_LEN:
+        tasks.submit(('rebalance_bookmarks', user_id), rebalance_bookmark_ranks, user_id)
+
+
+def rebase_trending():
+    # periodic job: decay hot scores and move the trending epoch
+    conn = connect_db()
+    try:
+        trending.rebase(conn)
+    finally:
+        conn.close()
+
+
+def expire_incoming():
+    # direct uploads (POST /api/uploads) that no form ever claimed, and chunked uploads left unfinished
+    try:
+        upload_store.expire_incoming(INCOMING_MAX_AGE)
+    except Exception:
+        pass
+    try:
+        upload_staging.expire()
+    except Exception:
+        pass
+
+
+def collect_orphans():
+    # periodic job: quarantine uploads no post/user references any more
+    conn = connect_db()
+    try:
+        orphans.sweep(conn, orphans.roots(UPLOAD_DIR, THUMB_DIR, AVATAR_DIR, archived=True), QUARANTINE_DIR)
+    finally:
+        conn.close()
+
+
+def backup_db():
+    # periodic job (checked hourly): online backup once the newest one is older than the interval
+    backup.backup_if_due(DB_PATH, BACKUP_DIR, orphans.roots(UPLOAD_DIR, THUMB_DIR, AVATAR_DIR, archived=True),
+                         attached={'archive': ARCHIVE_DB_PATH})
+
+
+def archive_posts():
+    # periodic job: move posts older than SNS_ARCHIVE_AFTER_DAYS to the archive DB
+    conn = connect_db()
+    try:
+        archive.move(conn, archive.cutoff())
+    finally:
+        conn.close()
+
+
 def init_db():
     if os.path.exists(DB_PATH):
         # DB exists: ensure columns and tables are present
@@ -151,9 +586,86 @@ def init_db():
             pass
         try:
             with sqlite3.connect(DB_PATH) as conn:
-                conn.execute("CREATE TABLE IF NOT EXISTS bookmarks (user_id INTEGER NOT NULL, post_id INTEGER NOT NULL, created_at TEXT NOT NULL, folder TEXT DEFAULT NULL, position INTEGER DEFAULT 0, PRIMARY KEY(user_id, post_id))")
+                conn.execute("CREATE TABLE IF NOT EXISTS bookmarks (user_id INTEGER NOT NULL, post_id INTEGER NOT NULL, created_at TEXT NOT NULL, folder TEXT DEFAULT NULL, position INTEGER DEFAULT 0, rank_key TEXT DEFAULT NULL, PRIMARY KEY(user_id, post_id))")
         except sqlite3.OperationalError:
             pass
+        try:
+            with sqlite3.connect(DB_PATH) as conn:
+                conn.execute("ALTER TABLE bookmarks ADD COLUMN rank_key TEXT DEFAULT NULL")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            with sqlite3.connect(DB_PATH) as conn:
+                conn.execute("ALTER TABLE bookmarks ADD COLUMN post_likes INTEGER DEFAULT 0")
+                conn.execute("ALTER TABLE bookmarks ADD COLUMN post_category TEXT DEFAULT 'food_photo'")
+                # denormalized sort keys: copy from posts once
+                conn.execute("UPDATE bookmarks SET post_likes = COALESCE((SELECT likes FROM posts WHERE posts.id = bookmarks.post_id), 0), post_category = COALESCE((SELECT category FROM posts WHERE posts.id = bookmarks.post_id), 'food_photo')")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            with sqlite3.connect(DB_PATH) as conn:
+                conn.execute("CREATE TABLE bookmark_folders (user_id INTEGER NOT NULL, folder TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(user_id, folder))")
+                rebuild_bookmark_folders(conn)
+        except sqlite3.OperationalError:
+            pass
+        try:
+            with sqlite3.connect(DB_PATH) as conn:
+                conn.execute("ALTER TABLE users ADD COLUMN unread_notifications INTEGER DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        with sqlite3.connect(DB_PATH) as conn:
+            create_notification_tables(conn)
+            create_bookmark_indexes(conn)
+            backfill_bookmark_ranks(conn)
+        with sqlite3.connect(DB_PATH) as conn:
+            has_counters = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'counters'").fetchone()
+            counters.create_table(conn)
+        if not has_counters:
+            conn = sqlite3.connect(DB_PATH)
+            try:
+                counters.reconcile(conn)
+            finally:
+                conn.close()
+        try:
+            with sqlite3.connect(DB_PATH) as conn:
+                conn.execute("ALTER TABLE posts ADD COLUMN hot_score REAL")
+        except sqlite3.OperationalError:
+            pass
+        with sqlite3.connect(DB_PATH) as conn:
+            trending.create_tables(conn)
+            trending.create_indexes(conn)
+            trending.backfill(conn)
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            trending.rebase(conn)
+        finally:
+            conn.close()
+        try:
+            with sqlite3.connect(DB_PATH) as conn:
+                conn.execute("ALTER TABLE posts ADD COLUMN shop_id INTEGER")
+        except sqlite3.OperationalError:
+            pass
+        with sqlite3.connect(DB_PATH) as conn:
+            has_tiles = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shop_tiles'").fetchone()
+            try:
+                archive.attach(conn, ARCHIVE_DB_PATH)  # so a recount includes archived shop posts
+            except sqlite3.DatabaseError:
+                pass
+            shops.create_tables(conn)
+            clusters.create_tables(conn)
+            if not shops.backfill(conn) and not has_tiles:
+                clusters.rebuild(conn)
+        with sqlite3.connect(DB_PATH) as conn:
+            images.create_tables(conn)
+        for col in ('width INTEGER', 'height INTEGER', 'thumb_width INTEGER', 'thumb_height INTEGER', 'color TEXT', 'blurhash TEXT', 'ingested_at TEXT'):
+            try:
+                with sqlite3.connect(DB_PATH) as conn:
+                    conn.execute(f"ALTER TABLE images ADD COLUMN {col}")
+            except sqlite3.OperationalError:
+                pass
+        with sqlite3.connect(DB_PATH) as conn:
+            archive.attach(conn, ARCHIVE_DB_PATH)
+            archive.create_tables(conn)
         return
 
     with sqlite3.connect(DB_PATH) as conn:
@@ -170,7 +682,8 @@ def init_db():
                     is_premium INTEGER DEFAULT 0,
                     verification_code_expires_at TEXT DEFAULT NULL,
                     verification_attempts INTEGER DEFAULT 0,
-                    last_code_sent_at TEXT DEFAULT NULL
+                    last_code_sent_at TEXT DEFAULT NULL,
+                    unread_notifications INTEGER DEFAULT 0
         )
         ''')
         cur.execute('''
@@ -191,6 +704,8 @@ def init_db():
           shop_lng REAL DEFAULT NULL,
           created_at TEXT NOT NULL,
           likes INTEGER DEFAULT 0,
+          hot_score REAL DEFAULT 0,
+          shop_id INTEGER DEFAULT NULL,
           FOREIGN KEY(user_id) REFERENCES users(id)
         )
         ''')
@@ -201,12 +716,34 @@ def init_db():
             created_at TEXT NOT NULL,
             folder TEXT DEFAULT NULL,
             position INTEGER DEFAULT 0,
+            rank_key TEXT DEFAULT NULL,
+            post_likes INTEGER DEFAULT 0,
+            post_category TEXT DEFAULT 'food_photo',
             PRIMARY KEY(user_id, post_id),
             FOREIGN KEY(user_id) REFERENCES users(id),
             FOREIGN KEY(post_id) REFERENCES posts(id)
         )
         ''')
+        cur.execute('''
+        CREATE TABLE bookmark_folders (
+            user_id INTEGER NOT NULL,
+            folder TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(user_id, folder)
+        )
+        ''')
+        create_bookmark_indexes(conn)
+        create_notification_tables(conn)
+        counters.create_table(conn)
+        trending.create_tables(conn)
+        trending.create_indexes(conn)
+        shops.create_tables(conn)
+        clusters.create_tables(conn)
+        images.create_tables(conn)
         conn.commit()
+    with sqlite3.connect(DB_PATH) as conn:
+        archive.attach(conn, ARCHIVE_DB_PATH)
+        archive.create_tables(conn)
 
 
 def send_verification_code(email: str, code: str) -> None:
@@ -263,9 +800,12 @@ def is_food_image(img: Image.Image) -> bool:
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    # popped, not just closed: a streamed response (stream_page) runs after
+    # this teardown and opens a connection of its own through get_db()
+    db = g.pop('_database', None)
     if db is not None:
         db.close()
+        metrics.db_closed()
 
 
 def current_user():
@@ -273,13 +813,13 @@ def current_user():
     if not uid:
         return None
     db = get_db()
-    return db.execute('SELECT id, username, avatar, is_premium FROM users WHERE id = ?', (uid,)).fetchone()
+    return db.execute('SELECT id, username, avatar, is_premium, unread_notifications FROM users WHERE id = ?', (uid,)).fetchone()
 
 
 _db_initialized = False
 
 @app.before_request
-def ensure_db():
+def ensure_db(background=True):
     global _db_initialized
     if not _db_initialized:
         init_db()
@@ -289,28 +829,46 @@ def ensure_db():
             os.makedirs(AVATAR_DIR, exist_ok=True)
         except Exception:
             pass
+        if background:
+            start_background()
         _db_initialized = True
 
 
+def start_background():
+    # the event hub and the periodic jobs; `serve` runs them in a process of their own (serve.py)
+    events.start()
+    tasks.scheduler_lock(TASKS_LOCK_PATH)
+    tasks.every(trending.REBASE_INTERVAL, rebase_trending, key='trending_rebase')
+    if orphans.INTERVAL > 0:
+        tasks.every(orphans.INTERVAL, collect_orphans, key='collect_orphans')
+    if backup.INTERVAL > 0:
+        tasks.every(min(backup.INTERVAL, 3600), backup_db, key='backup_db')
+    if archive.AFTER_DAYS > 0:
+        tasks.every(archive.INTERVAL, archive_posts, key='archive_posts')
+    tasks.every(3600, expire_incoming, key='expire_incoming')
+
+
 @app.route('/geocode')
 def geocode():
     name = request.args.get('name', '').strip()
     address = request.args.get('address', '').strip()
     if not name and not address:
         return {'error': 'name or address required'}, 400
+    if name:
+        # known shop: reuse its coordinates instead of asking nominatim again
+        shop_id = shops.find(get_db(), name, address)
+        if shop_id:
+            row = get_db().execute('SELECT lat, lng FROM shops WHERE id = ?', (shop_id,)).fetchone()
+            if row and row['lat'] is not None:
+                return {'lat': row['lat'], 'lng': row['lng'], 'shop_id': shop_id}
     query = ' '.join([p for p in [name, address] if p])
     try:
-        resp = requests.get(
-            'https://nominatim.openstreetmap.org/search',
-            params={'q': query, 'format': 'json', 'limit': 1},
-            headers={'User-Agent': 'mini-sns-app/1.0'},
-            timeout=5
-        )
-        data = resp.json()
-        if isinstance(data, list) and data:
-            item = data[0]
-            return {'lat': float(item.get('lat')), 'lng': float(item.get('lon'))}
+        found = lookup_address(query)
+        if found:
+            return {'lat': found[0], 'lng': found[1]}
         return {'error': 'not_found'}, 404
+    except LookupPending:
+        raise
     except Exception:
         return {'error': 'geocode_failed'}, 500
 
@@ -423,40 +981,134 @@ def index():
     page_size = 6
     offset = (page - 1) * page_size
 
+    # {posts} is the live table, and the archive for pages past the live rows (archive.page)
     if q and cat:
         like = f"%{q}%"
-        total = db.execute('SELECT COUNT(*) AS c FROM posts WHERE content LIKE ? AND category = ?', (like, cat)).fetchone()['c']
-        posts = db.execute(
-            'SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id WHERE posts.content LIKE ? AND posts.category = ? ORDER BY created_at DESC LIMIT ? OFFSET ?',
-            (like, cat, page_size, offset)
-        ).fetchall()
+        where, params = ' WHERE posts.content LIKE ? AND posts.category = ?', (like, cat)
     elif q:
         like = f"%{q}%"
-        total = db.execute('SELECT COUNT(*) AS c FROM posts WHERE content LIKE ?', (like,)).fetchone()['c']
-        posts = db.execute(
-            'SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id WHERE posts.content LIKE ? ORDER BY created_at DESC LIMIT ? OFFSET ?',
-            (like, page_size, offset)
-        ).fetchall()
+        where, params = ' WHERE posts.content LIKE ?', (like,)
+    elif cat:
+        where, params = ' WHERE posts.category = ?', (cat,)
+    else:
+        where, params = '', ()
+    count_sql = 'SELECT COUNT(*) FROM {posts} AS posts' + where
+    if q:
+        total = db.execute(count_sql.format(posts='main.posts'), params).fetchone()[0]
+        if offset + page_size >= total:
+            # last live page: count the archived matches too so paging can go on
+            total += archive.count(db, count_sql, params)
     elif cat:
-        total = db.execute('SELECT COUNT(*) AS c FROM posts WHERE category = ?', (cat,)).fetchone()['c']
-        posts = db.execute(
-            'SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id WHERE posts.category = ? ORDER BY created_at DESC LIMIT ? OFFSET ?',
-            (cat, page_size, offset)
+        total = counters.get(db, f'posts:cat:{cat}')
+    else:
+        total = counters.get(db, 'posts')
+    posts = archive.page(
+        db, 'SELECT ' + records.FEED_CARD.select + ' FROM {posts} AS posts JOIN users ON posts.user_id = users.id' + where + ' ORDER BY posts.created_at DESC LIMIT ? OFFSET ?',
+        count_sql, params, page_size, offset, records.FEED_CARD.factory)
+
+    total_pages = max(1, (total + page_size - 1) // page_size)
+    user = current_user()
+    bookmarked_ids = set()
+    followed_shops = set()
+    if user:
+        rows = db.execute('SELECT post_id FROM bookmarks WHERE user_id = ?', (user['id'],)).fetchall()
+        bookmarked_ids = {r['post_id'] for r in rows}
+        followed_shops = {r['shop_key'] for r in db.execute('SELECT shop_key FROM shop_follows WHERE user_id = ?', (user['id'],)).fetchall()}
+    return render_template('index.html', posts=posts, user=user, page=page, total_pages=total_pages, q=q, cat=cat, bookmarked_ids=bookmarked_ids, followed_shops=followed_shops)
+
+
+@app.route('/trending')
+def trending_posts():
+    # served straight from the hot_score indexes (see trending.create_indexes)
+    db = get_db()
+    cat = request.args.get('cat', '').strip()
+    sc = request.args.get('sc', '').strip()
+    try:
+        page = int(request.args.get('page', '1'))
+    except ValueError:
+        page = 1
+    max_page = (TRENDING_LIMIT + TRENDING_PAGE_SIZE - 1) // TRENDING_PAGE_SIZE
+    page = min(max(1, page), max_page)
+    offset = (page - 1) * TRENDING_PAGE_SIZE
+    limit = min(TRENDING_PAGE_SIZE, TRENDING_LIMIT - offset) + 1
+
+    if sc in SHOP_CATEGORIES:
+        cat = 'shop_intro'
+        posts = records.TRENDING_CARD.execute(
+            db, 'SELECT ' + records.TRENDING_CARD.select + " FROM posts JOIN users ON posts.user_id = users.id WHERE posts.category = 'shop_intro' AND posts.shop_category = ? AND posts.hot_score > 0 ORDER BY posts.hot_score DESC, posts.id DESC LIMIT ? OFFSET ?",
+            (sc, limit, offset)
+        ).fetchall()
+    elif cat in {'food_photo', 'shop_intro', 'recipe_intro'}:
+        sc = ''
+        posts = records.TRENDING_CARD.execute(
+            db, 'SELECT ' + records.TRENDING_CARD.select + ' FROM posts JOIN users ON posts.user_id = users.id WHERE posts.category = ? AND posts.hot_score > 0 ORDER BY posts.hot_score DESC, posts.id DESC LIMIT ? OFFSET ?',
+            (cat, limit, offset)
         ).fetchall()
     else:
-        total = db.execute('SELECT COUNT(*) AS c FROM posts').fetchone()['c']
-        posts = db.execute(
-            'SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id ORDER BY created_at DESC LIMIT ? OFFSET ?',
-            (page_size, offset)
+        cat = sc = ''
+        posts = records.TRENDING_CARD.execute(
+            db, 'SELECT ' + records.TRENDING_CARD.select + ' FROM posts JOIN users ON posts.user_id = users.id WHERE posts.hot_score > 0 ORDER BY posts.hot_score DESC, posts.id DESC LIMIT ? OFFSET ?',
+            (limit, offset)
         ).fetchall()
+    has_next = len(posts) == limit and offset + TRENDING_PAGE_SIZE < TRENDING_LIMIT
+    posts = posts[:limit - 1]
 
-    total_pages = max(1, (total + page_size - 1) // page_size)
     user = current_user()
     bookmarked_ids = set()
     if user:
         rows = db.execute('SELECT post_id FROM bookmarks WHERE user_id = ?', (user['id'],)).fetchall()
         bookmarked_ids = {r['post_id'] for r in rows}
-    return render_template('index.html', posts=posts, user=user, page=page, total_pages=total_pages, q=q, cat=cat, bookmarked_ids=bookmarked_ids)
+    return render_template('trending.html', posts=posts, user=user, page=page, has_next=has_next, cat=cat, sc=sc,
+                           rank_offset=offset, shop_categories=SHOP_CATEGORIES, bookmarked_ids=bookmarked_ids)
+
+
+def shop_results(db, shop_ids, distances=None):
+    # one entry per shop: its latest post plus the shop totals (shop_posts, shop_likes)
+    latest = {}
+    totals = {}
+    for i in range(0, len(shop_ids), 500):
+        chunk = shop_ids[i:i + 500]
+        marks = ','.join('?' * len(chunk))
+        for r in records.SHOP_CARD.execute(db, f'SELECT {records.SHOP_CARD.select} FROM all_posts AS posts JOIN users ON posts.user_id = users.id WHERE posts.id IN (SELECT MAX(id) FROM all_posts WHERE shop_id IN ({marks}) GROUP BY shop_id)', chunk):
+            latest[r.shop_id] = r
+        for r in db.execute(f'SELECT id, post_count, likes FROM shops WHERE id IN ({marks})', chunk).fetchall():
+            totals[r['id']] = r
+    results = []
+    for sid in shop_ids:
+        p = latest.get(sid)
+        if p is None:
+            continue
+        p.shop_posts = totals[sid]['post_count'] if sid in totals else 1
+        p.shop_likes = totals[sid]['likes'] if sid in totals else p.likes
+        if distances is not None:
+            p.distance_km = round(distances[sid], 2)
+        results.append(p)
+    return results
+
+
+def near_results(db, lat, lng, radius_km, more_url):
+    # shops inside the radius, nearest first, as a streamed result; c = offset into the distance order.
+    # Sources and transforms of a streamed result run after the view returned: they call get_db() themselves
+    try:
+        start = max(0, int(request.args.get('c', '0')))
+    except ValueError:
+        start = 0
+    # enough for this page and the check for a next one (streaming.Results stops at CAP)
+    found = shops.within(db, lat, lng, radius_km, limit=start + streaming.CAP + 1)
+    distances = {r['id']: d for r, d in found}
+    return streaming.Results(
+        [('near', lambda: enumerate(found[start:], start))],
+        transform=lambda chunk: shop_results(get_db(), [r['id'] for _, (r, _) in chunk], distances),
+        more_url=lambda tag, row: more_url(row[0] + 1))
+
+
+def stream_page(template, **context):
+    # headers (and the session cookie) go out before the template runs, so
+    # the session writes a render can make happen now: popping the flashes
+    # and creating the CSRF token; the template then only reads them
+    get_flashed_messages()
+    generate_csrf()
+    return app.response_class(streaming.buffered(stream_template(template, **context)), mimetype='text/html')
 
 
 @app.route('/search')
@@ -465,55 +1117,72 @@ def search():
     q = request.args.get('q', '').strip()
     t = (request.args.get('t', 'all') or 'all').strip()
     addr = request.args.get('address', '').strip()
+    archived = request.args.get('archived') == '1' and archive.attached(db)
+    after = request.args.get('c', '')
     try:
         radius_km = float(request.args.get('r', '2'))
     except ValueError:
         radius_km = 2.0
 
-    posts = []
+    results = streaming.Results([])
     lat = lng = None
 
     if q:
         like = f"%{q}%"
         if t == 'shop':
-            posts = db.execute(
-                "SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id WHERE posts.category = 'shop_intro' AND (posts.shop_name LIKE ? OR posts.content LIKE ?) ORDER BY posts.created_at DESC",
-                (like, like)
-            ).fetchall()
-        elif t == 'recipe':
-            posts = db.execute(
-                "SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id WHERE posts.category = 'recipe_intro' AND posts.content LIKE ? ORDER BY posts.created_at DESC",
-                (like,)
-            ).fetchall()
+            # one hit per shop, matched on its name or on any of its posts; newest latest post first
+            sql = ("SELECT shop_id, MAX(id) AS latest FROM all_posts WHERE shop_id IN ("
+                   "SELECT id FROM shops WHERE name LIKE ? OR name_key LIKE ? "
+                   "UNION SELECT shop_id FROM all_posts WHERE category = 'shop_intro' AND content LIKE ?) GROUP BY shop_id")
+            params = [like, f"%{shops.normalize_name(q)}%", like]
+            if after.isdigit():
+                sql += ' HAVING latest < ?'
+                params.append(int(after))
+            sql += ' ORDER BY latest DESC LIMIT ?'
+            params.append(streaming.CAP + 1)
+            results = streaming.Results(
+                [('shop', lambda: get_db().execute(sql, params))],
+                transform=lambda chunk: shop_results(get_db(), [r['shop_id'] for r in chunk]),
+                more_url=lambda tag, row: url_for('search', q=q, t=t, c=row['latest']))
         else:
-            posts = db.execute(
-                "SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id WHERE posts.content LIKE ? ORDER BY posts.created_at DESC",
-                (like,)
-            ).fetchall()
+            sql = 'SELECT ' + records.FEED_CARD.select + " FROM {posts} AS posts JOIN users ON posts.user_id = users.id WHERE posts.content LIKE ?"
+            if t == 'recipe':
+                sql += " AND posts.category = 'recipe_intro'"
+            # c = "<live|archive>:<id>:<created_at>" of the last row shown
+            tag, _, rest = after.partition(':')
+            last_id, _, last_created = rest.partition(':')
+            sources = []
+            # continuation past the live results (archive.py)
+            for schema in ('main', 'archive') if archived else ('main',):
+                src = 'live' if schema == 'main' else 'archive'
+                if tag == 'archive' and src == 'live':
+                    continue
+                s, params = sql, [like]
+                if tag == src and last_id.isdigit():
+                    s += ' AND (posts.created_at, posts.id) < (?, ?)'
+                    params += [last_created, int(last_id)]
+                s += ' ORDER BY posts.created_at DESC, posts.id DESC LIMIT ?'
+                params.append(streaming.CAP + 1)
+                sources.append((src, lambda s=s.format(posts=f'{schema}.posts'), params=params: records.FEED_CARD.execute(get_db(), s, params)))
+            results = streaming.Results(
+                sources,
+                more_url=lambda tag, row: url_for('search', q=q, t=t, archived=1 if archived else None, c=f"{tag}:{row['id']}:{row['created_at']}"))
     elif addr:
         try:
-            resp = requests.get('https://nominatim.openstreetmap.org/search', params={'q': addr, 'format': 'json', 'limit': 1}, headers={'User-Agent': 'mini-sns-app/1.0'}, timeout=5)
-            data = resp.json()
-            if isinstance(data, list) and data:
-                lat = float(data[0].get('lat'))
-                lng = float(data[0].get('lon'))
+            lat, lng = lookup_address(addr) or (None, None)
+        except LookupPending:
+            raise
         except Exception:
             lat = lng = None
         if lat is not None and lng is not None:
-            rows = db.execute("SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id WHERE posts.category = 'shop_intro' AND posts.shop_lat IS NOT NULL AND posts.shop_lng IS NOT NULL ORDER BY created_at DESC").fetchall()
-            for p in rows:
-                d = haversine_km(lat, lng, p['shop_lat'], p['shop_lng'])
-                if d <= radius_km:
-                    pr = dict(p)
-                    pr['distance_km'] = round(d, 2)
-                    posts.append(pr)
+            results = near_results(db, lat, lng, radius_km, lambda start: url_for('search', address=addr, r=radius_km, c=start))
 
     user = current_user()
     bookmarked_ids = set()
     if user:
         rows = db.execute('SELECT post_id FROM bookmarks WHERE user_id = ?', (user['id'],)).fetchall()
         bookmarked_ids = {r['post_id'] for r in rows}
-    return render_template('search.html', posts=posts, user=user, address=addr, radius_km=radius_km, lat=lat, lng=lng, q=q, t=t, bookmarked_ids=bookmarked_ids)
+    return stream_page('search.html', results=results, user=user, address=addr, radius_km=radius_km, lat=lat, lng=lng, q=q, t=t, bookmarked_ids=bookmarked_ids, archived=archived)
 
 
 @app.route('/post', methods=['POST'])
@@ -572,8 +1241,9 @@ def post():
             if v and len(v) > TEXT_MAX_LEN:
                 flash('店舗詳細の文字数が長すぎます')
                 return redirect(url_for('index'))
-    file = request.files.get('image')
+    file = request.files.get('image') or claimed_upload(user, 'post')
     image_name = None
+    image_hash = image_meta = duplicate_of = None
     # 料理写真SNSのため、画像は必須
     if not file or file.filename == '':
         flash('料理写真を必ず添付してください')
@@ -610,12 +1280,25 @@ def post():
                         os.remove(save_path)
                         flash('料理写真ではない可能性があります。料理写真のみ投稿できます。')
                         return redirect(url_for('index'))
-                    img.thumbnail((400, 400))
-                    thumb_name = f"thumb_{basename}"
-                    thumb_path = os.path.join(THUMB_DIR, thumb_name)
-                    img.save(thumb_path)
+                    img = images.orient(img)
+                    image_hash = images.dhash(img)
+                    duplicate_of = images.find_duplicate(get_db(), image_hash)
+                    if duplicate_of and images.DEDUP_MODE == 'reject':
+                        os.remove(save_path)
+                        flash('同じ写真がすでに投稿されています')
+                        return redirect(url_for('index'))
+                    if duplicate_of and images.DEDUP_MODE == 'reuse' and upload_store.stat(f'uploads/{duplicate_of}') is not None:
+                        # the same photo is already stored: share that file and its thumbnail
+                        os.remove(save_path)
+                        basename = duplicate_of
+                    else:
+                        basename, image_meta = ingest_upload(img, save_path)
+                        if basename is None:
+                            flash('画像の保存に失敗しました')
+                            return redirect(url_for('index'))
                 except Exception:
                     pass
+                publish_image(basename)
                 image_name = basename
             except Exception:
                 flash('画像の保存に失敗しました')
@@ -625,15 +1308,30 @@ def post():
             return redirect(url_for('index'))
 
     db = get_db()
-    db.execute('INSERT INTO posts (user_id, content, image, category, shop_category, shop_name, shop_address, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-               (user['id'], content, image_name, category, shop_category, shop_name, shop_address, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng, datetime.utcnow().isoformat()))
+    shop_id = None
+    if category == 'shop_intro':
+        shop_id = shops.resolve(db, shop_name, shop_address, shop_category, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng)
+    cur = db.execute('INSERT INTO posts (user_id, content, image, category, shop_category, shop_name, shop_address, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng, shop_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+               (user['id'], content, image_name, category, shop_category, shop_name, shop_address, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng, shop_id, datetime.utcnow().isoformat()))
+    counters.bump(db, counters.post_keys(user['id'], category), 1)
+    shops.bump(db, shop_id, posts=1)
+    if image_hash is not None and image_name != duplicate_of:
+        images.record(db, image_name, image_hash, duplicate_of, image_meta)
+    trending.add(db, cur.lastrowid, trending.POST_WEIGHT)
     db.commit()
+    events.publish('post', id=cur.lastrowid, username=user['username'], category=category)
+    if category == 'shop_intro':
+        notify.enqueue('shop_post', cur.lastrowid, actor_id=user['id'], shop_key=shop_key(shop_name))
     return redirect(url_for('index'))
 
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
+        allowed, retry = register_ip_limiter.consume(client_ip())
+        if not allowed:
+            flash('登録の試行が多すぎます。しばらくしてからお試しください')
+            return render_template('register.html'), 429, {'Retry-After': str(int(retry) + 1)}
         username = request.form.get('username', '').strip()
         # normalize to single leading '@'
         if username:
@@ -671,13 +1369,21 @@ def register():
             flash(msg)
             return redirect(url_for('register'))
         db = get_db()
+        if db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+            flash('そのユーザー名は既に使われています')
+            return redirect(url_for('register'))
+        try:
+            pwhash = auth.hash_password(password)
+        except auth.AuthBusy:
+            flash('混雑しています。しばらくしてから再度お試しください')
+            return render_template('register.html'), 503, {'Retry-After': '5'}
         # same email allowed; rely on unique username only
         try:
             code = f"{random.randint(0,9999):04d}"
             expires_at = (datetime.utcnow()).timestamp() + 600  # 10 minutes
             now_iso = datetime.utcnow().isoformat()
             db.execute('INSERT INTO users (username, email, password_hash, is_verified, verification_code, verification_code_expires_at, verification_attempts, last_code_sent_at) VALUES (?, ?, ?, 0, ?, ?, 0, ?)',
-                       (username, email, generate_password_hash(password), code, str(expires_at), now_iso))
+                       (username, email, pwhash, code, str(expires_at), now_iso))
             db.commit()
         except sqlite3.IntegrityError:
             flash('そのユーザー名は既に使われています')
@@ -699,13 +1405,32 @@ def login():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
+        # throttle before any DB or KDF work
+        user_key = '@' + username.lstrip('@').lower()
+        ok_ip, retry_ip = login_ip_limiter.consume(client_ip())
+        ok_user, retry_user = login_user_limiter.peek(user_key)
+        if not (ok_ip and ok_user):
+            flash('ログインの試行が多すぎます。しばらくしてからお試しください')
+            return render_template('login.html'), 429, {'Retry-After': str(int(max(retry_ip, retry_user)) + 1)}
         db = get_db()
         # support login with or without leading '@'
         user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
         if not user:
             normalized = '@' + username.lstrip('@')
             user = db.execute('SELECT * FROM users WHERE username = ?', (normalized,)).fetchone()
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            valid = bool(user) and auth.verify_password(user['password_hash'], password)
+        except auth.AuthBusy:
+            flash('混雑しています。しばらくしてから再度お試しください')
+            return render_template('login.html'), 503, {'Retry-After': '5'}
+        if valid:
+            try:
+                if auth.needs_rehash(user['password_hash']):
+                    # hash parameters changed since this password was stored
+                    db.execute('UPDATE users SET password_hash = ? WHERE id = ?', (auth.hash_password(password), user['id']))
+                    db.commit()
+            except auth.AuthBusy:
+                pass
             if user['is_verified'] == 0:
                 session['pending_email'] = user['email']
                 flash('登録確認コードを入力してください')
@@ -714,6 +1439,7 @@ def login():
             session['user_id'] = user['id']
             flash('ログインしました')
             return redirect(url_for('index'))
+        login_user_limiter.consume(user_key)
         flash('ユーザー名またはパスワードが間違っています')
         return redirect(url_for('login'))
     return render_template('login.html')
@@ -732,6 +1458,15 @@ def health():
     return 'OK', 200
 
 
+@app.route('/metrics.json')
+def metrics_json():
+    # request rate, latency percentiles and DB connection stats of this process
+    # (tk_launcher); local clients only, not through a proxy or tunnel
+    if request.remote_addr not in ('127.0.0.1', '::1') or request.headers.get('X-Forwarded-For') or request.headers.get('CF-Connecting-IP'):
+        abort(404)
+    return metrics.snapshot(), 200, {'Cache-Control': 'no-store'}
+
+
 @app.route('/edit/<int:post_id>', methods=['GET', 'POST'])
 def edit(post_id):
     user = current_user()
@@ -739,7 +1474,9 @@ def edit(post_id):
         flash('ログインしてください')
         return redirect(url_for('index'))
     db = get_db()
-    post = db.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+    # an archived post is edited in place (archive.py)
+    table = archive.holder(db, post_id) or 'main.posts'
+    post = db.execute(f'SELECT * FROM {table} WHERE id = ?', (post_id,)).fetchone()
     if not post:
         flash('投稿が見つかりません')
         return redirect(url_for('index'))
@@ -759,6 +1496,8 @@ def edit(post_id):
         shop_hours = None
         shop_phone = None
         shop_price_range = None
+        shop_lat = None
+        shop_lng = None
         if category == 'shop_intro':
             shop_category = request.form.get('shop_category', '').strip()
             if shop_category not in SHOP_CATEGORIES:
@@ -793,8 +1532,9 @@ def edit(post_id):
                 if v and len(v) > TEXT_MAX_LEN:
                     flash('店舗詳細の文字数が長すぎます')
                     return redirect(url_for('edit', post_id=post_id))
-        file = request.files.get('image')
+        file = request.files.get('image') or claimed_upload(user, 'post')
         image_name = post['image']
+        image_hash = image_meta = duplicate_of = None
         if file and file.filename:
             fname = secure_filename(file.filename)
             ext = fname.rsplit('.', 1)[-1].lower() if '.' in fname else ''
@@ -823,12 +1563,24 @@ def edit(post_id):
                             os.remove(save_path)
                             flash('料理写真ではない可能性があります。料理写真のみ投稿できます。')
                             return redirect(url_for('edit', post_id=post_id))
-                        img.thumbnail((400, 400))
-                        thumb_name = f"thumb_{basename}"
-                        thumb_path = os.path.join(THUMB_DIR, thumb_name)
-                        img.save(thumb_path)
+                        img = images.orient(img)
+                        image_hash = images.dhash(img)
+                        duplicate_of = images.find_duplicate(db, image_hash)
+                        if duplicate_of and images.DEDUP_MODE == 'reject' and duplicate_of != post['image']:
+                            os.remove(save_path)
+                            flash('同じ写真がすでに投稿されています')
+                            return redirect(url_for('edit', post_id=post_id))
+                        if duplicate_of and images.DEDUP_MODE == 'reuse' and upload_store.stat(f'uploads/{duplicate_of}') is not None:
+                            os.remove(save_path)
+                            basename = duplicate_of
+                        else:
+                            basename, image_meta = ingest_upload(img, save_path)
+                            if basename is None:
+                                flash('画像の保存に失敗しました')
+                                return redirect(url_for('edit', post_id=post_id))
                     except Exception:
                         pass
+                    publish_image(basename)
                     image_name = basename
                 except Exception:
                     flash('画像の保存に失敗しました')
@@ -841,7 +1593,19 @@ def edit(post_id):
             if not image_name:
                 flash('料理写真SNSのため画像は必須です')
                 return redirect(url_for('edit', post_id=post_id))
-        db.execute('UPDATE posts SET content = ?, image = ?, category = ?, shop_category = ?, shop_name = ?, shop_address = ?, shop_url = ?, shop_hours = ?, shop_phone = ?, shop_price_range = ?, shop_lat = ?, shop_lng = ? WHERE id = ?', (content, image_name, category, shop_category, shop_name, shop_address, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng, post_id))
+        shop_id = None
+        if category == 'shop_intro':
+            shop_id = shops.resolve(db, shop_name, shop_address, shop_category, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng)
+        if shop_id != post['shop_id']:
+            shops.bump(db, post['shop_id'], posts=-1, likes=-(post['likes'] or 0))
+            shops.bump(db, shop_id, posts=1, likes=post['likes'] or 0)
+        if image_hash is not None and image_name != duplicate_of:
+            images.record(db, image_name, image_hash, duplicate_of, image_meta)
+        db.execute(f'UPDATE {table} SET content = ?, image = ?, category = ?, shop_category = ?, shop_name = ?, shop_address = ?, shop_url = ?, shop_hours = ?, shop_phone = ?, shop_price_range = ?, shop_lat = ?, shop_lng = ?, shop_id = ? WHERE id = ?', (content, image_name, category, shop_category, shop_name, shop_address, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng, shop_id, post_id))
+        if category != post['category']:
+            db.execute('UPDATE bookmarks SET post_category = ? WHERE post_id = ?', (category, post_id))
+            counters.bump(db, [f"posts:cat:{post['category'] or 'food_photo'}"], -1)
+            counters.bump(db, [f'posts:cat:{category}'], 1)
         db.commit()
         flash('投稿を更新しました')
         return redirect(url_for('index'))
@@ -855,26 +1619,31 @@ def delete(post_id):
         flash('ログインしてください')
         return redirect(url_for('index'))
     db = get_db()
-    post = db.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+    table = archive.holder(db, post_id) or 'main.posts'
+    post = db.execute(f'SELECT * FROM {table} WHERE id = ?', (post_id,)).fetchone()
     if not post:
         flash('投稿が見つかりません')
         return redirect(url_for('index'))
     if post['user_id'] != user['id']:
         flash('権限がありません')
         return redirect(url_for('index'))
-    # delete image files if present
-    if post['image']:
+    # delete image files if present (and not shared with another post, see SNS_DEDUP_MODE=reuse)
+    if post['image'] and not db.execute('SELECT 1 FROM all_posts WHERE image = ? AND id != ?', (post['image'], post_id)).fetchone():
+        images.forget(db, post['image'])
         try:
-            p = os.path.join(UPLOAD_DIR, post['image'])
-            if os.path.exists(p):
-                os.remove(p)
-            tp = os.path.join(THUMB_DIR, f"thumb_{post['image']}")
-            if os.path.exists(tp):
-                os.remove(tp)
+            upload_store.delete(f"uploads/{post['image']}")
+            upload_store.delete(f"uploads/thumbs/thumb_{post['image']}")
         except Exception:
             pass
-    db.execute('DELETE FROM posts WHERE id = ?', (post_id,))
+    # bookmarks of a deleted post would never be listed; drop them and fix the folder counts
+    for r in db.execute("SELECT user_id, COALESCE(folder, '') AS folder, COUNT(*) AS c FROM bookmarks WHERE post_id = ? GROUP BY user_id, COALESCE(folder, '')", (post_id,)).fetchall():
+        bump_bookmark_folder(db, r['user_id'], r['folder'], -r['c'])
+    db.execute('DELETE FROM bookmarks WHERE post_id = ?', (post_id,))
+    db.execute(f'DELETE FROM {table} WHERE id = ?', (post_id,))
+    counters.bump(db, counters.post_keys(post['user_id'], post['category']), -1)
+    shops.bump(db, post['shop_id'], posts=-1, likes=-(post['likes'] or 0))
     db.commit()
+    events.publish('delete', id=post_id)
     flash('投稿を削除しました')
     return redirect(url_for('index'))
 
@@ -893,8 +1662,9 @@ def profile(username):
     page = max(1, page)
     page_size = 8
     offset = (page - 1) * page_size
-    total = db.execute('SELECT COUNT(*) AS c FROM posts WHERE user_id = ?', (user_row['id'],)).fetchone()['c']
-    posts = db.execute('SELECT * FROM posts WHERE user_id = ? ORDER BY created_at DESC LIMIT ? OFFSET ?', (user_row['id'], page_size, offset)).fetchall()
+    total = counters.get(db, f"posts:user:{user_row['id']}")
+    posts = archive.page(db, 'SELECT ' + records.PROFILE_CARD.select + ' FROM {posts} AS posts WHERE posts.user_id = ? ORDER BY posts.created_at DESC LIMIT ? OFFSET ?',
+                         'SELECT COUNT(*) FROM {posts} WHERE user_id = ?', (user_row['id'],), page_size, offset, records.PROFILE_CARD.factory)
     total_pages = max(1, (total + page_size - 1) // page_size)
     me = current_user()
     return render_template('profile.html', profile=user_row, posts=posts, page=page, total_pages=total_pages, me=me)
@@ -959,20 +1729,21 @@ def stripe_webhook():
 @app.route('/like/<int:post_id>', methods=['POST'])
 def like(post_id):
     db = get_db()
-    db.execute('UPDATE posts SET likes = likes + 1 WHERE id = ?', (post_id,))
+    table = archive.holder(db, post_id) or 'main.posts'
+    db.execute(f'UPDATE {table} SET likes = likes + 1 WHERE id = ?', (post_id,))
+    db.execute('UPDATE bookmarks SET post_likes = post_likes + 1 WHERE post_id = ?', (post_id,))
+    trending.add(db, post_id, trending.LIKE_WEIGHT)
+    shop_id = shops.bump_post(db, post_id, 1, table)
     db.commit()
+    if shop_id:
+        tasks.submit(('rescore_shop', shop_id), rescore_shop, shop_id)
+    row = db.execute(f'SELECT likes FROM {table} WHERE id = ?', (post_id,)).fetchone()
+    if row:
+        events.publish('like', id=post_id, likes=row['likes'])
+        notify.enqueue('like', post_id, actor_id=session.get('user_id'))
     return redirect(url_for('index'))
 
 
-def haversine_km(lat1, lon1, lat2, lon2):
-    R = 6371.0
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
-
-
 @app.route('/near')
 def near():
     try:
@@ -986,27 +1757,306 @@ def near():
     except ValueError:
         radius_km = 2.0
     db = get_db()
-    rows = db.execute("SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id WHERE posts.category = 'shop_intro' AND posts.shop_lat IS NOT NULL AND posts.shop_lng IS NOT NULL ORDER BY created_at DESC").fetchall()
-    results = []
-    for p in rows:
-        d = haversine_km(lat, lng, p['shop_lat'], p['shop_lng'])
-        if d <= radius_km:
-            pr = dict(p)
-            pr['distance_km'] = round(d, 2)
-            results.append(pr)
+    results = near_results(db, lat, lng, radius_km, lambda start: url_for('near', lat=lat, lng=lng, r=radius_km, c=start))
     user = current_user()
     bookmarked_ids = set()
     if user:
         rows = db.execute('SELECT post_id FROM bookmarks WHERE user_id = ?', (user['id'],)).fetchall()
         bookmarked_ids = {r['post_id'] for r in rows}
     # Render proximity results on search page
-    return render_template('search.html', posts=results, user=user, address='', radius_km=radius_km, lat=lat, lng=lng, q='', t='shop', bookmarked_ids=bookmarked_ids)
+    return stream_page('search.html', results=results, user=user, address='', radius_km=radius_km, lat=lat, lng=lng, q='', t='shop', bookmarked_ids=bookmarked_ids)
+
+
+@app.route('/api/shops/suggest')
+def shop_suggest():
+    prefix = request.args.get('prefix', '').strip()[:50]
+    if not prefix:
+        return {'shops': []}
+    try:
+        limit = min(20, max(1, int(request.args.get('limit', '10'))))
+    except ValueError:
+        limit = 10
+    return {'shops': suggest.suggest(get_db(), prefix, limit)}, 200, {'Cache-Control': 'private, max-age=60'}
+
+
+def upload_request(data):
+    # (kind, content type, ext, size) of an upload the client announces, or an error response
+    kind = data.get('kind')
+    ext = UPLOAD_TYPES.get(kind, {}).get(data.get('content_type'))
+    if not ext:
+        return None, ({'error': 'unsupported_type'}, 400)
+    max_bytes = MAX_IMAGE_SIZE_MB * 1024 * 1024
+    try:
+        size = int(data.get('size') or 0)
+    except (TypeError, ValueError):
+        return None, ({'error': 'bad_size'}, 400)
+    if size > max_bytes:
+        return None, ({'error': 'too_large', 'max_bytes': max_bytes}, 413)
+    return (kind, data['content_type'], ext, size), None
+
+
+def incoming_key(kind, user, ext):
+    # claimed_upload() accepts only keys under the user's own prefix
+    return f"{storage.INCOMING}{kind}/{user['id']}/{secrets.token_urlsafe(12)}.{ext}"
+
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    # presigned direct upload: the browser sends the bytes to storage, then
+    # submits the form with upload_key instead of the file (claimed_upload)
+    user = current_user()
+    if not user:
+        return {'error': 'login_required'}, 401
+    upload, error = upload_request(request.get_json(silent=True) or {})
+    if error:
+        return error
+    kind, content_type, ext, _ = upload
+    key = incoming_key(kind, user, ext)
+    max_bytes = MAX_IMAGE_SIZE_MB * 1024 * 1024
+    return {'key': key, 'upload': upload_store.presign_upload(key, content_type, max_bytes)}, 200, {'Cache-Control': 'no-store'}
+
+
+@app.route('/api/uploads/chunked', methods=['POST'])
+def create_chunked_upload():
+    # resumable upload (chunked.py): create, PUT the chunks in order, finalize;
+    # finalize returns an upload_key for the form, as a direct upload does
+    user = current_user()
+    if not user:
+        return {'error': 'login_required'}, 401
+    data = request.get_json(silent=True) or {}
+    upload, error = upload_request(data)
+    if error:
+        return error
+    kind, content_type, ext, size = upload
+    if size <= 0:
+        return {'error': 'bad_size'}, 400
+    try:
+        chunk_size = int(data.get('chunk_size') or 0) or None
+    except (TypeError, ValueError):
+        return {'error': 'bad_chunk_size'}, 400
+    return upload_staging.create(user['id'], kind, content_type, ext, size, chunk_size), 201, {'Cache-Control': 'no-store'}
+
+
+@app.route('/api/uploads/chunked/<upload_id>', methods=['GET', 'DELETE'])
+def chunked_upload_status(upload_id):
+    # where to resume: next_index / received; DELETE gives the upload up
+    user = current_user()
+    if not user:
+        return {'error': 'login_required'}, 401
+    if request.method == 'DELETE':
+        upload_staging.status(user['id'], upload_id)  # 404 if unknown
+        upload_staging.discard(user['id'], upload_id)
+        return '', 204
+    return upload_staging.status(user['id'], upload_id), 200, {'Cache-Control': 'no-store'}
+
+
+@app.route('/api/uploads/chunked/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    # body: the chunk's bytes; X-Chunk-SHA256: their hex sha256 (optional, checked if sent)
+    user = current_user()
+    if not user:
+        return {'error': 'login_required'}, 401
+    if (request.content_length or 0) > chunked.MAX_CHUNK_BYTES:
+        return {'error': 'chunk_too_large', 'max_bytes': chunked.MAX_CHUNK_BYTES}, 413
+    data = request.stream.read(chunked.MAX_CHUNK_BYTES + 1)
+    if len(data) > chunked.MAX_CHUNK_BYTES:
+        return {'error': 'chunk_too_large', 'max_bytes': chunked.MAX_CHUNK_BYTES}, 413
+    return upload_staging.append(user['id'], upload_id, index, data, request.headers.get('X-Chunk-SHA256'))
+
+
+@app.route('/api/uploads/chunked/<upload_id>/finalize', methods=['POST'])
+def finalize_chunked_upload(upload_id):
+    # the assembled file becomes an incoming upload; the form then claims it
+    # with upload_key and post()/edit()/update_icon() validate and ingest it
+    user = current_user()
+    if not user:
+        return {'error': 'login_required'}, 401
+    data = request.get_json(silent=True) or {}
+    meta, path = upload_staging.finalize(user['id'], upload_id, data.get('sha256'))
+    key = incoming_key(meta['kind'], user, meta['ext'])
+    try:
+        upload_store.put_file(key, path, meta['content_type'])
+    except FileNotFoundError:
+        # finalized by a concurrent request
+        return {'error': 'not_found'}, 404
+    upload_staging.discard(user['id'], upload_id)
+    return {'key': key}, 200, {'Cache-Control': 'no-store'}
+
+
+@app.route('/storage/upload', methods=['POST'])
+@csrf.exempt
+def storage_upload():
+    # the local backend's presigned POST target; the signed fields authorize it
+    if not upload_store.local:
+        abort(404)
+    try:
+        upload_store.receive(request.form, request.files.get('file'))
+    except storage.StorageError as e:
+        return {'error': str(e)}, 403
+    return '', 204
+
+
+@app.route('/img/<name>', defaults={'kind': 'posts'})
+@app.route('/img/avatars/<name>', defaults={'kind': 'avatars'})
+def image_derivative(name, kind):
+    # resized copy of an upload or avatar, rendered once into the derivative cache
+    if name != secure_filename(name):
+        abort(404)
+    source = os.path.join(AVATAR_DIR if kind == 'avatars' else UPLOAD_DIR, name)
+    if not os.path.isfile(source):
+        abort(404)
+    width = derivatives.pick_width(request.args.get('w', images.THUMB_SIZE))
+    if width is None:
+        abort(400)
+    fmt = request.args.get('fmt', '').lower().replace('jpeg', 'jpg')
+    if fmt and fmt not in derivatives.FORMATS:
+        abort(400)
+    if str(width) != request.args.get('w'):
+        # one URL per allowed width, so the proxy cache is not split by near-identical widths
+        args = {'w': width, 'fmt': fmt} if fmt else {'w': width}
+        return redirect(url_for('image_derivative', name=name, kind=kind, **args), 301)
+    negotiated = not fmt
+    if negotiated:
+        fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpg'
+    for _ in range(2):
+        try:
+            path = derivative_cache.get(source, kind, width, fmt)
+        except Exception:
+            abort(404)  # not a readable image
+        # the cache key (source mtime + size + format) is the validator; the file's own mtime moves on every hit
+        try:
+            resp = send_file(path, mimetype=derivatives.FORMATS[fmt][1], conditional=True, etag=os.path.basename(path),
+                             last_modified=os.path.getmtime(source), max_age=IMAGE_MAX_AGE)
+        except FileNotFoundError:
+            continue  # evicted by another worker in between; get() renders it again
+        break
+    else:
+        abort(503)
+    resp.headers['Cache-Control'] = f'public, max-age={IMAGE_MAX_AGE}, stale-while-revalidate=86400'
+    if negotiated:
+        resp.headers['Vary'] = 'Accept'
+    return resp
+
+
+@app.route('/api/shops/clusters')
+def shop_clusters():
+    # map markers: one aggregate per grid cell (see clusters.py), bbox = min_lng,min_lat,max_lng,max_lat
+    try:
+        min_lng, min_lat, max_lng, max_lat = [float(v) for v in request.args.get('bbox', '').split(',')]
+        zoom = int(float(request.args.get('zoom', '')))
+    except (ValueError, OverflowError):
+        return {'error': 'bbox=min_lng,min_lat,max_lng,max_lat and zoom required'}, 400
+    if not (MIN_LAT <= min_lat <= max_lat <= MAX_LAT and MIN_LNG <= min_lng <= max_lng <= MAX_LNG):
+        return {'error': 'invalid bbox'}, 400
+    db = get_db()
+    level, rows = clusters.query(db, min_lat, min_lng, max_lat, max_lng, zoom)
+    top_ids = list({r['top_shop_id'] for r in rows if r['top_shop_id']})
+    names = {}
+    for i in range(0, len(top_ids), 500):
+        chunk = top_ids[i:i + 500]
+        for r in db.execute(f"SELECT id, name FROM shops WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall():
+            names[r['id']] = r['name']
+    items = []
+    for r in rows:
+        item = {'count': r['count'], 'lat': round(r['sum_lat'] / r['count'], 6), 'lng': round(r['sum_lng'] / r['count'], 6)}
+        if r['top_shop_id'] in names:
+            item['top'] = {'id': r['top_shop_id'], 'name': names[r['top_shop_id']], 'url': url_for('shop_detail', shop_id=r['top_shop_id'])}
+        items.append(item)
+    return {'zoom': zoom, 'level': level, 'clusters': items}, 200, {'Cache-Control': 'public, max-age=30'}
+
+
+@app.route('/shop/<int:shop_id>')
+def shop_detail(shop_id):
+    db = get_db()
+    shop = db.execute('SELECT * FROM shops WHERE id = ?', (shop_id,)).fetchone()
+    if not shop:
+        flash('お店が見つかりません')
+        return redirect(url_for('search'))
+    try:
+        page = int(request.args.get('page', '1'))
+    except ValueError:
+        page = 1
+    page = max(1, page)
+    page_size = 6
+    offset = (page - 1) * page_size
+    posts = records.SHOP_POST.execute(
+        db, 'SELECT ' + records.SHOP_POST.select + ' FROM all_posts AS posts JOIN users ON posts.user_id = users.id WHERE posts.shop_id = ? ORDER BY posts.id DESC LIMIT ? OFFSET ?',
+        (shop_id, page_size, offset)
+    ).fetchall()
+    total_pages = max(1, (shop['post_count'] + page_size - 1) // page_size)
+    user = current_user()
+    bookmarked_ids = set()
+    following = False
+    if user:
+        rows = db.execute('SELECT post_id FROM bookmarks WHERE user_id = ?', (user['id'],)).fetchall()
+        bookmarked_ids = {r['post_id'] for r in rows}
+        following = db.execute('SELECT 1 FROM shop_follows WHERE user_id = ? AND shop_key = ?', (user['id'], shop_key(shop['name']))).fetchone() is not None
+    return render_template('shop.html', shop=shop, posts=posts, user=user, page=page, total_pages=total_pages, bookmarked_ids=bookmarked_ids, following=following)
+
+
+@app.route('/events')
+def event_stream():
+    # the SSE stream is served by the events hub (own port, asyncio); a proxy routes
+    # /events there. Reaching this view means it did not: pipe the hub's stream
+    # through, same origin, at the cost of a thread (events.open_stream)
+    stream = events.open_stream() if events.enabled() else None
+    if stream is None:
+        return '', 204  # EventSource does not retry a 204: no live updates on this page
+    return app.response_class(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/notifications')
 def notifications():
     user = current_user()
-    return render_template('notifications.html', user=user)
+    if not user:
+        return render_template('notifications.html', user=user, items=[], next_before=None)
+    db = get_db()
+    try:
+        before = int(request.args.get('before', '0'))
+    except ValueError:
+        before = 0
+    # the archive's copy of the post only when it is attached (archive.has_rows)
+    ap = 'archive.posts' if archive.attached(db) else 'main.posts'
+    if before > 0:
+        items = db.execute(
+            f'SELECT n.*, COALESCE(p.content, ap.content) AS content, COALESCE(p.shop_name, ap.shop_name) AS shop_name, a.username AS actor_name FROM notifications n LEFT JOIN posts p ON n.post_id = p.id LEFT JOIN {ap} ap ON n.post_id = ap.id LEFT JOIN users a ON n.actor_id = a.id WHERE n.user_id = ? AND n.id < ? ORDER BY n.id DESC LIMIT ?',
+            (user['id'], before, NOTIFICATION_PAGE_SIZE + 1)).fetchall()
+    else:
+        items = db.execute(
+            f'SELECT n.*, COALESCE(p.content, ap.content) AS content, COALESCE(p.shop_name, ap.shop_name) AS shop_name, a.username AS actor_name FROM notifications n LEFT JOIN posts p ON n.post_id = p.id LEFT JOIN {ap} ap ON n.post_id = ap.id LEFT JOIN users a ON n.actor_id = a.id WHERE n.user_id = ? ORDER BY n.id DESC LIMIT ?',
+            (user['id'], NOTIFICATION_PAGE_SIZE + 1)).fetchall()
+    next_before = None
+    if len(items) > NOTIFICATION_PAGE_SIZE:
+        items = items[:NOTIFICATION_PAGE_SIZE]
+        next_before = items[-1]['id']
+    if items and not before and user['unread_notifications']:
+        # mark what was shown as read; the fan-out worker may add more concurrently
+        cur = db.execute('UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0 AND id <= ?', (user['id'], items[0]['id']))
+        db.execute('UPDATE users SET unread_notifications = MAX(0, COALESCE(unread_notifications, 0) - ?) WHERE id = ?', (cur.rowcount, user['id']))
+        db.commit()
+    return render_template('notifications.html', user=user, items=items, next_before=next_before)
+
+
+@app.route('/follow/shop', methods=['POST'])
+def follow_shop():
+    user = current_user()
+    if not user:
+        flash('ログインしてください')
+        return redirect(url_for('login'))
+    name = request.form.get('shop_name', '').strip()
+    key = shop_key(name)
+    if not key or len(name) > TEXT_MAX_LEN:
+        flash('店名が不正です')
+        return redirect(request.referrer or url_for('index'))
+    db = get_db()
+    cur = db.execute('DELETE FROM shop_follows WHERE user_id = ? AND shop_key = ?', (user['id'], key))
+    if cur.rowcount:
+        flash(f'{name} のフォローを解除しました')
+    else:
+        db.execute('INSERT INTO shop_follows (user_id, shop_key, shop_name, created_at) VALUES (?, ?, ?, ?)', (user['id'], key, name, datetime.utcnow().isoformat()))
+        flash(f'{name} をフォローしました。新しい投稿を通知します')
+    db.commit()
+    return redirect(request.referrer or url_for('index'))
 
 
 @app.route('/bookmarks')
@@ -1017,25 +2067,42 @@ def bookmarks():
         return redirect(url_for('login'))
     db = get_db()
     sort = request.args.get('sort', 'position')
+    folder = request.args.get('folder', '').strip()
     premium = bool(user['is_premium'])
-    # Non-premium: restrict sort to created_at desc
+    # Non-premium: restrict sort to created_at desc, no folder views
     if not premium:
         sort = 'created_desc'
-    if sort == 'created_asc':
-        order_clause = 'b.created_at ASC'
-    elif sort == 'created_desc':
-        order_clause = 'b.created_at DESC'
-    elif sort == 'likes_desc':
-        order_clause = 'p.likes DESC'
-    elif sort == 'category':
-        order_clause = 'p.category ASC, b.created_at DESC'
-    else:
-        order_clause = 'b.position ASC, b.created_at DESC'
-    rows = db.execute(
-        f"SELECT p.*, u.username, u.avatar, b.folder, b.position FROM bookmarks b JOIN posts p ON b.post_id = p.id JOIN users u ON p.user_id = u.id WHERE b.user_id = ? ORDER BY {order_clause}",
-        (user['id'],)
+        folder = ''
+    if sort not in BOOKMARK_SORTS:
+        sort = 'position'
+    order = BOOKMARK_SORTS[sort]
+    where = ['b.user_id = ?']
+    params = [user['id']]
+    if folder == BOOKMARK_UNFILED:
+        where.append('b.folder IS NULL')
+    elif folder:
+        where.append('b.folder = ?')
+        params.append(folder)
+    cursor = request.args.get('cursor', '')
+    values = decode_cursor(cursor, len(order)) if cursor else None
+    if values:
+        clause, extra = keyset_clause(order, values)
+        where.append(clause)
+        params.extend(extra)
+    order_clause = ', '.join(f'{BOOKMARK_COLUMNS[c]} {d}' for c, d in order)
+    rows = records.BOOKMARK_ROW.execute(
+        db, f"SELECT {records.BOOKMARK_ROW.select} FROM bookmarks b JOIN all_posts p ON b.post_id = p.id JOIN users u ON p.user_id = u.id WHERE {' AND '.join(where)} ORDER BY {order_clause} LIMIT ?",
+        params + [BOOKMARK_PAGE_SIZE + 1]
     ).fetchall()
-    return render_template('bookmarks.html', user=user, bookmarks=rows, premium=premium, sort=sort)
+    next_cursor = None
+    if len(rows) > BOOKMARK_PAGE_SIZE:
+        rows = rows[:BOOKMARK_PAGE_SIZE]
+        next_cursor = encode_cursor([rows[-1][c] for c, _ in order])
+    folders = []
+    if premium:
+        folders = db.execute('SELECT folder, count FROM bookmark_folders WHERE user_id = ? ORDER BY folder', (user['id'],)).fetchall()
+    return render_template('bookmarks.html', user=user, bookmarks=rows, premium=premium, sort=sort, folder=folder, folders=folders,
+                           next_cursor=next_cursor, unfiled=BOOKMARK_UNFILED)
 
 
 @app.route('/bookmark/<int:post_id>', methods=['POST'])
@@ -1045,16 +2112,26 @@ def toggle_bookmark(post_id):
         flash('ログインしてください')
         return redirect(url_for('index'))
     db = get_db()
-    exists = db.execute('SELECT 1 FROM bookmarks WHERE user_id = ? AND post_id = ?', (user['id'], post_id)).fetchone()
+    exists = db.execute('SELECT folder FROM bookmarks WHERE user_id = ? AND post_id = ?', (user['id'], post_id)).fetchone()
     if exists:
         db.execute('DELETE FROM bookmarks WHERE user_id = ? AND post_id = ?', (user['id'], post_id))
+        bump_bookmark_folder(db, user['id'], exists['folder'], -1)
         db.commit()
         flash('ブックマークを外しました')
     else:
-        # position to end
-        maxpos = db.execute('SELECT COALESCE(MAX(position),0) AS m FROM bookmarks WHERE user_id = ?', (user['id'],)).fetchone()['m']
-        db.execute('INSERT INTO bookmarks (user_id, post_id, created_at, folder, position) VALUES (?, ?, ?, NULL, ?)', (user['id'], post_id, datetime.utcnow().isoformat(), maxpos + 1))
+        post = db.execute('SELECT likes, category FROM all_posts WHERE id = ?', (post_id,)).fetchone()
+        if not post:
+            flash('投稿が見つかりません')
+            return redirect(request.referrer or url_for('index'))
+        # append after the current last rank key (index lookup, no MAX scan)
+        last = db.execute('SELECT rank_key FROM bookmarks WHERE user_id = ? ORDER BY rank_key DESC LIMIT 1', (user['id'],)).fetchone()
+        key = ranks.key_after(last['rank_key'] if last else None)
+        db.execute('INSERT INTO bookmarks (user_id, post_id, created_at, folder, rank_key, post_likes, post_category) VALUES (?, ?, ?, NULL, ?, ?, ?)',
+                   (user['id'], post_id, datetime.utcnow().isoformat(), key, post['likes'] or 0, post['category'] or 'food_photo'))
+        bump_bookmark_folder(db, user['id'], None, 1)
         db.commit()
+        notify.enqueue('bookmark', post_id, actor_id=user['id'])
+        schedule_rank_rebalance(user['id'], key)
         flash('ブックマークに追加しました')
     return redirect(request.referrer or url_for('index'))
 
@@ -1070,21 +2147,86 @@ def move_bookmark(post_id):
         return redirect(url_for('bookmarks'))
     dirn = request.args.get('dir', 'up')
     db = get_db()
-    curpos_row = db.execute('SELECT position FROM bookmarks WHERE user_id = ? AND post_id = ?', (user['id'], post_id)).fetchone()
-    if not curpos_row:
+    cur = db.execute('SELECT rank_key FROM bookmarks WHERE user_id = ? AND post_id = ?', (user['id'], post_id)).fetchone()
+    if not cur:
         return redirect(url_for('bookmarks'))
-    curpos = curpos_row['position']
+    # the two rows past the current one in the move direction; the new key goes between them
     if dirn == 'up':
-        neighbor = db.execute('SELECT post_id, position FROM bookmarks WHERE user_id = ? AND position < ? ORDER BY position DESC LIMIT 1', (user['id'], curpos)).fetchone()
+        rows = db.execute('SELECT rank_key FROM bookmarks WHERE user_id = ? AND rank_key < ? ORDER BY rank_key DESC LIMIT 2', (user['id'], cur['rank_key'])).fetchall()
     else:
-        neighbor = db.execute('SELECT post_id, position FROM bookmarks WHERE user_id = ? AND position > ? ORDER BY position ASC LIMIT 1', (user['id'], curpos)).fetchone()
-    if neighbor:
-        db.execute('UPDATE bookmarks SET position = ? WHERE user_id = ? AND post_id = ?', (neighbor['position'], user['id'], post_id))
-        db.execute('UPDATE bookmarks SET position = ? WHERE user_id = ? AND post_id = ?', (curpos, user['id'], neighbor['post_id']))
+        rows = db.execute('SELECT rank_key FROM bookmarks WHERE user_id = ? AND rank_key > ? ORDER BY rank_key ASC LIMIT 2', (user['id'], cur['rank_key'])).fetchall()
+    if rows:
+        near_key = rows[0]['rank_key']
+        far_key = rows[1]['rank_key'] if len(rows) > 1 else None
+        key = ranks.key_between(far_key, near_key) if dirn == 'up' else ranks.key_between(near_key, far_key)
+        db.execute('UPDATE bookmarks SET rank_key = ? WHERE user_id = ? AND post_id = ?', (key, user['id'], post_id))
         db.commit()
+        schedule_rank_rebalance(user['id'], key)
     return redirect(url_for('bookmarks'))
 
 
+@app.route('/bookmarks/reorder', methods=['POST'])
+def reorder_bookmarks():
+    # JSON API (premium). Either a full ordering: {"order": [post_id, ...]}
+    # or a drag-and-drop move: {"post_id": x, "after": post_id|null, "before": post_id|null}
+    user = current_user()
+    if not user:
+        return {'error': 'login_required'}, 401
+    if not user['is_premium']:
+        return {'error': 'premium_only'}, 403
+    data = request.get_json(silent=True) or {}
+    db = get_db()
+    uid = user['id']
+    if 'order' in data:
+        try:
+            order = [int(x) for x in data.get('order') or []]
+        except (TypeError, ValueError):
+            return {'error': 'bad_order'}, 400
+        existing = {r['post_id'] for r in db.execute('SELECT post_id FROM bookmarks WHERE user_id = ?', (uid,)).fetchall()}
+        if len(set(order)) != len(order) or set(order) != existing:
+            return {'error': 'order_mismatch'}, 400
+        keys = ranks.spread_keys(len(order))
+        with db:
+            db.executemany('UPDATE bookmarks SET rank_key = ? WHERE user_id = ? AND post_id = ?', [(k, uid, pid) for k, pid in zip(keys, order)])
+        return {'ok': True, 'count': len(order)}
+    try:
+        post_id = int(data.get('post_id'))
+        after_id = int(data['after']) if data.get('after') is not None else None
+        before_id = int(data['before']) if data.get('before') is not None else None
+    except (TypeError, ValueError):
+        return {'error': 'bad_move'}, 400
+    if post_id in (after_id, before_id):
+        return {'error': 'bad_move'}, 400
+    if after_id is None and before_id is None and db.execute('SELECT 1 FROM bookmarks WHERE user_id = ? AND post_id != ? LIMIT 1', (uid, post_id)).fetchone():
+        # no neighbour given: only a move within an otherwise empty list means anything
+        return {'error': 'bad_move'}, 400
+
+    def key_of(pid):
+        if pid is None:
+            return None
+        row = db.execute('SELECT rank_key FROM bookmarks WHERE user_id = ? AND post_id = ?', (uid, pid)).fetchone()
+        return row['rank_key'] if row else False
+
+    after_key, before_key = key_of(after_id), key_of(before_id)
+    if key_of(post_id) in (None, False) or after_key is False or before_key is False:
+        return {'error': 'not_found'}, 404
+    if after_key is not None and before_key is None:
+        # dropped at the end of a visible page: use the real successor of `after`
+        nxt = db.execute('SELECT rank_key FROM bookmarks WHERE user_id = ? AND rank_key > ? AND post_id != ? ORDER BY rank_key LIMIT 1', (uid, after_key, post_id)).fetchone()
+        before_key = nxt['rank_key'] if nxt else None
+    elif before_key is not None and after_key is None:
+        prv = db.execute('SELECT rank_key FROM bookmarks WHERE user_id = ? AND rank_key < ? AND post_id != ? ORDER BY rank_key DESC LIMIT 1', (uid, before_key, post_id)).fetchone()
+        after_key = prv['rank_key'] if prv else None
+    try:
+        key = ranks.key_between(after_key, before_key)
+    except ValueError:
+        return {'error': 'bad_move'}, 400
+    with db:
+        db.execute('UPDATE bookmarks SET rank_key = ? WHERE user_id = ? AND post_id = ?', (key, uid, post_id))
+    schedule_rank_rebalance(uid, key)
+    return {'ok': True, 'rank': key}
+
+
 @app.route('/bookmarks/folder/<int:post_id>', methods=['POST'])
 def set_bookmark_folder(post_id):
     user = current_user()
@@ -1095,9 +2237,15 @@ def set_bookmark_folder(post_id):
         flash('フォルダ編集はプレミアム限定です')
         return redirect(url_for('bookmarks'))
     folder = request.form.get('folder', '').strip() or None
+    if folder == BOOKMARK_UNFILED:
+        folder = None
     db = get_db()
-    db.execute('UPDATE bookmarks SET folder = ? WHERE user_id = ? AND post_id = ?', (folder, user['id'], post_id))
-    db.commit()
+    row = db.execute('SELECT folder FROM bookmarks WHERE user_id = ? AND post_id = ?', (user['id'], post_id)).fetchone()
+    if row and (row['folder'] or None) != folder:
+        db.execute('UPDATE bookmarks SET folder = ? WHERE user_id = ? AND post_id = ?', (folder, user['id'], post_id))
+        bump_bookmark_folder(db, user['id'], row['folder'], -1)
+        bump_bookmark_folder(db, user['id'], folder, 1)
+        db.commit()
     flash('フォルダを更新しました')
     return redirect(url_for('bookmarks'))
 
@@ -1108,7 +2256,7 @@ def update_icon():
     if not user:
         flash('ログインしてください')
         return redirect(url_for('index'))
-    file = request.files.get('avatar')
+    file = request.files.get('avatar') or claimed_upload(user, 'avatar')
     if not file or not file.filename:
         flash('アイコン画像を選択してください')
         return redirect(url_for('profile', username=user['username']))
@@ -1138,6 +2286,7 @@ def update_icon():
                 pass
             flash('画像を読み込めませんでした')
             return redirect(url_for('profile', username=user['username']))
+        upload_store.put_file(f'uploads/avatars/{basename}', save_path, 'image/jpeg')
     except Exception:
         flash('画像の保存に失敗しました')
         return redirect(url_for('profile', username=user['username']))
@@ -1146,9 +2295,7 @@ def update_icon():
     old = db.execute('SELECT avatar FROM users WHERE id = ?', (user['id'],)).fetchone()
     if old and old['avatar']:
         try:
-            op = os.path.join(AVATAR_DIR, old['avatar'])
-            if os.path.exists(op):
-                os.remove(op)
+            upload_store.delete(f"uploads/avatars/{old['avatar']}")
         except Exception:
             pass
     db.execute('UPDATE users SET avatar = ? WHERE id = ?', (basename, user['id']))
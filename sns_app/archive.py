@@ -0,0 +1,214 @@
+"""Cold-post archive: old posts live in a second database, attached as `archive`.
+
+Almost all reads want recent posts, so posts older than ARCHIVE_AFTER_DAYS are
+moved to archive.posts by a background mover. The mover works in small
+transactions of BATCH posts and pauses in between, so it never holds the
+write lock for long. The insert into the archive and the delete from the
+live table commit together: SQLite makes a transaction that spans attached
+databases atomic.
+
+Trending reads only the live table. The feed, profile and search read the
+archive only for rows past the end of the live data (`page`), which relies on
+every archived post being older than every live one; so a post never moves
+back: likes, edits and deletes write to the schema that holds it (`holder`).
+Likes, bookmarks, counters and notifications stay in the main DB; the temp
+view `all_posts` (live + archive) resolves bookmarks of archived posts and
+serves the shop pages and shop results, whose totals count archived posts too.
+
+Requests attach the archive only once it holds posts (`has_rows`); until then
+the persistent view main.all_posts (live posts only) stands in for the temp
+view, and holder/page/count skip the archive. When the archive file cannot be
+attached, attach_empty() attaches an empty in-memory archive instead, so the
+same queries run on the live posts only.
+
+Environment:
+  SNS_ARCHIVE_DB          archive database file (default: sns_archive.db next to sns.db)
+  SNS_ARCHIVE_AFTER_DAYS  age at which posts are archived, 0 disables the mover (default 180)
+  SNS_ARCHIVE_BATCH       posts per mover transaction (default 200)
+"""
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+
+def _num_env(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+AFTER_DAYS = _num_env('SNS_ARCHIVE_AFTER_DAYS', 180)
+BATCH = _num_env('SNS_ARCHIVE_BATCH', 200)
+PAUSE = 0.05
+INTERVAL = 6 * 3600
+
+_columns = None  # per process: columns shared by main.posts and archive.posts
+_seen = {}       # archive path -> True once it had rows, else its (mtime, size) when it had none
+
+
+def has_rows(path):
+    """Whether the archive file holds any posts. The mover only adds rows, so
+    a file found with rows is not checked again; an empty one is re-read only
+    after it changes on disk."""
+    seen = _seen.get(path)
+    if seen is True:
+        return True
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    state = (st.st_mtime_ns, st.st_size)
+    if seen == state:
+        return False
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            found = conn.execute('SELECT 1 FROM posts LIMIT 1').fetchone() is not None
+        finally:
+            conn.close()
+    except sqlite3.OperationalError as e:
+        found = 'no such table' not in str(e)  # locked or busy: attach and let it wait
+    except sqlite3.DatabaseError:
+        found = True  # unreadable: attach() fails and the caller reports it
+    _seen[path] = True if found else state
+    return found
+
+
+def attached(db):
+    return db.execute("SELECT 1 FROM pragma_database_list WHERE name = 'archive'").fetchone() is not None
+
+
+def attach(conn, path):
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    attach_view(conn)
+
+
+def attach_empty(conn):
+    """Attach an empty in-memory archive in place of one that failed to attach."""
+    try:
+        conn.execute('DETACH DATABASE archive')
+    except Exception:
+        pass  # the ATTACH itself failed
+    conn.execute("ATTACH DATABASE ':memory:' AS archive")
+    create_tables(conn)
+    attach_view(conn)
+
+
+def attach_view(conn):
+    cols = columns(conn)
+    if cols:
+        names = ', '.join(cols)
+        conn.execute(f'CREATE TEMP VIEW IF NOT EXISTS all_posts AS SELECT {names} FROM main.posts UNION ALL SELECT {names} FROM archive.posts')
+
+
+def columns(conn):
+    """Column names of archive.posts also present in main.posts ([] before
+    create_tables). Read once per process; create_tables resets it."""
+    global _columns
+    if _columns is None:
+        archived = {r[1] for r in conn.execute('PRAGMA archive.table_info(posts)')}
+        names = [r[1] for r in conn.execute('PRAGMA main.table_info(posts)') if r[1] in archived]
+        if not names:
+            return names
+        _columns = names
+    return _columns
+
+
+def create_tables(conn):
+    """Create archive.posts from the live schema and add columns added since,
+    and main.all_posts for connections without the archive."""
+    global _columns
+    info = conn.execute('PRAGMA main.table_info(posts)').fetchall()
+    defs = []
+    for _, name, type_, notnull, default, pk in info:
+        d = f'{name} {type_}'
+        if pk:
+            d += ' PRIMARY KEY'
+        if notnull:
+            d += ' NOT NULL'
+        if default is not None:
+            d += f' DEFAULT {default}'
+        defs.append(d)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS archive.posts ({', '.join(defs)})")
+    have = {r[1] for r in conn.execute('PRAGMA archive.table_info(posts)')}
+    for _, name, type_, notnull, default, pk in info:
+        if name not in have:
+            conn.execute(f"ALTER TABLE archive.posts ADD COLUMN {name} {type_}{f' DEFAULT {default}' if default is not None else ''}")
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_posts_created ON posts(created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_posts_user ON posts(user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_posts_category ON posts(category, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_posts_shop ON posts(shop_id, id)')
+    # newest-first listings and the mover's cutoff scan on the live table
+    conn.execute('CREATE INDEX IF NOT EXISTS main.idx_posts_created ON posts(created_at)')
+    # SELECT * is expanded when the view is read, so it follows new columns
+    conn.execute('CREATE VIEW IF NOT EXISTS main.all_posts AS SELECT * FROM posts')
+    _columns = None
+
+
+def cutoff(days=None):
+    days = AFTER_DAYS if days is None else days
+    return (datetime.utcnow() - timedelta(days=days)).isoformat()
+
+
+def move(conn, before, batch=None, pause=None):
+    """Move posts created before `before` (ISO time) to the archive, oldest
+    first, one transaction per batch. Returns the number of posts moved."""
+    batch = batch or BATCH
+    pause = PAUSE if pause is None else pause
+    names = ', '.join(columns(conn))
+    moved = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [r[0] for r in conn.execute('SELECT id FROM main.posts WHERE created_at < ? ORDER BY created_at LIMIT ?', (before, batch)).fetchall()]
+            if ids:
+                marks = ','.join('?' * len(ids))
+                conn.execute(f'INSERT OR REPLACE INTO archive.posts ({names}) SELECT {names} FROM main.posts WHERE id IN ({marks})', ids)
+                conn.execute(f'DELETE FROM main.posts WHERE id IN ({marks})', ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        moved += len(ids)
+        if len(ids) < batch:
+            return moved
+        time.sleep(pause)
+
+
+def holder(db, post_id):
+    """The posts table that holds a post: 'main.posts', 'archive.posts' or None."""
+    for table in ('main.posts', 'archive.posts') if attached(db) else ('main.posts',):
+        if db.execute(f'SELECT 1 FROM {table} WHERE id = ?', (post_id,)).fetchone():
+            return table
+    return None
+
+
+def page(db, sql, count_sql, params, limit, offset, row_factory=None):
+    """One page of a newest-first listing. `sql` selects from `{posts}` and ends
+    with LIMIT ? OFFSET ?; count_sql counts the same rows. The live table is
+    read first, the archive only for the part of the page past the last live
+    row (the live count is only needed when the whole page is past it).
+    row_factory, if given, is used for the page's rows (records.py)."""
+    def rows_of(posts, *args):
+        cur = db.cursor()
+        if row_factory:
+            cur.row_factory = row_factory
+        return cur.execute(sql.format(posts=posts), (*params, *args)).fetchall()
+
+    rows = rows_of('main.posts', limit, offset)
+    if len(rows) == limit or not attached(db):
+        return rows
+    if rows or not offset:
+        live_total = offset + len(rows)
+    else:
+        live_total = db.execute(count_sql.format(posts='main.posts'), params).fetchone()[0]
+    return rows + rows_of('archive.posts', limit - len(rows), max(0, offset - live_total))
+
+
+def count(db, sql, params):
+    """Matches of a `{posts}` COUNT query in the archive."""
+    if not attached(db):
+        return 0
+    return db.execute(sql.format(posts='archive.posts'), params).fetchone()[0]
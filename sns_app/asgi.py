@@ -0,0 +1,246 @@
+"""ASGI entry point: `uvicorn sns_app.asgi:application` (or `python -m sns_app serve --asgi`).
+
+Under waitress, a request whose view calls Nominatim (/geocode, address
+search) holds one of the server's threads for as long as the lookup takes,
+and a few slow lookups can use up the whole pool. Here, the Flask app runs
+on a dedicated pool of THREADS threads, and that is the only place where
+views and their DB reads run. A view that needs a lookup does not wait for
+it: lookup_address() in app.py raises LookupPending and the thread is free
+again. This adapter then awaits the lookup on the event loop (geo.py) and
+replays the request with the result in the environ. Any number of lookups
+can be in flight while the pool keeps serving other requests.
+
+The WSGI entry point (wsgi.py, `python -m sns_app serve`) is unchanged and
+still does its lookups inline.
+
+Everything else is plain WSGI-over-ASGI: the request body is spooled, the
+app runs on the pool, and its response is passed to the event loop chunk by
+chunk through a small queue, so streamed pages (streaming.py) and the event
+stream still stream. Live
+events are per process here: with several ASGI workers a client only sees
+events raised in its own worker (`serve` relays them to its hub process).
+
+Environment:
+  SNS_THREADS  threads of the pool that runs the Flask app (default 8)
+"""
+import os
+import sys
+import asyncio
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .app import app
+from . import geo
+
+try:
+    THREADS = max(1, int(os.environ.get('SNS_THREADS', '8')))
+except ValueError:
+    THREADS = 8
+MAX_LOOKUPS = 3      # lookups (and replays) per request
+QUEUE_CHUNKS = 8     # response chunks buffered between the pool and the event loop
+SPOOL_BYTES = 1024 * 1024
+
+pool = ThreadPoolExecutor(THREADS, thread_name_prefix='sns-app')
+_END = object()
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1] if server[1] is not None else 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'sns.async_lookup': True,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').lower()
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def _read_body(receive):
+    body = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None
+        body.write(message.get('body', b''))
+        if not message.get('more_body'):
+            body.seek(0)
+            return body
+
+
+class _Gone(Exception):
+    pass
+
+
+def _close(result):
+    close = getattr(result, 'close', None)
+    if close:
+        close()
+
+
+def _produce(environ, loop, queue, gone):
+    # runs on the pool, start to finish on one thread as under waitress: the
+    # request context and DB connection of a streamed response stay on it
+    def put(*item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+        if gone.is_set():
+            raise _Gone()
+
+    started = {}
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = status
+        started['headers'] = headers
+        return written.append
+
+    result = None
+    try:
+        result = app(environ, start_response)
+        if environ.get('sns.lookup') is None:
+            it = iter(result)
+            while True:
+                chunk = next(it, _END)
+                if 'status' in started:
+                    put('start', started.pop('status'), started['headers'])
+                for data in written:
+                    put('body', data)
+                written.clear()
+                if chunk is _END:
+                    break
+                if chunk:
+                    put('body', chunk)
+    except _Gone:
+        pass
+    finally:
+        try:
+            if result is not None:
+                _close(result)
+        finally:
+            asyncio.run_coroutine_threadsafe(queue.put(('end', environ.get('sns.lookup'))), loop).result()
+
+
+async def _run(loop, environ, send):
+    """Run the app on the pool and send its response. Returns the address
+    the view is waiting for instead (nothing is sent then), else None."""
+    queue = asyncio.Queue(QUEUE_CHUNKS)
+    gone = threading.Event()
+    task = loop.run_in_executor(pool, _produce, environ, loop, queue, gone)
+    item = None
+    try:
+        while True:
+            item = await queue.get()
+            if item[0] == 'start':
+                headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in item[2]]
+                await send({'type': 'http.response.start', 'status': int(item[1].split(' ', 1)[0]), 'headers': headers})
+            elif item[0] == 'body':
+                await send({'type': 'http.response.body', 'body': item[1], 'more_body': True})
+            else:
+                break
+    finally:
+        if item is None or item[0] != 'end':
+            # the client went away: stop the producer, it closes the response
+            gone.set()
+            while (await queue.get())[0] != 'end':
+                pass
+    await task
+    if item[1] is None:
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    return item[1]
+
+
+async def _http(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    body = await _read_body(receive)
+    if body is None:
+        return
+    try:
+        geocoded = {}
+        while True:
+            environ = _environ(scope, body)
+            if geocoded:
+                environ['sns.geocoded'] = geocoded
+            query = await _run(loop, environ, send)
+            if query is None:
+                return
+            if len(geocoded) >= MAX_LOOKUPS:
+                await send({'type': 'http.response.start', 'status': 503, 'headers': [(b'content-type', b'text/plain')]})
+                await send({'type': 'http.response.body', 'body': b'too many address lookups'})
+                return
+            # the view wants an address lookup: wait for it here, not on the pool
+            try:
+                geocoded[query] = await geo.lookup_async(query)
+            except Exception as e:
+                geocoded[query] = e
+            body.seek(0)
+    finally:
+        body.close()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                from .serve import warmup
+                await asyncio.get_running_loop().run_in_executor(pool, warmup)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await geo.close()
+            pool.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        await _http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    else:
+        # websockets are not served
+        raise RuntimeError(f"unsupported ASGI scope: {scope['type']}")
+
+
+def serve(host=None, port=None, workers=None, threads=None):
+    """Run `application` under uvicorn (an optional dependency)."""
+    try:
+        import uvicorn
+    except ImportError:
+        print('[serve] --asgi needs uvicorn (pip install uvicorn); aiohttp is recommended for lookups', file=sys.stderr)
+        return 2
+    if threads:
+        os.environ['SNS_THREADS'] = str(threads)
+    uvicorn.run('sns_app.asgi:application',
+                host=host or os.environ.get('SNS_HOST', '0.0.0.0'),
+                port=port or int(os.environ.get('SNS_PORT', '5000')),
+                workers=workers or 1,
+                lifespan='on')
+    return 0
@@ -0,0 +1,96 @@
+"""Password hashing off the request threads.
+
+KDF work (werkzeug generate/check_password_hash) runs in a small process pool
+so a burst of logins burns the pool's CPUs, not the web process's GIL. The
+number of requests allowed to wait for the pool is bounded as well: when all
+slots are taken `AuthBusy` is raised immediately instead of parking another
+waitress thread.
+
+Environment:
+  SNS_AUTH_WORKERS       KDF processes (default 2; 0 = run inline, for debugging)
+  SNS_AUTH_MAX_INFLIGHT  requests that may wait for a KDF result (default 4)
+  SNS_AUTH_WAIT          seconds to wait for a free slot (default 0.5)
+  SNS_PASSWORD_METHOD    werkzeug hash method for new hashes (default scrypt)
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as KdfTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+WORKERS = _env_int('SNS_AUTH_WORKERS', 2)
+MAX_INFLIGHT = _env_int('SNS_AUTH_MAX_INFLIGHT', 4)
+SLOT_WAIT = float(os.environ.get('SNS_AUTH_WAIT', '0.5') or 0.5)
+METHOD = os.environ.get('SNS_PASSWORD_METHOD', 'scrypt')
+KDF_TIMEOUT = 30
+
+
+class AuthBusy(Exception):
+    """All KDF slots are in use, or the pool did not answer; the caller should answer 503/429."""
+
+
+_pool = None
+_pool_pid = None
+_slots = threading.BoundedSemaphore(max(1, MAX_INFLIGHT))
+_lock = threading.Lock()
+_method_prefix = None
+
+
+def _executor():
+    global _pool, _pool_pid, _slots
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # (re)create after fork: pools and semaphores don't survive it
+            _pool = ProcessPoolExecutor(max_workers=WORKERS)
+            _pool_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(max(1, MAX_INFLIGHT))
+        return _pool
+
+
+def _run(fn, *args):
+    global _pool
+    if WORKERS <= 0:
+        return fn(*args)
+    pool = _executor()
+    if not _slots.acquire(timeout=SLOT_WAIT):
+        raise AuthBusy()
+    try:
+        future = pool.submit(fn, *args)
+        return future.result(timeout=KDF_TIMEOUT)
+    except KdfTimeout:
+        future.cancel()
+        raise AuthBusy()
+    except BrokenProcessPool:
+        # a KDF process died; the next call builds a new pool
+        with _lock:
+            if _pool is pool:
+                _pool = None
+        raise AuthBusy()
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, METHOD)
+
+
+def verify_password(pwhash, password):
+    return _run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    """True when pwhash was made with other method/parameters than METHOD."""
+    global _method_prefix
+    if _method_prefix is None:
+        # werkzeug expands defaults (e.g. scrypt -> scrypt:32768:8:1); learn them once
+        _method_prefix = _run(generate_password_hash, '', METHOD).split('$', 1)[0]
+    return (pwhash or '').split('$', 1)[0] != _method_prefix
@@ -0,0 +1,344 @@
+"""Online backups of sns.db with the SQLite backup API.
+
+The copy is made in steps of STEP_PAGES pages with a PAUSE after each step.
+A step holds a read lock on the live DB for a few milliseconds, and writers
+proceed during the pauses, so requests keep being served. If a write lands
+between steps SQLite restarts the copy. After MAX_RESTARTS restarts the
+remaining copy is done in a single step, which blocks writers only for the
+time one copy takes.
+
+Every backup `sns-<UTC time, to the microsecond>.db` gets a manifest `sns-<UTC time>.json` (and
+`sns-<UTC time>.archive`, a copy of the attached post archive). The
+manifest holds the DB checksum and a snapshot of the upload files that this
+copy of the DB references. The reference list comes from the copy itself, so
+it is consistent with the DB. Uploads are written once and never changed in
+place (except by recompress-images), so name + size is enough to find one.
+Only the newest KEEP backups are kept.
+
+Restore verifies the backup (integrity_check, checksum, referenced uploads)
+and backs up the live DB first. It then writes the backup into the live DB
+through the same backup API, so running processes see the restored data
+on their next query.
+
+Environment:
+  SNS_BACKUP_DIR             where backups go (default: backups/ next to the app)
+  SNS_BACKUP_STEP_PAGES      pages per step (default 256)
+  SNS_BACKUP_PAUSE_MS        pause between steps (default 20)
+  SNS_BACKUP_KEEP            backups kept by rotation (default 7)
+  SNS_BACKUP_INTERVAL_HOURS  background backup interval, 0 disables (default 24)
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from datetime import datetime
+
+
+def _num_env(name, default, kind=int):
+    try:
+        return kind(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+STEP_PAGES = _num_env('SNS_BACKUP_STEP_PAGES', 256)
+PAUSE = _num_env('SNS_BACKUP_PAUSE_MS', 20, float) / 1000
+KEEP = _num_env('SNS_BACKUP_KEEP', 7)
+INTERVAL = _num_env('SNS_BACKUP_INTERVAL_HOURS', 24, float) * 3600
+MAX_RESTARTS = 3
+PREFIX = 'sns-'
+
+
+class BackupError(Exception):
+    pass
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _copy(src, dst, pages, pause, stats):
+    last = [None]
+
+    def progress(status, remaining, total):
+        t = time.perf_counter()
+        step = t - stats.pop('_t', t)
+        stats['steps'] += 1
+        stats['step_time'] += step
+        stats['max_step'] = max(stats['max_step'], step)
+        stats['pages'] = total
+        if last[0] is not None and remaining >= last[0]:
+            stats['restarts'] += 1
+            if pages > 0 and stats['restarts'] > MAX_RESTARTS:
+                raise _Restarted()
+        last[0] = remaining
+        if remaining and pause:
+            time.sleep(pause)
+            stats['pause_time'] += pause
+        stats['_t'] = time.perf_counter()
+
+    stats['_t'] = time.perf_counter()
+    src.backup(dst, pages=pages, progress=progress)
+    stats.pop('_t', None)
+
+
+def snapshot(db_path, dest, pages=None, pause=None):
+    """Copy the live DB at db_path into dest (a new file). Returns timing stats."""
+    pages = STEP_PAGES if pages is None else pages
+    pause = PAUSE if pause is None else pause
+    stats = {'steps': 0, 'step_time': 0.0, 'pause_time': 0.0, 'max_step': 0.0, 'restarts': 0, 'pages': 0}
+    started = time.perf_counter()
+    src = sqlite3.connect(db_path)
+    try:
+        dst = sqlite3.connect(dest)
+        try:
+            try:
+                _copy(src, dst, pages, pause, stats)
+            except _Restarted:
+                # too busy for a paced copy: finish in one step
+                stats['one_step'] = True
+                _copy(src, dst, -1, 0, stats)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    stats['duration'] = time.perf_counter() - started
+    stats.pop('_t', None)
+    return stats
+
+
+def _uploads(conn, roots):
+    found = []
+    for label, directory, prefix, query in roots:
+        for (name,) in conn.execute(query):
+            path = os.path.join(directory, prefix + name)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+            found.append({'dir': label, 'name': prefix + name, 'size': size})
+    return found
+
+
+def backups(backup_dir):
+    """Backup DB paths, oldest first."""
+    try:
+        names = sorted(n for n in os.listdir(backup_dir) if n.startswith(PREFIX) and n.endswith('.db'))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(backup_dir, n) for n in names]
+
+
+def rotate(backup_dir, keep=None):
+    keep = KEEP if keep is None else keep
+    removed = []
+    for path in backups(backup_dir)[:-keep] if keep > 0 else []:
+        base = os.path.basename(path)[:-3]
+        for n in os.listdir(backup_dir):
+            if n.startswith(base + '.'):
+                try:
+                    os.remove(os.path.join(backup_dir, n))
+                except FileNotFoundError:
+                    pass
+        removed.append(path)
+    return removed
+
+
+def due(backup_dir, interval=None):
+    """True when the newest backup is older than interval (or there is none)."""
+    interval = INTERVAL if interval is None else interval
+    found = backups(backup_dir)
+    return not found or time.time() - os.path.getmtime(found[-1]) >= interval
+
+
+def backup_if_due(db_path, backup_dir, roots=(), interval=None, attached=None):
+    """backup() unless a recent one exists; a lock file keeps worker processes
+    from copying at the same time. Returns the manifest or None."""
+    if not due(backup_dir, interval):
+        return None
+    os.makedirs(backup_dir, exist_ok=True)
+    lock = os.path.join(backup_dir, '.lock')
+    try:
+        if time.time() - os.path.getmtime(lock) > 3600:
+            os.remove(lock)  # left behind by a killed process
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return None
+    try:
+        return backup(db_path, backup_dir, roots, attached=attached) if due(backup_dir, interval) else None
+    finally:
+        os.remove(lock)
+
+
+def _check(path):
+    """integrity_check result of a DB file ('ok' when sound)."""
+    try:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            return conn.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        return f'not a database: {e}'
+
+
+def backup(db_path, backup_dir, roots=(), keep=None, label='', attached=None):
+    """Make one backup + manifest, rotate old ones. Returns the manifest dict.
+
+    attached: {schema name: path} of databases the app ATTACHes (the post
+    archive); each is copied to `<backup>.<name>` right after the main DB and
+    attached to the copy while the upload manifest is read. The main DB is
+    copied first, so a post moved between the two copies shows up in both
+    rather than in neither."""
+    os.makedirs(backup_dir, exist_ok=True)
+    name, dest = _claim(backup_dir, f"{PREFIX}{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}{label}")
+    copies = {'': (db_path, dest)}
+    for schema, path in (attached or {}).items():
+        if os.path.exists(path):
+            copies[schema] = (path, os.path.join(backup_dir, f'{name}.{schema}'))
+    stats = {}
+    for schema, (src, dst) in copies.items():
+        if schema and os.path.exists(dst + '.partial'):
+            os.remove(dst + '.partial')
+        stats[schema] = snapshot(src, dst + '.partial')
+    conn = sqlite3.connect(dest + '.partial')
+    try:
+        for schema, (_, dst) in copies.items():
+            if schema:
+                conn.execute('ATTACH DATABASE ? AS ' + schema, (dst + '.partial',))
+        checks = {schema: conn.execute(f"PRAGMA {schema or 'main'}.integrity_check").fetchone()[0] for schema in copies}
+        uploads = _uploads(conn, roots)
+    finally:
+        conn.close()
+    bad = {k: v for k, v in checks.items() if v != 'ok'}
+    if bad:
+        for _, dst in copies.values():
+            os.remove(dst + '.partial')
+        raise BackupError(f'integrity check of the copy failed: {bad}')
+    for _, dst in copies.values():
+        os.replace(dst + '.partial', dst)
+    manifest = {
+        'created_at': datetime.utcnow().isoformat(),
+        'db': os.path.basename(dest),
+        'bytes': os.path.getsize(dest),
+        'sha256': _sha256(dest),
+        'stats': _rounded(stats.pop('')),
+        'attached': {schema: {'file': os.path.basename(dst), 'bytes': os.path.getsize(dst), 'sha256': _sha256(dst), 'stats': _rounded(stats[schema])}
+                     for schema, (_, dst) in copies.items() if schema},
+        'uploads': uploads,
+    }
+    with open(dest[:-3] + '.json.partial', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(dest[:-3] + '.json.partial', dest[:-3] + '.json')
+    manifest['removed'] = rotate(backup_dir, keep)
+    return manifest
+
+
+def _claim(backup_dir, name):
+    """(name, DB path) of a new backup; its .partial file is created with
+    O_EXCL, so two backups started at once (a manual one and the scheduled
+    one) never write the same files. A taken name gets a -2, -3... suffix."""
+    n = 1
+    while True:
+        candidate = name if n == 1 else f'{name}-{n}'
+        n += 1
+        dest = os.path.join(backup_dir, candidate + '.db')
+        if os.path.exists(dest):
+            continue
+        try:
+            os.close(os.open(dest + '.partial', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        return candidate, dest
+
+
+def _rounded(stats):
+    return {k: round(v, 4) if isinstance(v, float) else v for k, v in stats.items()}
+
+
+def _manifest(path):
+    try:
+        with open(path[:-3] + '.json', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def verify(path, upload_dirs=None):
+    """Problems found in a backup (empty list = restorable). upload_dirs maps
+    manifest dir labels to directories; without it uploads are not checked."""
+    problems = []
+    manifest = _manifest(path)
+    if manifest is None:
+        problems.append('manifest missing')
+    elif manifest.get('sha256') != _sha256(path):
+        problems.append('checksum does not match the manifest')
+    check = _check(path)
+    if check != 'ok':
+        problems.append(f'integrity check: {check}')
+    for schema, extra in (manifest or {}).get('attached', {}).items():
+        p = os.path.join(os.path.dirname(path), extra['file'])
+        if not os.path.exists(p):
+            problems.append(f'{schema} copy missing')
+            continue
+        if extra['sha256'] != _sha256(p):
+            problems.append(f'{schema} checksum does not match the manifest')
+        check = _check(p)
+        if check != 'ok':
+            problems.append(f'{schema} integrity check: {check}')
+    if manifest and upload_dirs:
+        for u in manifest.get('uploads', []):
+            directory = upload_dirs.get(u['dir'])
+            if directory is None or u['size'] is None:
+                continue
+            p = os.path.join(directory, u['name'])
+            if not os.path.exists(p):
+                problems.append(f"upload missing: {u['dir']}/{u['name']}")
+            elif os.path.getsize(p) != u['size']:
+                problems.append(f"upload changed: {u['dir']}/{u['name']}")
+    return problems
+
+
+def _write(src_path, dst_path):
+    src = sqlite3.connect(f'file:{src_path}?mode=ro', uri=True)
+    try:
+        dst = sqlite3.connect(dst_path)
+        try:
+            src.backup(dst, pages=-1)
+            return dst.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+
+def restore(path, db_path, backup_dir, attached=None):
+    """Write a backup into the live DB (and the attached DBs it has copies of)
+    after verifying it. The current state is backed up first (label
+    '-pre-restore'). Returns the safety backup's manifest."""
+    problems = verify(path)
+    if problems:
+        raise BackupError('; '.join(problems))
+    attached = attached or {}
+    safety = backup(db_path, backup_dir, label='-pre-restore', keep=0, attached=attached)
+    targets = [(path, db_path)]
+    for schema, extra in (_manifest(path) or {}).get('attached', {}).items():
+        if schema in attached:
+            targets.append((os.path.join(os.path.dirname(path), extra['file']), attached[schema]))
+    for src, dst in targets:
+        check = _write(src, dst)
+        if check != 'ok':
+            raise BackupError(f'restored {os.path.basename(dst)} failed quick_check: {check}')
+    return safety
@@ -0,0 +1,240 @@
+"""Resumable uploads in chunks (/api/uploads/chunked).
+
+A photo sent as one multipart body is lost with the connection that carried
+it, and the request holds a worker thread for the whole transfer. Here the
+client creates an upload session, then sends the file as numbered chunks of
+a fixed size, each one its own short request. A failed chunk is sent again;
+after a reload, the session's status says where to continue.
+
+A session is a directory of the staging area, per user:
+
+  <root>/<user id>/<upload id>/meta.json   kind, content type, size, chunk size
+                               data        the bytes received so far, appended in order
+                               chunks      one line per chunk: index, size, sha256
+
+Chunks are only appended, in index order. The chunk log is written after
+the bytes, so after a crash the data file can be longer than the log says,
+and the next append cuts it back first. Each chunk's sha256 is recorded (and
+checked against the one the client sends, if any): a chunk sent twice, e.g.
+when the response to the first try was lost, is recognized and accepted
+again without being appended. finalize() checks that the file is complete,
+re-reads it against the recorded checksums (and the client's sha256 of the
+whole file, if given), and hands over the assembled file; the app then
+stores it as an incoming upload, and the form claims it like a direct upload.
+
+Sessions nobody finished are deleted by expire() once they have been idle
+for SESSION_TTL. Appends to one session are serialized by a thread lock and,
+across worker processes, an flock on its chunk log (POSIX only). Staging is
+local disk: with several hosts, a session's requests must reach the same one.
+
+Environment:
+  SNS_UPLOAD_CHUNK_KB     chunk size the server asks for (default 512)
+  SNS_UPLOAD_SESSION_TTL  seconds an idle session is kept (default 21600)
+  SNS_UPLOAD_SESSIONS     open sessions per user (default 4)
+"""
+import os
+import json
+import time
+import zlib
+import shutil
+import hashlib
+import secrets
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def _int_env(name, default):
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+CHUNK_BYTES = _int_env('SNS_UPLOAD_CHUNK_KB', 512) * 1024
+MIN_CHUNK_BYTES = 64 * 1024
+MAX_CHUNK_BYTES = 4 * 1024 * 1024
+SESSION_TTL = _int_env('SNS_UPLOAD_SESSION_TTL', 6 * 3600)
+MAX_SESSIONS = _int_env('SNS_UPLOAD_SESSIONS', 4)
+LOCK_STRIPES = 64
+
+
+class ChunkError(Exception):
+    def __init__(self, message, status=400, **info):
+        super().__init__(message)
+        self.status = status
+        self.info = info
+
+
+class Staging:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _dir(self, user_id, upload_id):
+        if not upload_id.replace('-', '').replace('_', '').isalnum():
+            raise ChunkError('not_found', 404)
+        return os.path.join(self.root, str(int(user_id)), upload_id)
+
+    def _meta(self, d):
+        try:
+            with open(os.path.join(d, 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise ChunkError('not_found', 404)
+
+    def _log(self, d):
+        try:
+            with open(os.path.join(d, 'chunks')) as f:
+                return self._parse(f.read())
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _parse(text):
+        # [(size, sha256)] by chunk index
+        chunks = []
+        for line in text.splitlines():
+            parts = line.split()
+            # a torn last line (crash mid-write) does not count
+            if len(parts) == 3 and parts[0] == str(len(chunks)) and parts[1].isdigit() and len(parts[2]) == 64:
+                chunks.append((int(parts[1]), parts[2]))
+        return chunks
+
+    def _status(self, upload_id, d, meta, chunks):
+        received = sum(size for size, _ in chunks)
+        try:
+            touched = os.path.getmtime(os.path.join(d, 'chunks'))
+        except OSError:
+            touched = meta['created']
+        return {
+            'id': upload_id,
+            'size': meta['size'],
+            'chunk_size': meta['chunk_size'],
+            'received': received,
+            'next_index': len(chunks),
+            'complete': received == meta['size'],
+            'expires': int(touched + SESSION_TTL),
+        }
+
+    def create(self, user_id, kind, content_type, ext, size, chunk_size=None):
+        """Start a session for a file of `size` bytes; returns its status."""
+        chunk_size = min(MAX_CHUNK_BYTES, max(MIN_CHUNK_BYTES, int(chunk_size or CHUNK_BYTES)))
+        user_dir = os.path.join(self.root, str(int(user_id)))
+        try:
+            open_sessions = len(os.listdir(user_dir))
+        except FileNotFoundError:
+            open_sessions = 0
+        if open_sessions >= MAX_SESSIONS:
+            raise ChunkError('too_many_uploads', 429, max_sessions=MAX_SESSIONS)
+        upload_id = secrets.token_urlsafe(12)
+        d = os.path.join(user_dir, upload_id)
+        os.makedirs(d)
+        meta = {'kind': kind, 'content_type': content_type, 'ext': ext, 'size': size,
+                'chunk_size': chunk_size, 'created': time.time()}
+        with open(os.path.join(d, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        open(os.path.join(d, 'data'), 'wb').close()
+        return self._status(upload_id, d, meta, [])
+
+    def status(self, user_id, upload_id):
+        d = self._dir(user_id, upload_id)
+        meta = self._meta(d)
+        return self._status(upload_id, d, meta, self._log(d))
+
+    def append(self, user_id, upload_id, index, data, checksum=None):
+        """Add chunk `index`; returns the session's status."""
+        d = self._dir(user_id, upload_id)
+        meta = self._meta(d)
+        digest = hashlib.sha256(data).hexdigest()
+        if checksum and checksum.lower() != digest:
+            raise ChunkError('checksum_mismatch', 400)
+        lock = self.locks[zlib.crc32(upload_id.encode()) % LOCK_STRIPES]
+        with lock, open(os.path.join(d, 'chunks'), 'a+') as log:
+            if fcntl:
+                fcntl.flock(log, fcntl.LOCK_EX)
+            log.seek(0)
+            text = log.read()
+            chunks = self._parse(text)
+            if index < len(chunks):
+                if chunks[index] != (len(data), digest):
+                    raise ChunkError('chunk_mismatch', 409, **self._status(upload_id, d, meta, chunks))
+                # a retry of a chunk we already have
+                return self._status(upload_id, d, meta, chunks)
+            if index > len(chunks):
+                raise ChunkError('out_of_order', 409, **self._status(upload_id, d, meta, chunks))
+            offset = sum(size for size, _ in chunks)
+            if offset >= meta['size']:
+                raise ChunkError('complete', 409, **self._status(upload_id, d, meta, chunks))
+            expected = min(meta['chunk_size'], meta['size'] - offset)
+            if len(data) != expected:
+                raise ChunkError('bad_chunk_size', 400, expected=expected)
+            with open(os.path.join(d, 'data'), 'r+b') as out:
+                out.truncate(offset)   # bytes of a chunk that never made it into the log
+                out.seek(offset)
+                out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+            if text and not text.endswith('\n'):
+                log.write('\n')   # close a torn line, so this one is read on its own
+            log.write(f'{index} {len(data)} {digest}\n')
+            log.flush()
+            chunks.append((len(data), digest))
+            return self._status(upload_id, d, meta, chunks)
+
+    def finalize(self, user_id, upload_id, checksum=None):
+        """Check the assembled file; returns (meta, path of the file). discard() it afterwards."""
+        d = self._dir(user_id, upload_id)
+        meta = self._meta(d)
+        chunks = self._log(d)
+        status = self._status(upload_id, d, meta, chunks)
+        if not status['complete']:
+            raise ChunkError('incomplete', 409, **status)
+        path = os.path.join(d, 'data')
+        whole = hashlib.sha256()
+        with open(path, 'r+b') as f:
+            f.truncate(meta['size'])   # see append()
+            for index, (size, digest) in enumerate(chunks):
+                block = f.read(size)
+                if hashlib.sha256(block).hexdigest() != digest:
+                    raise ChunkError('corrupt', 422, index=index)
+                whole.update(block)
+        if checksum and checksum.lower() != whole.hexdigest():
+            raise ChunkError('checksum_mismatch', 422)
+        return meta, path
+
+    def discard(self, user_id, upload_id):
+        shutil.rmtree(self._dir(user_id, upload_id), ignore_errors=True)
+
+    def expire(self, ttl=None):
+        """Delete sessions idle for longer than `ttl`; returns how many."""
+        ttl = SESSION_TTL if ttl is None else ttl
+        now = time.time()
+        removed = 0
+        try:
+            users = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        for user in users:
+            user_dir = os.path.join(self.root, user)
+            try:
+                sessions = os.listdir(user_dir)
+            except OSError:
+                continue
+            for upload_id in sessions:
+                d = os.path.join(user_dir, upload_id)
+                try:
+                    touched = max(os.path.getmtime(os.path.join(d, n)) for n in os.listdir(d))
+                except (OSError, ValueError):
+                    touched = 0  # empty or half-created
+                if now - touched > ttl:
+                    shutil.rmtree(d, ignore_errors=True)
+                    removed += 1
+            try:
+                os.rmdir(user_dir)
+            except OSError:
+                pass
+        return removed
@@ -0,0 +1,160 @@
+"""Per-zoom shop clusters for map views.
+
+Every shop with coordinates and at least one post is counted in one Web
+Mercator tile per level (MIN_LEVEL..MAX_LEVEL). `shop_tiles` keeps, per tile,
+the shop count, the coordinate sums (centroid = sum / count) and the most
+popular shop (score = posts + likes), so a map request reads one row per
+visible cluster instead of every shop.
+
+Rows are kept current by `update()`, which the shops module calls with a
+shop's state before and after each change. The top shop is replaced as soon
+as another shop in the tile scores higher; when the top shop leaves a tile
+its replacement is looked up again. Likes only change a shop's score, so they
+skip update(): `rescore()` applies the new score from a background job, once
+for a burst of likes.
+"""
+import math
+
+MIN_LEVEL = 2
+MAX_LEVEL = 18
+MAX_LAT = 85.05112878
+
+
+def create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS shop_tiles (
+        level INTEGER NOT NULL,
+        x INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        sum_lat REAL NOT NULL,
+        sum_lng REAL NOT NULL,
+        top_shop_id INTEGER,
+        top_score INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(level, x, y)
+    ) WITHOUT ROWID
+    ''')
+
+
+def tile(lat, lng, level):
+    n = 1 << level
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    x = int((lng + 180.0) / 360.0 * n)
+    r = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(r) + 1.0 / math.cos(r)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, level):
+    """(min_lat, max_lat, min_lng, max_lng) of a tile."""
+    n = 1 << level
+
+    def lat_of(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+    return lat_of(y + 1), lat_of(y), x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+
+
+def level_for_zoom(zoom):
+    # ~64px cells: four cluster cells per 256px map tile in each direction
+    return max(MIN_LEVEL, min(MAX_LEVEL, int(zoom) + 2))
+
+
+def state(db, shop_id):
+    """(lat, lng, score) of a shop if it belongs on the map, else None."""
+    row = db.execute('SELECT lat, lng, post_count, likes FROM shops WHERE id = ?', (shop_id,)).fetchone()
+    if row is None or row[0] is None or row[1] is None or (row[2] or 0) <= 0:
+        return None
+    return (row[0], row[1], (row[2] or 0) + (row[3] or 0))
+
+
+def _add(db, shop_id, lat, lng, score):
+    for level in range(MIN_LEVEL, MAX_LEVEL + 1):
+        x, y = tile(lat, lng, level)
+        db.execute('''INSERT INTO shop_tiles (level, x, y, count, sum_lat, sum_lng, top_shop_id, top_score) VALUES (?, ?, ?, 1, ?, ?, ?, ?)
+                      ON CONFLICT(level, x, y) DO UPDATE SET
+                        count = count + 1, sum_lat = sum_lat + excluded.sum_lat, sum_lng = sum_lng + excluded.sum_lng,
+                        top_shop_id = CASE WHEN excluded.top_score > top_score THEN excluded.top_shop_id ELSE top_shop_id END,
+                        top_score = MAX(top_score, excluded.top_score)''',
+                   (level, x, y, lat, lng, shop_id, score))
+
+
+def _remove(db, shop_id, lat, lng):
+    for level in range(MIN_LEVEL, MAX_LEVEL + 1):
+        x, y = tile(lat, lng, level)
+        db.execute('UPDATE shop_tiles SET count = count - 1, sum_lat = sum_lat - ?, sum_lng = sum_lng - ? WHERE level = ? AND x = ? AND y = ?',
+                   (lat, lng, level, x, y))
+        db.execute('DELETE FROM shop_tiles WHERE level = ? AND x = ? AND y = ? AND count <= 0', (level, x, y))
+        row = db.execute('SELECT top_shop_id FROM shop_tiles WHERE level = ? AND x = ? AND y = ?', (level, x, y)).fetchone()
+        if row is not None and row[0] == shop_id:
+            _refresh_top(db, level, x, y, exclude=shop_id)
+
+
+def _refresh_top(db, level, x, y, exclude=None):
+    min_lat, max_lat, min_lng, max_lng = tile_bounds(x, y, level)
+    row = db.execute('SELECT id, post_count + likes FROM shops WHERE lat >= ? AND lat <= ? AND lng >= ? AND lng < ? AND post_count > 0 AND id != ? ORDER BY post_count + likes DESC, id LIMIT 1',
+                     (min_lat, max_lat, min_lng, max_lng, exclude or 0)).fetchone()
+    db.execute('UPDATE shop_tiles SET top_shop_id = ?, top_score = ? WHERE level = ? AND x = ? AND y = ?',
+               (row[0] if row else None, row[1] if row else 0, level, x, y))
+
+
+def _rescore(db, shop_id, lat, lng, score):
+    for level in range(MIN_LEVEL, MAX_LEVEL + 1):
+        x, y = tile(lat, lng, level)
+        db.execute('''UPDATE shop_tiles SET
+                        top_shop_id = ?, top_score = ?
+                      WHERE level = ? AND x = ? AND y = ? AND (top_score < ? OR top_shop_id = ?)''',
+                   (shop_id, score, level, x, y, score, shop_id))
+
+
+def rescore(db, shop_id):
+    """Apply a shop's current score to its tiles (a change that kept it in place)."""
+    s = state(db, shop_id)
+    if s is not None:
+        _rescore(db, shop_id, *s)
+
+
+def update(db, shop_id, old, new):
+    """Apply a shop change; old/new are `state()` values (None = not on the map)."""
+    if old == new:
+        return
+    moved = old is None or new is None or old[:2] != new[:2]
+    if old is not None and moved:
+        _remove(db, shop_id, old[0], old[1])
+    if new is not None:
+        if moved:
+            _add(db, shop_id, new[0], new[1], new[2])
+        else:
+            # same place, different score; a lower score may leave this shop
+            # on top until the tile is refreshed, which is good enough here
+            _rescore(db, shop_id, new[0], new[1], new[2])
+
+
+def rebuild(conn):
+    """Recompute shop_tiles from the shops table."""
+    conn.execute('DELETE FROM shop_tiles')
+    tiles = {}
+    for shop_id, lat, lng, score in conn.execute('SELECT id, lat, lng, post_count + likes FROM shops WHERE lat IS NOT NULL AND lng IS NOT NULL AND post_count > 0').fetchall():
+        for level in range(MIN_LEVEL, MAX_LEVEL + 1):
+            key = (level,) + tile(lat, lng, level)
+            t = tiles.get(key)
+            if t is None:
+                tiles[key] = [1, lat, lng, shop_id, score]
+            else:
+                t[0] += 1
+                t[1] += lat
+                t[2] += lng
+                if score > t[4]:
+                    t[3], t[4] = shop_id, score
+    conn.executemany('INSERT INTO shop_tiles (level, x, y, count, sum_lat, sum_lng, top_shop_id, top_score) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     [k + tuple(v) for k, v in tiles.items()])
+    return len(tiles)
+
+
+def query(db, min_lat, min_lng, max_lat, max_lng, zoom, limit=2000):
+    """Clusters intersecting the bounding box at a map zoom level."""
+    level = level_for_zoom(zoom)
+    x0, y0 = tile(max_lat, min_lng, level)
+    x1, y1 = tile(min_lat, max_lng, level)
+    rows = db.execute('SELECT x, y, count, sum_lat, sum_lng, top_shop_id FROM shop_tiles WHERE level = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ? LIMIT ?',
+                      (level, min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1), limit)).fetchall()
+    return level, rows
@@ -0,0 +1,67 @@
+"""Maintained post counters (global, per user, per category).
+
+Writers call `bump()` inside the same transaction as the INSERT/UPDATE/DELETE
+on posts, so pages can read a count with one primary-key lookup instead of
+COUNT(*) over the table. `reconcile()` recomputes everything from posts and
+repairs drift (`python -m sns_app reconcile-counters`).
+
+Counter names:
+  posts               all posts
+  posts:user:<id>     posts by one user
+  posts:cat:<cat>     posts in one category (food_photo, shop_intro, ...)
+"""
+
+
+def create_table(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)')
+
+
+def post_keys(user_id, category):
+    return ['posts', f'posts:user:{user_id}', f'posts:cat:{category or "food_photo"}']
+
+
+def bump(db, names, delta):
+    db.executemany('INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                   [(n, delta) for n in names])
+
+
+def get(db, name, default=0):
+    row = db.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else default
+
+
+def actual_counts(conn):
+    # archived posts still count: read live + archive when the archive is attached
+    table = 'all_posts' if conn.execute("SELECT 1 FROM sqlite_temp_master WHERE type = 'view' AND name = 'all_posts'").fetchone() else 'posts'
+    counts = {'posts': conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]}
+    for uid, c in conn.execute(f'SELECT user_id, COUNT(*) FROM {table} GROUP BY user_id').fetchall():
+        counts[f'posts:user:{uid}'] = c
+    for cat, c in conn.execute(f"SELECT COALESCE(category, 'food_photo'), COUNT(*) FROM {table} GROUP BY COALESCE(category, 'food_photo')").fetchall():
+        counts[f'posts:cat:{cat}'] = c
+    return counts
+
+
+def reconcile(conn, fix=True):
+    """Compare stored counters with the posts table; returns [(name, stored, actual)] that differ.
+
+    Runs in one IMMEDIATE transaction so no post is written between the
+    recount and the repair.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        actual = actual_counts(conn)
+        stored = {name: value for name, value in conn.execute("SELECT name, value FROM counters WHERE name = 'posts' OR name LIKE 'posts:%'").fetchall()}
+        drift = []
+        for name in sorted(set(actual) | set(stored)):
+            a = actual.get(name, 0)
+            s = stored.get(name)
+            if s != a and not (s is None and a == 0):
+                drift.append((name, s, a))
+        if fix:
+            for name, _, a in drift:
+                conn.execute('INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value', (name, a))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return drift
@@ -0,0 +1,175 @@
+"""Resized image derivatives rendered on demand (`/img/<name>?w=&fmt=`).
+
+Widths come from an allowlist, so the cache cannot be filled with arbitrary
+sizes. A rendered derivative is written to a disk cache directory and
+served from there afterwards. The cache key contains the source's mtime, so
+a re-encoded source (recompress-images) gets fresh derivatives and the old
+ones age out.
+
+The cache has a byte budget for the directory, shared by all worker
+processes. Each process keeps an LRU index of the cache files, built by
+scanning the directory, oldest first. A hit moves the key to the end of the
+index and touches the file, so the next scan keeps the order. Other workers
+add and delete files too, so an index that would go over the budget, or is
+older than RESCAN seconds, is rebuilt from the directory before the oldest
+files are deleted: the directory exceeds the budget by at most what the
+workers render in RESCAN seconds. A file can still disappear between get()
+and the read; the caller then asks again and it is rendered anew. Concurrent misses for one key render once: a per-key thread lock
+inside a process, and an flock on one of LOCK_STRIPES lock files across
+worker processes (POSIX only; elsewhere the thread lock alone).
+
+Environment:
+  SNS_IMG_CACHE_MB  byte budget of the derivative cache (default 256)
+"""
+import os
+import time
+import zlib
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+WIDTHS = (160, 320, 400, 640, 960, 1280)
+FORMATS = {'jpg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp'), 'png': ('PNG', 'image/png')}
+QUALITY = 80
+LOCK_STRIPES = 64
+RESCAN = 30
+try:
+    BUDGET = int(float(os.environ.get('SNS_IMG_CACHE_MB', '256')) * 1024 * 1024)
+except ValueError:
+    BUDGET = 256 * 1024 * 1024
+
+
+class DerivativeCache:
+    def __init__(self, cache_dir, budget=None):
+        self.dir = cache_dir
+        self.budget = BUDGET if budget is None else budget
+        self.index = None   # OrderedDict {file name: size}, least recently used first
+        self.total = 0
+        self.scanned = 0
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def _load(self):
+        os.makedirs(os.path.join(self.dir, '.locks'), exist_ok=True)
+        entries = []
+        for e in os.scandir(self.dir):
+            if e.is_file() and not e.name.endswith('.tmp'):
+                st = e.stat()
+                entries.append((st.st_mtime, e.name, st.st_size))
+        entries.sort()
+        self.index = OrderedDict((name, size) for _, name, size in entries)
+        self.total = sum(self.index.values())
+        self.scanned = time.time()
+
+    def _hit(self, key):
+        with self.lock:
+            if self.index is None:
+                self._load()
+            if key not in self.index:
+                return None
+            path = os.path.join(self.dir, key)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # evicted by another worker process
+                self.total -= self.index.pop(key)
+                return None
+            self.index.move_to_end(key)
+            return path
+
+    def _add(self, key, size):
+        with self.lock:
+            if self.total + size > self.budget or time.time() - self.scanned > RESCAN:
+                # see what the other workers added and evicted since
+                self._load()
+            if key in self.index:
+                self.total -= self.index.pop(key)
+            self.index[key] = size
+            self.total += size
+            while self.total > self.budget and len(self.index) > 1:
+                old, old_size = self.index.popitem(last=False)
+                self.total -= old_size
+                try:
+                    os.remove(os.path.join(self.dir, old))
+                except OSError:
+                    pass  # gone already, or open on Windows
+
+    def _key_lock(self, key):
+        with self.lock:
+            lock = self.key_locks.get(key)
+            if lock is None:
+                lock = self.key_locks[key] = [threading.Lock(), 0]
+            lock[1] += 1
+        return lock
+
+    def _release(self, key, lock):
+        with self.lock:
+            lock[1] -= 1
+            if not lock[1]:
+                self.key_locks.pop(key, None)
+
+    def get(self, source, kind, width, fmt):
+        """Path of the derivative of `source` at `width` in `fmt`, rendering it on a miss."""
+        mtime = int(os.path.getmtime(source))
+        key = f'{kind}-{os.path.basename(source)}-{mtime}-w{width}.{fmt}'
+        path = self._hit(key)
+        if path:
+            return path
+        lock = self._key_lock(key)
+        try:
+            with lock[0]:
+                stripe = None
+                if fcntl:
+                    stripe = open(os.path.join(self.dir, '.locks', f'{zlib.crc32(key.encode()) % LOCK_STRIPES}.lock'), 'w')
+                    fcntl.flock(stripe, fcntl.LOCK_EX)
+                try:
+                    path = os.path.join(self.dir, key)
+                    if not os.path.exists(path):
+                        # nobody (no thread, no other worker) rendered it while we waited
+                        render(source, path + '.tmp', width, fmt)
+                        os.replace(path + '.tmp', path)
+                    self._add(key, os.path.getsize(path))
+                finally:
+                    if stripe:
+                        stripe.close()
+        finally:
+            self._release(key, lock)
+        return path
+
+
+def render(source, dest, width, fmt):
+    with Image.open(source) as src:
+        img = ImageOps.exif_transpose(src)
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+        if fmt == 'jpg':
+            if alpha:
+                bg = Image.new('RGB', img.size, (255, 255, 255))
+                bg.paste(img.convert('RGBA'), mask=img.convert('RGBA').split()[3])
+                img = bg
+            img.convert('RGB').save(dest, format='JPEG', quality=QUALITY, optimize=True, progressive=True)
+        elif fmt == 'webp':
+            img.convert('RGBA' if alpha else 'RGB').save(dest, format='WEBP', quality=QUALITY, method=4)
+        else:
+            img.save(dest, format='PNG', optimize=True)
+
+
+def pick_width(w):
+    """Smallest allowed width >= w (the largest one for anything bigger); None if w is invalid."""
+    try:
+        w = int(w)
+    except (TypeError, ValueError):
+        return None
+    if w <= 0:
+        return None
+    for allowed in WIDTHS:
+        if allowed >= w:
+            return allowed
+    return WIDTHS[-1]
@@ -0,0 +1,334 @@
+"""Live event stream (Server-Sent Events) for the feed.
+
+Request handlers call `publish()` after committing (new post, like, delete).
+Events are fanned out by a broker that lives on a dedicated asyncio loop in
+its own thread; the same loop serves `GET /events` on a separate port, so an
+idle SSE client costs a socket and a small buffer, not a waitress thread.
+
+The stream must stay same-origin, so browsers never connect to that port
+themselves. A proxy in front of the app (cloudflared, nginx) routes the path
+/events to it (README_public.md). A request that reaches Flask's `/events`
+instead is piped through from the hub over localhost (`open_stream`), which
+holds a server thread for as long as the client listens. So at most
+SNS_EVENTS_INLINE_MAX of those run per process, and reaching the cap (or
+finding no hub) is logged once with a pointer to the proxy setup.
+
+In the multi-process mode (`python -m sns_app serve`) the hub runs in a
+process of its own, forked by the master, and the workers forward their
+events to it over a localhost UDP socket the master binds (`bind_relay`,
+address in SNS_EVENTS_RELAY).
+
+Environment:
+  SNS_EVENTS              '0' disables the subsystem
+  SNS_EVENTS_HOST/PORT    SSE listener (default: SNS_HOST, SNS_PORT + 1)
+  SNS_EVENTS_INLINE_MAX   streams piped through Flask's /events per process (default 4)
+  SNS_EVENTS_BUFFER       events buffered per client before the oldest are dropped
+  SNS_EVENTS_HEARTBEAT    seconds between keep-alive comments
+  SNS_EVENTS_MAX_CLIENTS  concurrent stream limit
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import threading
+from collections import deque
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+class Client:
+    __slots__ = ('buf', 'wakeup', 'dropped')
+
+    def __init__(self, size):
+        self.buf = deque(maxlen=size)
+        self.wakeup = asyncio.Event()
+        self.dropped = False
+
+
+class Hub:
+    """Broker + SSE server, running on its own event loop thread."""
+
+    def __init__(self, host, port, relay=False):
+        # relay: True binds a relay socket, a socket object is read as one
+        self.host = host
+        self.port = port
+        self.relay = relay
+        self.relay_addr = None
+        self.buffer_size = _env_int('SNS_EVENTS_BUFFER', 100)
+        self.heartbeat = _env_int('SNS_EVENTS_HEARTBEAT', 15)
+        self.max_clients = _env_int('SNS_EVENTS_MAX_CLIENTS', 1000)
+        self.clients = set()
+        self.seq = 0
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._error = None
+        self.thread = threading.Thread(target=self._run, name='sns-events', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self._ready.wait(5)
+        if self._error:
+            raise self._error
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._setup())
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def _setup(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, reuse_address=True)
+        if self.relay:
+            where = {'sock': self.relay} if isinstance(self.relay, socket.socket) else {'local_addr': ('127.0.0.1', 0)}
+            transport, _ = await self.loop.create_datagram_endpoint(lambda: _RelayProtocol(self), **where)
+            self.relay_addr = transport.get_extra_info('sockname')[:2]
+
+    # --- broker -----------------------------------------------------------
+
+    def publish_threadsafe(self, message):
+        self.loop.call_soon_threadsafe(self._fanout, message)
+
+    def _fanout(self, message):
+        self.seq += 1
+        frame = f"id: {self.seq}\nevent: {message['type']}\ndata: {json.dumps(message, ensure_ascii=False)}\n\n".encode('utf-8')
+        for c in self.clients:
+            if len(c.buf) == c.buf.maxlen:
+                c.dropped = True
+            c.buf.append(frame)
+            c.wakeup.set()
+
+    # --- SSE server -------------------------------------------------------
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+        except Exception:
+            writer.close()
+            return
+        request_line = head.split(b'\r\n', 1)[0].decode('latin-1')
+        parts = request_line.split()
+        path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+        if len(parts) < 2 or parts[0] != 'GET' or path != '/events':
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await self._close(writer)
+            return
+        if len(self.clients) >= self.max_clients:
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 30\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await self._close(writer)
+            return
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream; charset=utf-8\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Connection: keep-alive\r\n'
+                     b'X-Accel-Buffering: no\r\n\r\n'
+                     b'retry: 5000\n\n')
+        client = Client(self.buffer_size)
+        self.clients.add(client)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(client.wakeup.wait(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    writer.write(b': ping\n\n')
+                client.wakeup.clear()
+                if client.dropped:
+                    # the client fell behind; tell it to reload instead of replaying a gap
+                    client.dropped = False
+                    client.buf.clear()
+                    writer.write(b'event: resync\ndata: {}\n\n')
+                while client.buf:
+                    writer.write(client.buf.popleft())
+                await asyncio.wait_for(writer.drain(), 10)
+        except Exception:
+            pass
+        finally:
+            self.clients.discard(client)
+            await self._close(writer)
+
+    async def _close(self, writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    def stats(self):
+        return {'clients': len(self.clients), 'published': self.seq}
+
+
+class _RelayProtocol(asyncio.DatagramProtocol):
+    def __init__(self, hub):
+        self.hub = hub
+
+    def datagram_received(self, data, addr):
+        try:
+            message = json.loads(data.decode('utf-8'))
+        except Exception:
+            return
+        if isinstance(message, dict) and 'type' in message:
+            self.hub._fanout(message)
+
+
+_hub = None
+_relay_sock = None
+_relay_addr = None
+_lock = threading.Lock()
+INLINE_MAX = max(1, _env_int('SNS_EVENTS_INLINE_MAX', 4))
+_inline = threading.BoundedSemaphore(INLINE_MAX)
+_warned = set()
+
+
+def enabled():
+    return os.environ.get('SNS_EVENTS', '1') != '0'
+
+
+def listen_address():
+    host = os.environ.get('SNS_EVENTS_HOST') or os.environ.get('SNS_HOST', '0.0.0.0')
+    port = _env_int('SNS_EVENTS_PORT', _env_int('SNS_PORT', 5000) + 1)
+    return host, port
+
+
+def start(relay=False):
+    """Start the hub in this process, or forward to the serving hub when
+    SNS_EVENTS_RELAY is set. relay: True, or the socket from bind_relay()."""
+    global _hub, _relay_addr
+    if not enabled():
+        return
+    with _lock:
+        if _hub is not None or _relay_addr is not None:
+            return
+        relay_env = os.environ.get('SNS_EVENTS_RELAY', '')
+        if relay_env and not relay:
+            host, _, port = relay_env.rpartition(':')
+            _relay_addr = (host, int(port))
+            return
+        host, port = listen_address()
+        hub = Hub(host, port, relay=relay)
+        try:
+            hub.start()
+        except OSError as e:
+            # e.g. the port is taken by another dev server: run without live updates
+            print(f'[events] SSE listener on {host}:{port} unavailable: {e}', file=sys.stderr)
+            return
+        _hub = hub
+        if relay and hub.relay_addr:
+            os.environ['SNS_EVENTS_RELAY'] = '%s:%d' % hub.relay_addr
+
+
+def bind_relay():
+    """Bind the relay socket before forking, so the hub process and the workers
+    agree on its address (and a restarted hub gets the same one)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.set_inheritable(True)
+    os.environ['SNS_EVENTS_RELAY'] = '%s:%d' % sock.getsockname()[:2]
+    return sock
+
+
+def after_fork():
+    """Drop the parent's hub in a forked worker; publish through the relay instead."""
+    global _hub, _relay_sock, _relay_addr
+    _hub = None
+    _relay_sock = None
+    _relay_addr = None
+    start()
+
+
+def publish(type_, **data):
+    data['type'] = type_
+    data.setdefault('ts', time.time())
+    if _hub is not None:
+        _hub.publish_threadsafe(data)
+    elif _relay_addr is not None:
+        global _relay_sock
+        try:
+            if _relay_sock is None:
+                _relay_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _relay_sock.sendto(json.dumps(data, ensure_ascii=False).encode('utf-8'), _relay_addr)
+        except OSError:
+            pass
+
+
+def _warn_once(kind, message):
+    if kind not in _warned:
+        _warned.add(kind)
+        print(message, file=sys.stderr)
+
+
+class _Piped:
+    """The body of the hub's stream, read from `sock`; close() (the server
+    calls it when the client goes) frees the socket and the inline slot."""
+
+    def __init__(self, sock, rest):
+        self.sock = sock
+        self.rest = rest
+        self.closed = False
+
+    def __iter__(self):
+        if self.rest:
+            yield self.rest
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except OSError:  # includes the timeout: the hub stopped sending pings
+                return
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+            _inline.release()
+
+
+def open_stream():
+    """The hub's stream for a request that reached the app, or None when it
+    cannot be served (too many piped streams here, no hub, hub full)."""
+    host, port = listen_address()
+    if not _inline.acquire(blocking=False):
+        _warn_once('busy', f'[events] {INLINE_MAX} live streams already hold server threads; '
+                           f'route /events to port {port} in the proxy (README_public.md)')
+        return None
+    host = {'': '127.0.0.1', '0.0.0.0': '127.0.0.1', '::': '::1'}.get(host, host)
+    sock = None
+    try:
+        sock = socket.create_connection((host, port), timeout=5)
+        sock.sendall(b'GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        head = b''
+        while b'\r\n\r\n' not in head:
+            data = sock.recv(4096)
+            if not data:
+                raise OSError('closed by the hub')
+            head += data
+        head, _, rest = head.partition(b'\r\n\r\n')
+        if head.split(b' ', 2)[1:2] != [b'200']:
+            raise OSError(head.split(b'\r\n', 1)[0].decode('latin-1'))
+    except OSError as e:
+        if sock is not None:
+            sock.close()
+        _inline.release()
+        _warn_once('down', f'[events] no live stream from {host}:{port}: {e}')
+        return None
+    # the hub pings every SNS_EVENTS_HEARTBEAT seconds; silence past a few means it is gone
+    sock.settimeout(3 * _env_int('SNS_EVENTS_HEARTBEAT', 15))
+    return _Piped(sock, rest)
+
+
+def stats():
+    if _hub is not None:
+        return _hub.stats()
+    return None
@@ -0,0 +1,84 @@
+"""Address lookups on Nominatim.
+
+lookup() is the blocking call the WSGI views make. lookup_async() is the
+one the ASGI entry point (asgi.py) awaits. With aiohttp installed, every
+lookup of a process shares one ClientSession and its pooled connector, so
+any number of lookups can wait on Nominatim without holding a thread.
+Without aiohttp, lookup() runs on a separate pool of OUTBOUND_THREADS, so
+slow lookups still never take a thread from the pool that serves requests.
+
+Environment:
+  SNS_GEOCODE_THREADS      outbound threads when aiohttp is missing (default 32)
+  SNS_GEOCODE_CONNECTIONS  open connections to Nominatim per process with aiohttp (default 8)
+"""
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:  # optional: lookups then run on the outbound thread pool
+    aiohttp = None
+
+URL = 'https://nominatim.openstreetmap.org/search'
+HEADERS = {'User-Agent': 'mini-sns-app/1.0'}
+TIMEOUT = 5
+
+
+def _int_env(name, default):
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+OUTBOUND_THREADS = _int_env('SNS_GEOCODE_THREADS', 32)
+CONNECTIONS = _int_env('SNS_GEOCODE_CONNECTIONS', 8)
+
+_client = None
+_outbound = None
+
+
+def _params(query):
+    return {'q': query, 'format': 'json', 'limit': 1}
+
+
+def _parse(data):
+    # (lat, lng) of the first hit, None when nothing matched
+    if isinstance(data, list) and data:
+        return float(data[0].get('lat')), float(data[0].get('lon'))
+    return None
+
+
+def lookup(query):
+    """(lat, lng) for a free-text address or place, None if not found; raises on network errors."""
+    resp = requests.get(URL, params=_params(query), headers=HEADERS, timeout=TIMEOUT)
+    return _parse(resp.json())
+
+
+async def lookup_async(query):
+    """lookup() for the event loop; the calling coroutine waits, no request thread does."""
+    global _client, _outbound
+    if aiohttp is None:
+        if _outbound is None:
+            _outbound = ThreadPoolExecutor(OUTBOUND_THREADS, thread_name_prefix='sns-geocode')
+        return await asyncio.get_running_loop().run_in_executor(_outbound, lookup, query)
+    if _client is None or _client.closed:
+        _client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=CONNECTIONS, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+            headers=HEADERS)
+    async with _client.get(URL, params=_params(query)) as resp:
+        return _parse(await resp.json(content_type=None))
+
+
+async def close():
+    global _client, _outbound
+    if _client is not None:
+        await _client.close()
+        _client = None
+    if _outbound is not None:
+        _outbound.shutdown(wait=False)
+        _outbound = None
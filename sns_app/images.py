@@ -0,0 +1,471 @@
+"""Per-image metadata for uploaded post photos (`images` table).
+
+Placeholders: intrinsic size of the original and the thumbnail, a dominant
+colour and a BlurHash (https://blurha.sh, 4x3 components, ~28 chars) are
+stored per image, so feed pages can reserve the box and paint a blurred
+preview (static/blurhash.js) before the thumbnail bytes arrive.
+
+Perceptual hash: a 64-bit dHash (difference of neighbouring pixels on a 9x8
+greyscale copy), so resized or recompressed copies of a photo hash to the
+same or nearby values. Lookups use multi-index hashing: the hash is split
+into four 16-bit bands, each with its own index. Two hashes within Hamming
+distance 3 always share a band exactly, so a search reads the few rows that
+match any band and checks the real distance in Python.
+
+Ingest: uploads are not served as sent. After validation the photo is
+turned upright (EXIF orientation), its long edge capped, and it is re-encoded
+without EXIF/XMP/ICC blobs (GPS positions never reach the feed) as a
+progressive JPEG, a PNG when it has transparency, or WebP when configured.
+`recompress-images` runs the same stage over older uploads on all cores.
+
+Environment:
+  SNS_IMAGE_MAX_EDGE  long edge of the stored original in px (default 2048)
+  SNS_IMAGE_QUALITY   JPEG/WebP quality (default 82)
+  SNS_IMAGE_FORMAT    jpeg (default) | webp
+  SNS_KEEP_ORIGINALS  1 to keep the file as uploaded in the originals directory
+  SNS_DEDUP_MODE      off | flag (default: keep, remember dup_of) |
+                      reject (refuse the upload) | reuse (point the post at the existing file)
+  SNS_DEDUP_DISTANCE  max Hamming distance counted as the same photo (default 3, at most
+                      BANDS - 1 = 3: a larger distance would need more bands)
+"""
+import os
+import sys
+import math
+import time
+import shutil
+import sqlite3
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+DEDUP_MODE = os.environ.get('SNS_DEDUP_MODE', 'flag')
+BANDS = 4
+BAND_BITS = 16
+# pigeonhole: hashes within BANDS - 1 bits differ in at most BANDS - 1 bands, so they share one
+MAX_DEDUP_DISTANCE = BANDS - 1
+try:
+    DEDUP_DISTANCE = int(os.environ.get('SNS_DEDUP_DISTANCE', '3'))
+except ValueError:
+    DEDUP_DISTANCE = 3
+if DEDUP_DISTANCE > MAX_DEDUP_DISTANCE:
+    print(f'[images] SNS_DEDUP_DISTANCE={DEDUP_DISTANCE} is more than the band index finds reliably; using {MAX_DEDUP_DISTANCE}', file=sys.stderr)
+    DEDUP_DISTANCE = MAX_DEDUP_DISTANCE
+
+
+def _int_env(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+MAX_EDGE = _int_env('SNS_IMAGE_MAX_EDGE', 2048)
+QUALITY = _int_env('SNS_IMAGE_QUALITY', 82)
+OUTPUT_FORMAT = os.environ.get('SNS_IMAGE_FORMAT', 'jpeg').lower()
+KEEP_ORIGINALS = os.environ.get('SNS_KEEP_ORIGINALS', '0').lower() in ('1', 'true', 'yes')
+THUMB_SIZE = 400   # thumbnails are fitted into THUMB_SIZE x THUMB_SIZE
+BACKFILL_BATCH = 100
+
+
+def create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS images (
+        name TEXT PRIMARY KEY,
+        dhash INTEGER,
+        h0 INTEGER, h1 INTEGER, h2 INTEGER, h3 INTEGER,
+        dup_of TEXT,
+        created_at TEXT NOT NULL,
+        width INTEGER,
+        height INTEGER,
+        thumb_width INTEGER,
+        thumb_height INTEGER,
+        color TEXT,
+        blurhash TEXT,
+        ingested_at TEXT
+    )
+    ''')
+    for i in range(BANDS):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_images_h{i} ON images(h{i})")
+
+
+def dhash(img):
+    """64-bit difference hash of a PIL image, as an unsigned int."""
+    g = img.convert('L').resize((9, 8), Image.LANCZOS)
+    px = list(g.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return value
+
+
+def _signed(h):
+    # SQLite integers are signed 64-bit
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def _unsigned(h):
+    return h + (1 << 64) if h < 0 else h
+
+
+def bands(h):
+    mask = (1 << BAND_BITS) - 1
+    return [(h >> (i * BAND_BITS)) & mask for i in range(BANDS)]
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def find_similar(db, h, max_distance=None, exclude=None):
+    """[(name, distance)] of stored images within max_distance of h, closest first."""
+    max_distance = DEDUP_DISTANCE if max_distance is None else min(max_distance, MAX_DEDUP_DISTANCE)
+    b = bands(h)
+    rows = db.execute('SELECT name, dhash, dup_of FROM images WHERE h0 = ? OR h1 = ? OR h2 = ? OR h3 = ?', b).fetchall()
+    found = []
+    for name, stored, dup_of in rows:
+        if stored is None or name == exclude:
+            continue
+        d = distance(h, _unsigned(stored))
+        if d <= max_distance:
+            # always point at the first copy, not at another duplicate
+            found.append((dup_of or name, d))
+    found.sort(key=lambda x: x[1])
+    return found
+
+
+def find_duplicate(db, h):
+    """Name of the original this hash duplicates, or None (also when dedup is off)."""
+    if DEDUP_MODE == 'off':
+        return None
+    found = find_similar(db, h)
+    return found[0][0] if found else None
+
+
+def record(db, name, h, dup_of=None, meta=None):
+    b = bands(h)
+    meta = meta or {}
+    db.execute('INSERT OR REPLACE INTO images (name, dhash, h0, h1, h2, h3, dup_of, created_at, width, height, thumb_width, thumb_height, color, blurhash, ingested_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+               (name, _signed(h), b[0], b[1], b[2], b[3], dup_of if dup_of != name else None, datetime.utcnow().isoformat(),
+                meta.get('width'), meta.get('height'), meta.get('thumb_width'), meta.get('thumb_height'), meta.get('color'), meta.get('blurhash'),
+                meta.get('ingested_at')))
+
+
+def forget(db, name):
+    """Drop the row of a deleted image. Its duplicates then point at the oldest
+    of them, which becomes the original, so no dup_of names a missing row."""
+    db.execute('DELETE FROM images WHERE name = ?', (name,))
+    heir = db.execute('SELECT name FROM images WHERE dup_of = ? ORDER BY created_at, name LIMIT 1', (name,)).fetchone()
+    if heir:
+        db.execute('UPDATE images SET dup_of = NULL WHERE name = ?', (heir[0],))
+        db.execute('UPDATE images SET dup_of = ? WHERE dup_of = ?', (heir[0], name))
+
+
+# --- placeholders ----------------------------------------------------------
+
+_B83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def _base83(value, length):
+    return ''.join(_B83[(value // 83 ** (length - i)) % 83] for i in range(1, length + 1))
+
+
+def _to_linear(v):
+    v /= 255.0
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _to_srgb(v):
+    v = max(0.0, min(1.0, v))
+    return int(v * 12.92 * 255 + 0.5) if v <= 0.0031308 else int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def blurhash(img, x_components=4, y_components=3):
+    small = img.convert('RGB')
+    small.thumbnail((32, 32))
+    w, h = small.size
+    lin = [(_to_linear(r), _to_linear(g), _to_linear(b)) for r, g, b in small.getdata()]
+    cos_x = [[math.cos(math.pi * i * x / w) for x in range(w)] for i in range(x_components)]
+    cos_y = [[math.cos(math.pi * j * y / h) for y in range(h)] for j in range(y_components)]
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            norm = 1.0 if i == 0 and j == 0 else 2.0
+            r = g = b = 0.0
+            for y in range(h):
+                cy = cos_y[j][y]
+                row = y * w
+                for x in range(w):
+                    basis = cos_x[i][x] * cy
+                    pr, pg, pb = lin[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = norm / (w * h)
+            factors.append((r * scale, g * scale, b * scale))
+    dc, ac = factors[0], factors[1:]
+    out = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        actual_max = max(abs(v) for f in ac for v in f)
+        quant_max = max(0, min(82, int(actual_max * 166 - 0.5)))
+        max_value = (quant_max + 1) / 166.0
+        out += _base83(quant_max, 1)
+    else:
+        max_value = 1.0
+        out += _base83(0, 1)
+    out += _base83((_to_srgb(dc[0]) << 16) + (_to_srgb(dc[1]) << 8) + _to_srgb(dc[2]), 4)
+    for f in ac:
+        q = [max(0, min(18, int(math.floor(math.copysign(abs(v / max_value) ** 0.5, v) * 9 + 9.5)))) for v in f]
+        out += _base83(q[0] * 19 * 19 + q[1] * 19 + q[2], 2)
+    return out
+
+
+def dominant_color(img):
+    small = img.convert('RGB')
+    small.thumbnail((64, 64))
+    pal = small.quantize(colors=5)
+    index = max(pal.getcolors(), key=lambda c: c[0])[1]
+    r, g, b = pal.getpalette()[index * 3:index * 3 + 3]
+    return f'#{r:02x}{g:02x}{b:02x}'
+
+
+def describe(img):
+    """Size, thumbnail size, dominant colour and BlurHash of an (oriented) PIL image."""
+    w, h = img.size
+    scale = min(1.0, THUMB_SIZE / w, THUMB_SIZE / h)
+    return {
+        'width': w,
+        'height': h,
+        'thumb_width': max(1, round(w * scale)),
+        'thumb_height': max(1, round(h * scale)),
+        'color': dominant_color(img),
+        'blurhash': blurhash(img),
+    }
+
+
+def meta_for(db, names):
+    """{image name: images row} for the given names (one query per 500)."""
+    names = list({n for n in names if n})
+    found = {}
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        for r in db.execute(f"SELECT name, thumb_width, thumb_height, color, blurhash FROM images WHERE name IN ({','.join('?' * len(chunk))})", chunk).fetchall():
+            found[r[0]] = r
+    return found
+
+
+def backfill(conn, upload_dir):
+    """Hash and describe uploads missing from `images` (oldest file first), then fill
+    placeholders of rows that predate them; commits every BACKFILL_BATCH images.
+    Returns (hashed, duplicates, described)."""
+    known = {r[0]: r[1] for r in conn.execute('SELECT name, width FROM images').fetchall()}
+    files = []
+    for entry in os.scandir(upload_dir):
+        if entry.is_file() and entry.name.rsplit('.', 1)[-1].lower() in ('jpg', 'jpeg', 'png', 'webp'):
+            if entry.name not in known or known[entry.name] is None:
+                files.append((entry.stat().st_mtime, entry.name, entry.path))
+    files.sort()
+    hashed = dups = described = 0
+    for n, (_, name, path) in enumerate(files, 1):
+        try:
+            with Image.open(path) as img:
+                meta = describe(img)
+                h = dhash(img) if name not in known else None
+        except Exception:
+            continue
+        if h is None:
+            conn.execute('UPDATE images SET width = ?, height = ?, thumb_width = ?, thumb_height = ?, color = ?, blurhash = ? WHERE name = ?',
+                         (meta['width'], meta['height'], meta['thumb_width'], meta['thumb_height'], meta['color'], meta['blurhash'], name))
+        else:
+            found = find_similar(conn, h, exclude=name)
+            dup_of = found[0][0] if found else None
+            record(conn, name, h, dup_of, meta)
+            hashed += 1
+            dups += dup_of is not None
+        described += 1
+        if n % BACKFILL_BATCH == 0:
+            conn.commit()
+    conn.commit()
+    return hashed, dups, described
+
+
+# --- ingest ----------------------------------------------------------------
+
+def orient(img):
+    """Upright copy of img (EXIF orientation applied, tag dropped)."""
+    return ImageOps.exif_transpose(img)
+
+
+def _has_alpha(img):
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def encode(img, path):
+    """Write the stored form of an oriented image next to `path` as a temp file.
+
+    Returns (final path, temp path, stored image); the extension of the final
+    path follows the output format, so it can differ from `path`."""
+    out = img
+    if max(out.size) > MAX_EDGE:
+        out = out.copy()
+        out.thumbnail((MAX_EDGE, MAX_EDGE), Image.LANCZOS)
+    alpha = _has_alpha(out)
+    if OUTPUT_FORMAT == 'webp':
+        out = out.convert('RGBA' if alpha else 'RGB')
+        ext, params = 'webp', {'format': 'WEBP', 'quality': QUALITY, 'method': 6}
+    elif alpha:
+        out = out.convert('RGBA')
+        ext, params = 'png', {'format': 'PNG', 'optimize': True}
+    else:
+        out = out.convert('RGB')
+        ext, params = 'jpg', {'format': 'JPEG', 'quality': QUALITY, 'optimize': True, 'progressive': True}
+    final = f'{os.path.splitext(path)[0]}.{ext}'
+    tmp = path + '.tmp'  # named after the source: a.png and a.jpg both end up as a.jpg
+    # no exif/icc_profile arguments: the stored file carries no metadata
+    out.save(tmp, **params)
+    return final, tmp, out
+
+
+def keep_original(path, originals_dir):
+    os.makedirs(originals_dir, exist_ok=True)
+    target = os.path.join(originals_dir, os.path.basename(path))
+    shutil.copy2(path, target + '.tmp')
+    place(target + '.tmp', target)
+
+
+def place(tmp, path, thumb_dir=None):
+    """Move tmp to `path`, or to <stem>_2<ext>, _3... when a file of that name
+    (or, with thumb_dir, its thumbnail) exists: never replaces another
+    upload. Returns the path used."""
+    stem, ext = os.path.splitext(path)
+    n = 1
+    while True:
+        candidate = path if n == 1 else f'{stem}_{n}{ext}'
+        n += 1
+        if thumb_dir and os.path.exists(os.path.join(thumb_dir, f'thumb_{os.path.basename(candidate)}')):
+            continue
+        try:
+            os.link(tmp, candidate)  # fails if the name is taken, unlike a rename
+        except FileExistsError:
+            continue
+        os.remove(tmp)
+        return candidate
+
+
+def ingest(img, path, originals_dir=None, thumb_dir=None):
+    """Replace the upload at `path` by its stored form (see encode).
+
+    Returns (new path, stored image). When the format changes the extension,
+    the new name is one no other upload (or thumbnail in thumb_dir) has. The
+    file as uploaded is copied to originals_dir first when one is given."""
+    final, tmp, out = encode(img, path)
+    if originals_dir:
+        keep_original(path, originals_dir)
+    if final == path:
+        os.replace(tmp, final)
+    else:
+        final = place(tmp, final, thumb_dir)
+        os.remove(path)
+    return final, out
+
+
+_FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+
+
+def _recompress_one(path, thumb_dir):
+    """Worker: encode one upload and its thumbnail into temp files."""
+    try:
+        with Image.open(path) as src:
+            rotated = src.getexif().get(0x0112, 1) != 1
+            tagged = bool(src.info.get('exif') or src.info.get('icc_profile') or src.info.get('xmp'))
+            img = orient(src)
+            final, tmp, out = encode(img, path)
+        before = os.path.getsize(path)
+        after = os.path.getsize(tmp)
+        if not (rotated or tagged or max(img.size) > MAX_EDGE or final != path) and after >= before:
+            # already lean and nothing to strip: leave the file alone
+            os.remove(tmp)
+            return {'path': path, 'skipped': True, 'before': before, 'after': before}
+        thumb = out.copy()
+        thumb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        thumb_tmp = os.path.join(thumb_dir, f'thumb_{os.path.basename(path)}.tmp')
+        thumb.save(thumb_tmp, format=_FORMATS[final.rsplit('.', 1)[-1]])
+        meta = describe(out)
+        meta['dhash'] = dhash(out)
+        return {'path': path, 'final': final, 'tmp': tmp, 'thumb_tmp': thumb_tmp, 'before': before, 'after': after, 'meta': meta}
+    except Exception as e:
+        return {'path': path, 'error': str(e)}
+
+
+def _apply(conn, r, thumb_dir, originals_dir):
+    """Swap one recompressed file in: files first when the name changes (the DB
+    never points at a missing file), DB rows in one transaction, then cleanup."""
+    old, new = r['path'], r['final']
+    if originals_dir:
+        keep_original(old, originals_dir)
+    if new != old:
+        new = place(r['tmp'], new, thumb_dir)
+    old_name, new_name = os.path.basename(old), os.path.basename(new)
+    old_thumb = os.path.join(thumb_dir, f'thumb_{old_name}')
+    new_thumb = os.path.join(thumb_dir, f'thumb_{new_name}')
+    if new != old:
+        os.replace(r['thumb_tmp'], new_thumb)
+    meta = r['meta']
+    meta['ingested_at'] = datetime.utcnow().isoformat()
+    with conn:
+        row = conn.execute('SELECT dup_of FROM images WHERE name = ?', (old_name,)).fetchone()
+        if new != old:
+            conn.execute('DELETE FROM images WHERE name = ?', (old_name,))
+            conn.execute('UPDATE images SET dup_of = ? WHERE dup_of = ?', (new_name, old_name))
+            conn.execute('UPDATE posts SET image = ? WHERE image = ?', (new_name, old_name))
+            try:
+                conn.execute('UPDATE archive.posts SET image = ? WHERE image = ?', (new_name, old_name))
+            except sqlite3.OperationalError:
+                pass  # no archive attached
+        record(conn, new_name, meta['dhash'], row[0] if row else None, meta)
+    if new == old:
+        os.replace(r['tmp'], new)
+        os.replace(r['thumb_tmp'], new_thumb)
+    else:
+        os.remove(old)
+        if os.path.exists(old_thumb):
+            os.remove(old_thumb)
+
+
+def recompress(conn, upload_dir, thumb_dir, originals_dir=None, workers=None, force=False, dry_run=False, log=print):
+    """Run the ingest stage over stored uploads not ingested yet, across `workers`
+    processes. Returns (files, bytes before, bytes after, failures)."""
+    done = set() if force else {r[0] for r in conn.execute('SELECT name FROM images WHERE ingested_at IS NOT NULL').fetchall()}
+    paths = sorted(e.path for e in os.scandir(upload_dir)
+                   if e.is_file() and e.name.rsplit('.', 1)[-1].lower() in ('jpg', 'jpeg', 'png', 'webp') and e.name not in done)
+    files = failed = before = after = 0
+    started = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for r in pool.map(_recompress_one, paths, [thumb_dir] * len(paths), chunksize=8):
+            if 'error' in r:
+                failed += 1
+                log(f"{os.path.basename(r['path'])}: {r['error']}")
+                continue
+            files += 1
+            before += r['before']
+            after += r['after']
+            if r.get('skipped'):
+                if not dry_run:
+                    with conn:
+                        conn.execute('UPDATE images SET ingested_at = ? WHERE name = ?', (datetime.utcnow().isoformat(), os.path.basename(r['path'])))
+                continue
+            if dry_run:
+                os.remove(r['tmp'])
+                os.remove(r['thumb_tmp'])
+                continue
+            try:
+                _apply(conn, r, thumb_dir, originals_dir)
+            except Exception as e:
+                failed += 1
+                log(f"{os.path.basename(r['path'])}: {e}")
+                for t in (r['tmp'], r['thumb_tmp']):
+                    if os.path.exists(t):
+                        os.remove(t)
+    log(f'{files} file(s) in {time.time() - started:.1f}s')
+    return files, before, after, failed
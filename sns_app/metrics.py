@@ -0,0 +1,97 @@
+"""In-process request metrics, served as /metrics.json (polled by tk_launcher).
+
+State has a fixed size: request counts per second for the last WINDOW
+seconds, and the durations of the last SAMPLES requests, from which the
+latency percentiles are computed when asked. A duration ends when the
+response is ready; for a streamed page that is its first byte. Each serving
+process keeps its own numbers: with `serve` a poll sees the worker that
+answered it.
+
+DB stats count the per-request connections of get_db() (there is no pool):
+how many are open right now, how many were opened, and the time an open
+takes (connect + ATTACH of the archive).
+"""
+import os
+import time
+import threading
+from collections import deque
+
+WINDOW = 60
+SAMPLES = 2048
+
+_lock = threading.Lock()
+_started = time.time()
+_seconds = [0] * WINDOW     # second (int time) each bucket belongs to
+_counts = [0] * WINDOW
+_durations = deque(maxlen=SAMPLES)
+_totals = {'requests': 0, 'errors': 0}
+_db = {'open': 0, 'opened': 0, 'connect_time': 0.0}
+
+
+def record(duration, status):
+    now = int(time.time())
+    i = now % WINDOW
+    with _lock:
+        if _seconds[i] != now:
+            _seconds[i] = now
+            _counts[i] = 0
+        _counts[i] += 1
+        _durations.append(duration)
+        _totals['requests'] += 1
+        if status >= 500:
+            _totals['errors'] += 1
+
+
+def db_opened(connect_time):
+    with _lock:
+        _db['open'] += 1
+        _db['opened'] += 1
+        _db['connect_time'] += connect_time
+
+
+def db_closed():
+    with _lock:
+        _db['open'] -= 1
+
+
+def _rate(now, seconds):
+    # completed seconds only: the current one is still filling up
+    n = sum(c for s, c in zip(_seconds, _counts) if now - seconds <= s < now)
+    return round(n / seconds, 2)
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+
+def snapshot():
+    now = int(time.time())
+    with _lock:
+        ordered = sorted(_durations)
+        rps_10 = _rate(now, 10)
+        rps_60 = _rate(now, WINDOW - 1)
+        totals = dict(_totals)
+        db = dict(_db)
+    return {
+        'pid': os.getpid(),
+        'uptime': round(time.time() - _started, 1),
+        'requests': totals['requests'],
+        'errors': totals['errors'],
+        'rps_10s': rps_10,
+        'rps_60s': rps_60,
+        'latency_ms': {
+            'samples': len(ordered),
+            'p50': _percentile(ordered, 0.50),
+            'p90': _percentile(ordered, 0.90),
+            'p99': _percentile(ordered, 0.99),
+            'max': _percentile(ordered, 1.0),
+        },
+        'db': {
+            'open': db['open'],
+            'opened': db['opened'],
+            'avg_connect_ms': round(db['connect_time'] / db['opened'] * 1000, 2) if db['opened'] else None,
+        },
+        'threads': threading.active_count(),
+    }
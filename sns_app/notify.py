@@ -0,0 +1,122 @@
+"""Notification fan-out on write.
+
+Request handlers only `enqueue()` an event (like, bookmark, new shop post).
+A background thread drains the queue in batches and writes the resulting
+rows into the per-user `notifications` table in one transaction per batch,
+together with the cached `users.unread_notifications` counters.
+
+Unread like notifications for the same post are merged (count column), so a
+viral post keeps a single row per owner instead of one per like.
+"""
+import sys
+import time
+import queue
+import threading
+import traceback
+from datetime import datetime
+
+BATCH_SIZE = 500       # events per transaction
+BATCH_WAIT = 0.2       # seconds to wait for more events before writing
+INSERT_CHUNK = 1000    # rows per executemany when a shop has many followers
+
+_q = queue.Queue(maxsize=100000)
+_connect = None
+_thread = None
+_lock = threading.Lock()
+
+
+def configure(connect):
+    """connect() must return a new sqlite3 connection with Row factory."""
+    global _connect
+    _connect = connect
+
+
+def enqueue(kind, post_id, actor_id=None, shop_key=None):
+    if _connect is None:
+        return
+    try:
+        _q.put_nowait((kind, post_id, actor_id, shop_key, datetime.utcnow().isoformat()))
+    except queue.Full:
+        print('[notify] queue full, dropping event', file=sys.stderr)
+        return
+    _ensure_thread()
+
+
+def _ensure_thread():
+    global _thread
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_loop, name='sns-notify', daemon=True)
+            _thread.start()
+
+
+def _loop():
+    while True:
+        batch = [_q.get()]
+        deadline = time.time() + BATCH_WAIT
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            write_batch(batch)
+        except Exception:
+            print(f'[notify] failed to write {len(batch)} events', file=sys.stderr)
+            traceback.print_exc()
+
+
+def write_batch(batch):
+    conn = _connect()
+    try:
+        with conn:
+            _write(conn, batch)
+    finally:
+        conn.close()
+
+
+def _write(conn, batch):
+    post_ids = list({e[1] for e in batch})
+    owners = {}
+    for i in range(0, len(post_ids), 500):
+        chunk = post_ids[i:i + 500]
+        marks = ','.join('?' * len(chunk))
+        for r in conn.execute(f'SELECT id, user_id FROM all_posts WHERE id IN ({marks})', chunk).fetchall():
+            owners[r['id']] = r['user_id']
+
+    likes = {}      # (owner, post_id) -> [count, last actor, last time]
+    rows = []       # (user_id, kind, post_id, actor_id, count, created_at)
+    for kind, post_id, actor_id, shop_key, ts in batch:
+        owner = owners.get(post_id)
+        if owner is None:
+            continue
+        if kind == 'like':
+            if actor_id == owner:
+                continue
+            agg = likes.setdefault((owner, post_id), [0, None, ts])
+            agg[0] += 1
+            agg[1] = actor_id or agg[1]
+            agg[2] = ts
+        elif kind == 'bookmark':
+            if actor_id != owner:
+                rows.append((owner, 'bookmark', post_id, actor_id, 1, ts))
+        elif kind == 'shop_post' and shop_key:
+            for f in conn.execute('SELECT user_id FROM shop_follows WHERE shop_key = ? AND user_id != ?', (shop_key, owner)).fetchall():
+                rows.append((f['user_id'], 'shop_post', post_id, owner, 1, ts))
+
+    for (owner, post_id), (count, actor_id, ts) in likes.items():
+        cur = conn.execute("UPDATE notifications SET count = count + ?, actor_id = COALESCE(?, actor_id), created_at = ? WHERE user_id = ? AND kind = 'like' AND post_id = ? AND is_read = 0",
+                           (count, actor_id, ts, owner, post_id))
+        if cur.rowcount == 0:
+            rows.append((owner, 'like', post_id, actor_id, count, ts))
+
+    for i in range(0, len(rows), INSERT_CHUNK):
+        conn.executemany('INSERT INTO notifications (user_id, kind, post_id, actor_id, count, created_at) VALUES (?, ?, ?, ?, ?, ?)', rows[i:i + INSERT_CHUNK])
+    unread = {}
+    for r in rows:
+        unread[r[0]] = unread.get(r[0], 0) + 1
+    conn.executemany('UPDATE users SET unread_notifications = COALESCE(unread_notifications, 0) + ? WHERE id = ?', [(n, uid) for uid, n in unread.items()])
+
@@ -0,0 +1,177 @@
+"""Reconcile upload directories with the DB and collect orphaned files.
+
+Orphans come from best-effort removals that failed, and from uploads whose
+post was never inserted. References (posts.image, users.avatar) are read
+with ORDER BY and directory listings are sorted the same way, so one merge
+pass finds files nobody references and references without a file. Only the
+cursor and one listing chunk are held in memory: listings longer than
+RUN_SIZE are sorted in runs spilled to temp files and merged (external sort).
+
+Orphans younger than the grace period are left alone: post() writes the file
+before its INSERT. Older ones are moved to the quarantine directory, put back
+if they become referenced again, and deleted after QUARANTINE_DAYS there.
+
+Environment:
+  SNS_GC_MODE             quarantine (default) | delete (no quarantine)
+  SNS_GC_GRACE_HOURS      minimum age of an orphan before it is touched (default 24)
+  SNS_GC_QUARANTINE_DAYS  how long quarantined files are kept (default 7)
+  SNS_GC_INTERVAL_HOURS   background sweep interval, 0 disables it (default 6)
+"""
+import os
+import time
+import heapq
+import tempfile
+
+
+def _float_env(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+MODE = os.environ.get('SNS_GC_MODE', 'quarantine')
+GRACE = _float_env('SNS_GC_GRACE_HOURS', 24) * 3600
+QUARANTINE_TTL = _float_env('SNS_GC_QUARANTINE_DAYS', 7) * 86400
+INTERVAL = _float_env('SNS_GC_INTERVAL_HOURS', 6) * 3600
+RUN_SIZE = 50000
+
+POST_IMAGES = 'SELECT DISTINCT image FROM posts WHERE image IS NOT NULL ORDER BY image'
+# with the cold-post archive attached (archive.py): images of live and archived posts
+ALL_POST_IMAGES = 'SELECT image FROM main.posts WHERE image IS NOT NULL UNION SELECT image FROM archive.posts WHERE image IS NOT NULL ORDER BY 1'
+AVATARS = 'SELECT DISTINCT avatar FROM users WHERE avatar IS NOT NULL ORDER BY avatar'
+
+
+def roots(upload_dir, thumb_dir, avatar_dir, archived=False):
+    """(label, directory, file name prefix, query of referenced names) per upload kind.
+    archived: the connection has the archive DB attached."""
+    images = ALL_POST_IMAGES if archived else POST_IMAGES
+    return [
+        ('uploads', upload_dir, '', images),
+        ('thumbs', thumb_dir, 'thumb_', images),
+        ('avatars', avatar_dir, '', AVATARS),
+    ]
+
+
+def _spill(names):
+    f = tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.run', delete=False)
+    with f:
+        for n in names:
+            f.write(n + '\n')
+    return f.name
+
+
+def _lines(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield line[:-1]
+
+
+def sorted_names(directory, prefix='', run_size=None):
+    """File names in directory starting with prefix (prefix stripped), in sorted order."""
+    run_size = run_size or RUN_SIZE
+    runs, chunk = [], []
+    try:
+        with os.scandir(directory) as it:
+            for e in it:
+                if e.name.startswith(prefix) and e.is_file():
+                    chunk.append(e.name[len(prefix):])
+                    if len(chunk) >= run_size:
+                        chunk.sort()
+                        runs.append(_spill(chunk))
+                        chunk = []
+    except FileNotFoundError:
+        pass
+    chunk.sort()
+    try:
+        yield from heapq.merge(chunk, *[_lines(r) for r in runs])
+    finally:
+        for r in runs:
+            os.remove(r)
+
+
+def merge(a, b):
+    """Walk two sorted streams of names: yield (name, in_a, in_b)."""
+    a, b = iter(a), iter(b)
+    x, y = next(a, None), next(b, None)
+    while x is not None or y is not None:
+        if y is None or (x is not None and x < y):
+            yield x, True, False
+            x = next(a, None)
+        elif x is None or y < x:
+            yield y, False, True
+            y = next(b, None)
+        else:
+            yield x, True, True
+            x, y = next(a, None), next(b, None)
+
+
+def _refs(conn, query):
+    # SQLite's BINARY collation orders UTF-8 like Python orders str
+    return (r[0] for r in conn.execute(query))
+
+
+def sweep(conn, roots, quarantine_dir, mode=None, grace=None, dry_run=False, now=None):
+    """Reconcile every root once. Returns {label: report dict}; in dry-run mode
+    nothing is moved and report['orphans'] lists what would be."""
+    mode = mode or MODE
+    grace = GRACE if grace is None else grace
+    now = now or time.time()
+    reports = {}
+    for label, directory, prefix, query in roots:
+        rep = {'files': 0, 'orphans': [], 'bytes': 0, 'young': 0, 'missing': [], 'restored': 0, 'purged': 0}
+        qdir = os.path.join(quarantine_dir, label)
+        for name, on_disk, referenced in merge(sorted_names(directory, prefix), _refs(conn, query)):
+            if on_disk:
+                rep['files'] += 1
+            if referenced and not on_disk:
+                rep['missing'].append(name)
+                continue
+            if referenced:
+                continue
+            path = os.path.join(directory, prefix + name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime < grace:
+                rep['young'] += 1
+                continue
+            rep['orphans'].append(name)
+            rep['bytes'] += st.st_size
+            if dry_run:
+                continue
+            try:
+                if mode == 'delete':
+                    os.remove(path)
+                else:
+                    os.makedirs(qdir, exist_ok=True)
+                    dest = os.path.join(qdir, prefix + name)
+                    os.replace(path, dest)
+                    # the quarantine clock starts now
+                    os.utime(dest, (now, now))
+            except FileNotFoundError:
+                pass
+        # quarantined files that are referenced again go back, expired ones go away
+        for name, quarantined, referenced in merge(sorted_names(qdir, prefix), _refs(conn, query)):
+            if not quarantined:
+                continue
+            path = os.path.join(qdir, prefix + name)
+            if referenced:
+                live = os.path.join(directory, prefix + name)
+                if not dry_run and not os.path.exists(live):
+                    os.replace(path, live)
+                rep['restored'] += 1
+                if name in rep['missing']:
+                    rep['missing'].remove(name)
+                continue
+            try:
+                expired = now - os.stat(path).st_mtime >= QUARANTINE_TTL
+            except FileNotFoundError:
+                continue
+            if expired:
+                if not dry_run:
+                    os.remove(path)
+                rep['purged'] += 1
+        reports[label] = rep
+    return reports
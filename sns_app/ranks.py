@@ -0,0 +1,71 @@
+"""Fractional (lexicographic) rank keys for user-ordered lists such as bookmarks.
+
+A key is a base-62 fraction written without the leading "0.", so plain string
+comparison (SQLite BINARY collation) gives the list order. A new key can always
+be generated between two neighbours, which makes a move a single UPDATE of the
+moved row. Keys never end in '0', otherwise no key could be placed before them.
+"""
+
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+_INDEX = {d: i for i, d in enumerate(DIGITS)}
+
+# keys longer than this trigger a rebalance of the whole list
+MAX_KEY_LEN = 24
+
+
+def _midpoint(a, b):
+    """Key strictly between a and b ('' = start, None = end)."""
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else '0') == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    da = _INDEX[a[0]] if a else 0
+    db = _INDEX[b[0]] if b is not None else BASE
+    if db - da > 1:
+        return DIGITS[(da + db) // 2]
+    if b is not None and len(b) > 1:
+        return b[:1]
+    return DIGITS[da] + _midpoint(a[1:], None)
+
+
+def key_after(a):
+    """Shortest convenient key after a (appending to the end of a list)."""
+    if not a:
+        return DIGITS[BASE // 2]
+    for i, ch in enumerate(a):
+        if ch != DIGITS[-1]:
+            return a[:i] + DIGITS[_INDEX[ch] + 1]
+    return a + DIGITS[1]
+
+
+def key_between(a, b):
+    """Key strictly between a and b. Either side may be None (list start / end)."""
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f'rank keys out of order: {a!r} >= {b!r}')
+    if b is None:
+        return key_after(a)
+    return _midpoint(a or '', b)
+
+
+def spread_keys(n):
+    """n evenly spaced keys for backfills and rebalancing.
+
+    Keys are spread over the lower half of the key space so that later
+    appends get short keys again.
+    """
+    width = 1
+    while BASE ** width < (n + 1) * 4:
+        width += 1
+    keys = []
+    step = BASE ** width // 2
+    for i in range(n):
+        v = (i + 1) * step // (n + 1)
+        digits = []
+        for _ in range(width):
+            v, r = divmod(v, BASE)
+            digits.append(DIGITS[r])
+        keys.append(''.join(reversed(digits)).rstrip('0'))
+    return keys
@@ -0,0 +1,157 @@
+"""Token-bucket rate limiting with pluggable state.
+
+`create(name, rate, capacity)` returns a limiter; `consume(key, cost)` returns
+(allowed, retry_after_seconds). Buckets refill continuously at `rate` tokens
+per second up to `capacity`.
+
+Backends (SNS_RATELIMIT_BACKEND):
+  memory  per-process dict, idle keys evicted LRU-style (default)
+  sqlite  small shared SQLite file (SNS_RATELIMIT_DB) so limits hold across
+          the worker processes of `python -m sns_app serve`
+The backend is chosen on first use in each process, so the server can pick
+it after the app module was imported.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class Limiter:
+    """In-memory buckets for one process."""
+
+    def __init__(self, rate, capacity, max_keys=100000):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, now):
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = [self.capacity, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            b[0] = min(self.capacity, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        return b
+
+    def _retry(self, tokens, cost):
+        return (cost - tokens) / self.rate if self.rate > 0 else 60.0
+
+    def consume(self, key, cost=1.0):
+        now = time.monotonic()
+        with self._lock:
+            b = self._bucket(key, now)
+            if b[0] >= cost:
+                b[0] -= cost
+                return True, 0.0
+            return False, self._retry(b[0], cost)
+
+    def peek(self, key, cost=1.0):
+        """Would `consume` succeed? Does not take tokens."""
+        now = time.monotonic()
+        with self._lock:
+            b = self._bucket(key, now)
+            if b[0] >= cost:
+                return True, 0.0
+            return False, self._retry(b[0], cost)
+
+
+class SqliteLimiter:
+    """Buckets in a shared SQLite file; one short IMMEDIATE transaction per check."""
+
+    def __init__(self, path, name, rate, capacity):
+        self.path = path
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=0.5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT NOT NULL, key TEXT NOT NULL, tokens REAL NOT NULL, updated REAL NOT NULL, PRIMARY KEY(name, key))')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _check(self, key, cost, take):
+        now = time.time()
+        try:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ? AND key = ?', (self.name, key)).fetchone()
+                tokens = self.capacity if row is None else min(self.capacity, row[0] + (now - row[1]) * self.rate)
+                allowed = tokens >= cost
+                if allowed and take:
+                    tokens -= cost
+                conn.execute('INSERT OR REPLACE INTO buckets (name, key, tokens, updated) VALUES (?, ?, ?, ?)', (self.name, key, tokens, now))
+                if random.random() < 0.001 and self.rate > 0:
+                    # drop buckets that are full again anyway
+                    conn.execute('DELETE FROM buckets WHERE name = ? AND updated < ?', (self.name, now - self.capacity / self.rate))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            # never take the site down because the limiter store is busy
+            print(f'[ratelimit] {self.name}: {e}', file=sys.stderr)
+            return True, 0.0
+        if allowed:
+            return True, 0.0
+        return False, (cost - tokens) / self.rate if self.rate > 0 else 60.0
+
+    def consume(self, key, cost=1.0):
+        return self._check(key, cost, True)
+
+    def peek(self, key, cost=1.0):
+        return self._check(key, cost, False)
+
+
+def default_db_path():
+    return os.environ.get('SNS_RATELIMIT_DB') or os.path.join(tempfile.gettempdir(), 'sns_ratelimit.db')
+
+
+class SharedLimiter:
+    """Named limiter whose backend is resolved lazily per process."""
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._impl = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _backend(self):
+        if self._impl is None or self._pid != os.getpid():
+            with self._lock:
+                if self._impl is None or self._pid != os.getpid():
+                    if os.environ.get('SNS_RATELIMIT_BACKEND', 'memory') == 'sqlite':
+                        self._impl = SqliteLimiter(default_db_path(), self.name, self.rate, self.capacity)
+                    else:
+                        self._impl = Limiter(self.rate, self.capacity)
+                    self._pid = os.getpid()
+        return self._impl
+
+    def consume(self, key, cost=1.0):
+        return self._backend().consume(key, cost)
+
+    def peek(self, key, cost=1.0):
+        return self._backend().peek(key, cost)
+
+
+def create(name, rate, capacity):
+    return SharedLimiter(name, rate, capacity)
@@ -0,0 +1,106 @@
+"""Column projections for listing pages, read into `__slots__` records.
+
+Listing queries used to select `posts.*` (hot_score and the nine shop
+columns of every post included) into sqlite3.Row objects, and the shop/near results
+then copied each row into a dict. A Projection names the columns one kind
+of card actually shows, with the SQL expression for each, and reads them
+straight into instances of a record class with one slot per column: no
+per-row dict, no column the template never looks at: hot_score is never
+read, trending reads three of the nine shop columns, the shop page and
+bookmarks none, and the profile skips the users join. Shop columns are
+read as stored: blanking them per row with CASE for other categories costs
+SQLite more VM steps than the NULLs save.
+
+    cur = FEED_CARD.execute(db, 'SELECT ' + FEED_CARD.select + ' FROM ...', params)
+
+Records read like rows in templates and views: p['id'], p.id, p.get('x'),
+p.keys(), dict(p). A column that is not part of the projection is a
+KeyError for p['x'], so Jinja treats it as undefined, as it does for a Row.
+Slots listed as `extra` are not read from SQL; the view sets them (shop
+totals, distance), and until then they are undefined like a missing column.
+
+scripts/bench_records.py compares a page of cards read this way with the
+posts.* path.
+"""
+
+SHOP_COLUMNS = ('shop_category', 'shop_name', 'shop_address', 'shop_url', 'shop_hours',
+                'shop_phone', 'shop_price_range', 'shop_lat', 'shop_lng')
+
+
+class Record:
+    __slots__ = ()
+    fields = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = self.fields[key]
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.fields else default
+
+    def keys(self):
+        return list(self.fields)
+
+    def __iter__(self):
+        # like sqlite3.Row: the values, in column order
+        return (getattr(self, f, None) for f in self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{f}={getattr(self, f, None)!r}' for f in self.fields)})"
+
+
+class Projection:
+    """The columns of one kind of card: (name, SQL expression) pairs."""
+
+    def __init__(self, name, columns, extra=()):
+        self.columns = tuple(columns)
+        names = tuple(n for n, _ in self.columns)
+        self.select = ', '.join(expr if expr.rsplit('.', 1)[-1] == n else f'{expr} AS {n}' for n, expr in self.columns)
+        # a generated __init__ (as namedtuple does): one positional argument per column
+        args = ', '.join(names)
+        body = ''.join(f'    self.{n} = {n}\n' for n in names)
+        ns = {}
+        exec(f'def __init__(self, {args}):\n{body}', ns)
+        self.record = type(name, (Record,), {'__slots__': names + tuple(extra), 'fields': names + tuple(extra),
+                                             '__init__': ns['__init__']})
+        record = self.record
+        self.factory = lambda cursor, row: record(*row)
+
+    def execute(self, db, sql, params=()):
+        """A cursor for `sql` (which selects self.select) that yields records."""
+        cur = db.cursor()
+        cur.row_factory = self.factory
+        return cur.execute(sql, params)
+
+
+def _shop_columns(table, names=SHOP_COLUMNS):
+    return [(n, f'{table}.{n}') for n in names + ('shop_id',)]
+
+
+_POST = [('id', 'posts.id'), ('user_id', 'posts.user_id'), ('content', 'posts.content'), ('image', 'posts.image'),
+         ('category', 'posts.category'), ('created_at', 'posts.created_at'), ('likes', 'posts.likes')]
+_AUTHOR = [('username', 'users.username'), ('avatar', 'users.avatar')]
+
+# index, keyword search: FROM posts JOIN users
+FEED_CARD = Projection('FeedCard', _POST + _AUTHOR + _shop_columns('posts'))
+# shop and near results: a shop's latest post plus its totals
+SHOP_CARD = Projection('ShopCard', _POST + _AUTHOR + _shop_columns('posts'), extra=('shop_posts', 'shop_likes', 'distance_km'))
+# profile: FROM posts, the author is the profile's user
+PROFILE_CARD = Projection('ProfileCard', _POST + _shop_columns('posts'))
+# trending: FROM posts JOIN users
+TRENDING_CARD = Projection('TrendingCard', _POST + _AUTHOR + _shop_columns('posts', ('shop_category', 'shop_name', 'shop_address')))
+# shop page: FROM posts JOIN users, all posts of one shop
+SHOP_POST = Projection('ShopPost', [c for c in _POST if c[0] != 'category'] + _AUTHOR)
+# bookmarks: FROM bookmarks b JOIN all_posts p JOIN users u
+BOOKMARK_ROW = Projection('BookmarkRow', [
+    ('id', 'p.id'), ('content', 'p.content'), ('image', 'p.image'), ('category', 'p.category'),
+    ('created_at', 'p.created_at'), ('username', 'u.username'), ('avatar', 'u.avatar'), ('folder', 'b.folder'),
+    ('bm_rank', 'b.rank_key'), ('bm_created', 'b.created_at'), ('bm_likes', 'b.post_likes'),
+    ('bm_category', 'b.post_category'), ('bm_post_id', 'b.post_id')])
@@ -0,0 +1,225 @@
+"""Benchmark: listing rows as posts.* + sqlite3.Row vs records.py projections.
+
+Builds a throwaway database shaped like sns.db (posts with all their
+columns, a third of them shop_intro with filled shop columns) and reads
+the same pages both ways:
+
+  feed      one index page (LIMIT 20)
+  trending  one trending page (hot_score order)
+  shop      one shop page (posts of one shop)
+  search    one streamed search page (LIKE, up to the 200-result cap)
+  shops     shop results: latest post per shop, plus totals and distance
+            (before: dict(row) per result; now: the record's extra slots)
+
+For each it prints the time per page, the SQLite VM steps the query took
+(query cost, independent of Python), and what tracemalloc sees while the
+page is materialized: bytes still held by the page, peak bytes and the
+number of allocations.
+
+    python sns_app/scripts/bench_records.py [--posts 20000] [--rounds 200]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+import importlib.util
+
+spec = importlib.util.spec_from_file_location('records', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'records.py'))
+records = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(records)
+
+SHOP_CATEGORIES = ['和食', '洋食', '中華', 'カフェ', '居酒屋', 'ラーメン', 'スイーツ']
+
+
+def build(path, n_posts, n_users=200, n_shops=300):
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT, email TEXT, password TEXT, avatar TEXT,
+                            is_verified INTEGER, is_premium INTEGER, created_at TEXT);
+        CREATE TABLE posts (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, content TEXT NOT NULL,
+                            image TEXT, category TEXT DEFAULT 'food_photo', shop_category TEXT, shop_name TEXT,
+                            shop_address TEXT, shop_url TEXT, shop_hours TEXT, shop_phone TEXT, shop_price_range TEXT,
+                            shop_lat REAL, shop_lng REAL, created_at TEXT NOT NULL, likes INTEGER DEFAULT 0,
+                            hot_score REAL, shop_id INTEGER);
+        CREATE TABLE shops (id INTEGER PRIMARY KEY, post_count INTEGER, likes INTEGER);
+        CREATE INDEX idx_posts_created ON posts(created_at);
+        CREATE INDEX idx_posts_shop ON posts(shop_id, id);
+        CREATE INDEX idx_posts_hot ON posts(hot_score DESC, id DESC);
+    ''')
+    rnd = random.Random(1)
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, 1, 0, ?)',
+                     [(i, f'@user{i}', f'u{i}@example.com', 'x' * 60, f'avatar_{i}.jpg', '2026-01-01T00:00:00') for i in range(1, n_users + 1)])
+    conn.executemany('INSERT INTO shops VALUES (?, ?, ?)', [(i, rnd.randint(1, 50), rnd.randint(0, 500)) for i in range(1, n_shops + 1)])
+    rows = []
+    for i in range(n_posts):
+        category = ('food_photo', 'shop_intro', 'recipe_intro')[i % 3]
+        shop = ()
+        if category == 'shop_intro':
+            s = rnd.randint(1, n_shops)
+            shop = (rnd.choice(SHOP_CATEGORIES), f'お店 {s}', f'東京都千代田区丸の内{s}-1-1 ビル{s}階', f'https://example.com/shops/{s}',
+                    '11:00-22:00（L.O. 21:30）', '03-0000-0000', '1000〜2000円', 35.6 + s / 1000, 139.7 + s / 1000, s)
+        content = ' '.join(rnd.choice(['ラーメン', 'カレー', '寿司', 'おいしい', '今日の', 'ランチ', 'ramen', 'lunch']) for _ in range(rnd.randint(5, 40)))
+        rows.append((rnd.randint(1, n_users), content, f'{1700000000 + i}_photo{i}.jpg', category, *(shop or (None,) * 10),
+                     f'2026-{1 + i * 12 // n_posts:02d}-01T00:00:{i % 60:02d}.{i:06d}', rnd.randint(0, 100), rnd.random()))
+    conn.executemany('INSERT INTO posts (user_id, content, image, category, shop_category, shop_name, shop_address, shop_url, shop_hours, '
+                     'shop_phone, shop_price_range, shop_lat, shop_lng, shop_id, created_at, likes, hot_score) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    return conn
+
+
+OLD_SELECT = 'SELECT posts.*, users.username, users.avatar FROM posts JOIN users ON posts.user_id = users.id'
+FEED_TAIL = ' ORDER BY posts.created_at DESC LIMIT 20 OFFSET 40'
+TRENDING_TAIL = ' WHERE posts.hot_score > 0 ORDER BY posts.hot_score DESC, posts.id DESC LIMIT 7'
+SHOP_TAIL = ' WHERE posts.shop_id = 7 ORDER BY posts.id DESC LIMIT 6'
+SEARCH_TAIL = " WHERE posts.content LIKE '%ramen%' ORDER BY posts.created_at DESC, posts.id DESC LIMIT 201"
+LATEST = ' WHERE posts.id IN (SELECT MAX(id) FROM posts WHERE shop_id IN ({marks}) GROUP BY shop_id)'
+
+
+def feed_old(conn):
+    conn.row_factory = sqlite3.Row
+    return conn.execute(OLD_SELECT + FEED_TAIL).fetchall()
+
+
+def feed_new(conn):
+    p = records.FEED_CARD
+    return p.execute(conn, f'SELECT {p.select} FROM posts JOIN users ON posts.user_id = users.id' + FEED_TAIL).fetchall()
+
+
+def trending_old(conn):
+    conn.row_factory = sqlite3.Row
+    return conn.execute(OLD_SELECT + TRENDING_TAIL).fetchall()
+
+
+def trending_new(conn):
+    p = records.TRENDING_CARD
+    return p.execute(conn, f'SELECT {p.select} FROM posts JOIN users ON posts.user_id = users.id' + TRENDING_TAIL).fetchall()
+
+
+def shop_old(conn):
+    conn.row_factory = sqlite3.Row
+    return conn.execute(OLD_SELECT + SHOP_TAIL).fetchall()
+
+
+def shop_new(conn):
+    p = records.SHOP_POST
+    return p.execute(conn, f'SELECT {p.select} FROM posts JOIN users ON posts.user_id = users.id' + SHOP_TAIL).fetchall()
+
+
+def search_old(conn):
+    conn.row_factory = sqlite3.Row
+    return conn.execute(OLD_SELECT + SEARCH_TAIL).fetchall()
+
+
+def search_new(conn):
+    p = records.FEED_CARD
+    return p.execute(conn, f'SELECT {p.select} FROM posts JOIN users ON posts.user_id = users.id' + SEARCH_TAIL).fetchall()
+
+
+SHOP_IDS = list(range(1, 201))
+
+
+def _totals(conn):
+    marks = ','.join('?' * len(SHOP_IDS))
+    return {r[0]: r for r in conn.execute(f'SELECT id, post_count, likes FROM shops WHERE id IN ({marks})', SHOP_IDS)}
+
+
+def shops_old(conn):
+    conn.row_factory = sqlite3.Row
+    marks = ','.join('?' * len(SHOP_IDS))
+    latest = {r['shop_id']: r for r in conn.execute(OLD_SELECT + LATEST.format(marks=marks), SHOP_IDS).fetchall()}
+    totals = _totals(conn)
+    results = []
+    for sid in SHOP_IDS:
+        p = latest.get(sid)
+        if p is None:
+            continue
+        pr = dict(p)
+        pr['shop_posts'], pr['shop_likes'] = totals[sid][1], totals[sid][2]
+        pr['distance_km'] = 1.0
+        results.append(pr)
+    return results
+
+
+def shops_new(conn):
+    p = records.SHOP_CARD
+    marks = ','.join('?' * len(SHOP_IDS))
+    latest = {r.shop_id: r for r in p.execute(conn, f'SELECT {p.select} FROM posts JOIN users ON posts.user_id = users.id' + LATEST.format(marks=marks), SHOP_IDS)}
+    totals = _totals(conn)
+    results = []
+    for sid in SHOP_IDS:
+        r = latest.get(sid)
+        if r is None:
+            continue
+        r.shop_posts, r.shop_likes = totals[sid][1], totals[sid][2]
+        r.distance_km = 1.0
+        results.append(r)
+    return results
+
+
+def vm_steps(conn, fn):
+    steps = [0]
+
+    def tick():
+        steps[0] += 1
+        return 0
+    conn.set_progress_handler(tick, 1)
+    try:
+        fn(conn)
+    finally:
+        conn.set_progress_handler(None, 1)
+    return steps[0]
+
+
+def allocations(conn, fn):
+    fn(conn)  # warm the statement cache
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        page = fn(conn)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    held = sum(s.size_diff for s in stats)
+    blocks = sum(s.count_diff for s in stats)
+    return len(page), held, peak, blocks
+
+
+def timing(conn, fn, rounds):
+    fn(conn)
+    samples = []
+    for _ in range(rounds):
+        t = time.perf_counter()
+        fn(conn)
+        samples.append(time.perf_counter() - t)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--posts', type=int, default=20000)
+    ap.add_argument('--rounds', type=int, default=200)
+    args = ap.parse_args(argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build(os.path.join(tmp, 'bench.db'), args.posts)
+        print(f'{args.posts} posts, median of {args.rounds} rounds')
+        print(f"{'page':<10}{'path':<9}{'rows':>6}{'ms/page':>10}{'vm steps':>11}{'held KiB':>10}{'peak KiB':>10}{'allocs':>8}")
+        for name, old, new in (('feed', feed_old, feed_new), ('trending', trending_old, trending_new), ('shop', shop_old, shop_new),
+                              ('search', search_old, search_new), ('shops', shops_old, shops_new)):
+            for label, fn in (('posts.*', old), ('records', new)):
+                rows, held, peak, blocks = allocations(conn, fn)
+                steps = vm_steps(conn, fn)
+                ms = timing(conn, fn, args.rounds) * 1000
+                print(f'{name:<10}{label:<9}{rows:>6}{ms:>10.3f}{steps:>11}{held / 1024:>10.1f}{peak / 1024:>10.1f}{blocks:>8}')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ param(
   [string]$TunnelName = "sns-app",
   [string]$Hostname = "sns.wp.lundi.com",
   [int]$Port = 5000,
+  [int]$EventsPort = 0,
   [switch]$InstallService
 )
 
@@ -48,6 +49,9 @@ $cfgDir = Join-Path $env:USERPROFILE ".cloudflared"
 $cfgPath = Join-Path $cfgDir "config.yml"
 $credPath = Join-Path $cfgDir ("{0}.json" -f $TunnelId)
 
+# the live stream (/events) goes straight to the events hub, same origin (README_public.md)
+if ($EventsPort -le 0) { $EventsPort = $Port + 1 }
+
 $cfg = @"
 # Cloudflare Tunnel config for persistent public URL
 # Hostname: $Hostname
@@ -59,6 +63,9 @@ credentials-file: "$credPath"
 
 # Ingress rules (map hostname to local service)
 ingress:
+  - hostname: $Hostname
+    path: ^/events$
+    service: http://127.0.0.1:$EventsPort
   - hostname: $Hostname
     service: http://127.0.0.1:$Port
   - service: http_status:404
@@ -0,0 +1,345 @@
+"""Multi-process serving mode: `python -m sns_app serve`.
+
+The master process binds the listening socket once, runs the startup warmup
+and forks SNS_WORKERS waitress workers that all accept on the shared socket.
+Workers share nothing else; each one opens its own DB connections.
+
+Environment (command line flags override):
+  SNS_HOST, SNS_PORT      listen address (same as run.py)
+  SNS_WORKERS             worker processes (default: CPU count)
+  SNS_THREADS             waitress threads per worker (default: 8)
+  SNS_WORKER_TIMEOUT      seconds without heartbeat before a worker is killed
+  SNS_GRACEFUL_TIMEOUT    seconds a stopping worker may spend draining requests
+
+With more than one worker, SNS_RATELIMIT_BACKEND defaults to 'sqlite' so the
+rate limits in ratelimit.py hold across processes.
+
+The live event stream (events.py) and the periodic jobs (tasks.every) run
+in a hub process the master forks first; workers forward their events to it.
+The master itself starts no threads, so a fork never copies a lock held by
+another thread.
+
+A worker stops its heartbeat while a request waits at the head of its queue
+and no request thread takes it, so a worker whose threads are all stuck is
+killed after SNS_WORKER_TIMEOUT; one that is stuck with an empty queue is not
+noticed.
+
+Signals (POSIX): HUP = graceful restart (new workers first, then old ones
+drain), TERM/INT = graceful stop, TTIN/TTOU = add/remove one worker.
+On platforms without fork() (Windows) it falls back to a single waitress
+process with the same warmup.
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import tempfile
+
+from waitress.server import create_server
+from waitress import wasyncore
+
+from .app import app, ensure_db, get_db, start_background
+from . import events, tasks
+
+
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+def warmup(open_db=True, background=True):
+    """Run DB init/migrations, precompile every template and open a DB connection.
+    background=False leaves the event hub and the periodic jobs unstarted."""
+    with app.app_context():
+        ensure_db(background)
+        for name in app.jinja_env.list_templates():
+            try:
+                app.jinja_env.get_template(name)
+            except Exception as e:
+                print(f'[serve] template warmup failed: {name}: {e}', file=sys.stderr)
+        if open_db:
+            db = get_db()
+            db.execute('SELECT id FROM posts ORDER BY created_at DESC LIMIT 1').fetchall()
+
+
+def make_socket(host, port, backlog=1024):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Worker:
+    def __init__(self, age, pid, tmp):
+        self.age = age
+        self.pid = pid
+        self.tmp = tmp  # heartbeat file (mtime is refreshed by the worker)
+        self.stopping_since = None
+
+    def last_beat(self):
+        try:
+            return os.fstat(self.tmp.fileno()).st_mtime
+        except OSError:
+            return 0.0
+
+
+def worker_main(sock, tmp, threads, graceful_timeout):
+    stopping = []
+
+    def on_term(signum, frame):
+        stopping.append(time.time())
+
+    signal.signal(signal.SIGTERM, on_term)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    for sig in ('SIGTTIN', 'SIGTTOU', 'SIGCHLD'):
+        if hasattr(signal, sig):
+            signal.signal(getattr(signal, sig), signal.SIG_DFL)
+
+    # publish through the master's event hub instead of the inherited one
+    events.after_fork()
+    # the master runs the periodic jobs; this process only runs what it submits
+    tasks.after_fork()
+    # per-process part of the warmup: a fresh DB connection after fork
+    try:
+        warmup(open_db=True)
+    except Exception as e:
+        print(f'[serve] worker {os.getpid()} warmup failed: {e}', file=sys.stderr)
+
+    server = create_server(app, sockets=[sock], threads=threads)
+    dispatcher = server.task_dispatcher
+    listening = True
+    waiting = None
+    while True:
+        # no beat while the same request waits for a free thread
+        head = dispatcher.queue[0] if dispatcher.queue else None
+        if head is None or head is not waiting:
+            try:
+                os.utime(tmp.name)
+            except OSError:
+                pass
+        waiting = head
+        if stopping:
+            if listening:
+                # stop accepting; requests already read keep being served
+                server.del_channel()
+                listening = False
+            busy = any(ch.requests for ch in list(server.active_channels.values()))
+            if not busy or time.time() - stopping[0] > graceful_timeout:
+                break
+        try:
+            wasyncore.loop(timeout=1.0, map=server._map, count=1)
+        except (SystemExit, KeyboardInterrupt):
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    dispatcher.shutdown(timeout=graceful_timeout)
+    os._exit(0)
+
+
+def hub_main(sock, relay_sock):
+    # the event hub and the periodic jobs, away from the master (see the module docstring)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for sig in ('SIGHUP', 'SIGTTIN', 'SIGTTOU', 'SIGCHLD'):
+        if hasattr(signal, sig):
+            signal.signal(getattr(signal, sig), signal.SIG_DFL)
+    sock.close()
+    master = os.getppid()
+    if relay_sock is not None:
+        events.start(relay=relay_sock)
+    start_background()
+    while os.getppid() == master:
+        time.sleep(1)
+    os._exit(0)
+
+
+class Master:
+    def __init__(self, host, port, workers, threads, worker_timeout, graceful_timeout):
+        self.host = host
+        self.port = port
+        self.num_workers = max(1, workers)
+        self.threads = threads
+        self.worker_timeout = worker_timeout
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}
+        self.age = 0
+        self.sock = None
+        self.relay_sock = None
+        self.hub = None
+        self.stopping = False
+        self._signals = []
+
+    def log(self, msg):
+        print(f'[serve] {msg}', flush=True)
+
+    def spawn(self):
+        self.age += 1
+        tmp = tempfile.NamedTemporaryFile(prefix='sns-worker-', delete=False)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                worker_main(self.sock, tmp, self.threads, self.graceful_timeout)
+            finally:
+                os._exit(1)
+        self.workers[pid] = Worker(self.age, pid, tmp)
+        return pid
+
+    def spawn_hub(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                hub_main(self.sock, self.relay_sock)
+            finally:
+                os._exit(1)
+        self.hub = pid
+        return pid
+
+    def kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                self.forget(pid)
+
+    def forget(self, pid):
+        w = self.workers.pop(pid, None)
+        if w is not None:
+            try:
+                w.tmp.close()
+                os.unlink(w.tmp.name)
+            except OSError:
+                pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid == self.hub:
+                if not self.stopping:
+                    self.log(f'hub process {pid} exited unexpectedly (status {status})')
+                self.hub = None
+                continue
+            w = self.workers.get(pid)
+            if w is not None and w.stopping_since is None:
+                self.log(f'worker {pid} exited unexpectedly (status {status})')
+            self.forget(pid)
+
+    def active(self):
+        return [w for w in self.workers.values() if w.stopping_since is None]
+
+    def stop_worker(self, w):
+        if w.stopping_since is None:
+            w.stopping_since = time.time()
+            self.kill(w.pid, signal.SIGTERM)
+
+    def check_health(self):
+        now = time.time()
+        for w in list(self.workers.values()):
+            if w.stopping_since is not None:
+                if now - w.stopping_since > self.graceful_timeout + 5:
+                    self.log(f'worker {w.pid} did not stop in time, killing')
+                    self.kill(w.pid, signal.SIGKILL)
+            elif now - w.last_beat() > self.worker_timeout:
+                self.log(f'worker {w.pid} missed heartbeat for {self.worker_timeout}s, killing')
+                w.stopping_since = now
+                self.kill(w.pid, signal.SIGKILL)
+
+    def manage(self):
+        if self.hub is None:
+            self.spawn_hub()
+        alive = sorted(self.active(), key=lambda w: w.age)
+        while len(alive) < self.num_workers:
+            self.spawn()
+            alive = sorted(self.active(), key=lambda w: w.age)
+        # oldest go first when shrinking or after a restart
+        for w in alive[:len(alive) - self.num_workers]:
+            self.stop_worker(w)
+
+    def graceful_restart(self):
+        self.log('graceful restart')
+        old = self.active()
+        for _ in range(self.num_workers):
+            self.spawn()
+        for w in old:
+            self.stop_worker(w)
+
+    def shutdown(self):
+        self.log('shutting down')
+        self.stopping = True
+        for w in list(self.workers.values()):
+            self.stop_worker(w)
+        if self.hub is not None:
+            self.kill(self.hub, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout + 5
+        while (self.workers or self.hub is not None) and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers) + ([self.hub] if self.hub is not None else []):
+            self.kill(pid, signal.SIGKILL)
+        self.reap()
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def run(self):
+        self.sock = make_socket(self.host, self.port)
+        if self.num_workers > 1:
+            # rate limits must be shared by all workers
+            os.environ.setdefault('SNS_RATELIMIT_BACKEND', 'sqlite')
+        # nothing here starts a thread: the hub process runs those (hub_main)
+        if events.enabled():
+            self.relay_sock = events.bind_relay()
+        warmup(open_db=False, background=False)
+        self.spawn_hub()
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(sig, self._on_signal)
+        self.log(f'listening on http://{self.host}:{self.port} with {self.num_workers} workers x {self.threads} threads')
+        try:
+            while True:
+                while self._signals:
+                    sig = self._signals.pop(0)
+                    if sig in (signal.SIGTERM, signal.SIGINT):
+                        return
+                    if sig == signal.SIGHUP:
+                        self.graceful_restart()
+                    elif sig == signal.SIGTTIN:
+                        self.num_workers += 1
+                    elif sig == signal.SIGTTOU and self.num_workers > 1:
+                        self.num_workers -= 1
+                self.reap()
+                self.check_health()
+                self.manage()
+                time.sleep(0.5)
+        finally:
+            self.shutdown()
+            self.sock.close()
+
+
+def serve(host=None, port=None, workers=None, threads=None):
+    host = host or os.environ.get('SNS_HOST', '0.0.0.0')
+    port = port or env_int('SNS_PORT', 5000)
+    workers = workers or env_int('SNS_WORKERS', os.cpu_count() or 1)
+    threads = threads or env_int('SNS_THREADS', 8)
+    worker_timeout = env_int('SNS_WORKER_TIMEOUT', 30)
+    graceful_timeout = env_int('SNS_GRACEFUL_TIMEOUT', 20)
+    if not hasattr(os, 'fork'):
+        # Windows: no fork(), serve from this process only
+        warmup(open_db=True)
+        print(f'[serve] fork() unavailable; single process on http://{host}:{port} x {threads} threads', flush=True)
+        from waitress import serve as waitress_serve
+        waitress_serve(app, host=host, port=port, threads=threads)
+        return
+    Master(host, port, workers, threads, worker_timeout, graceful_timeout).run()
@@ -0,0 +1,177 @@
+"""Shops as entities shared by all shop_intro posts.
+
+A post keeps the shop details its author typed (shown on the post), and
+`posts.shop_id` points at the deduplicated shop. Two posts name the same shop
+when their normalized names match and their addresses agree: same normalized
+address, one side without an address, or coordinates within MATCH_KM.
+Search and geo queries run over `shops` (one row per restaurant); the
+post_count / likes columns are maintained by the post handlers, and every
+change is mirrored into the map clusters (see clusters.py).
+"""
+import re
+import heapq
+import math
+import unicodedata
+from datetime import datetime
+
+try:
+    from . import clusters
+except ImportError:
+    import clusters
+
+MATCH_KM = 0.15
+
+_PUNCT = re.compile(r'[\s・･.,，、。\'"’”「」『』()（）\[\]【】!！?？&＆/／_-]+')
+_DASHES = re.compile(r'[‐‑‒–—―−ー－─━]')
+_CHOME = re.compile(r'(\d+)(?:丁目|番地|番|号|の)')
+
+
+def normalize_name(name):
+    s = unicodedata.normalize('NFKC', name or '').casefold()
+    return _PUNCT.sub('', s)
+
+
+def normalize_address(address):
+    s = unicodedata.normalize('NFKC', address or '').casefold()
+    s = re.sub(r'^〒?\s*\d{3}-?\d{4}', '', s.strip())
+    s = re.sub(r'^日本(国)?', '', s.strip())
+    s = re.sub(r'\s+', '', s)
+    # 1丁目2番3号 / 1ー2ー3 / 1−2−3 -> 1-2-3
+    s = _DASHES.sub('-', s)
+    s = _CHOME.sub(r'\1-', s)
+    return s.strip('-')
+
+
+def create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS shops (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        name_key TEXT NOT NULL,
+        address TEXT,
+        address_key TEXT NOT NULL DEFAULT '',
+        shop_category TEXT,
+        url TEXT,
+        hours TEXT,
+        phone TEXT,
+        price_range TEXT,
+        lat REAL,
+        lng REAL,
+        post_count INTEGER NOT NULL DEFAULT 0,
+        likes INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shops_name ON shops(name_key, address_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shops_geo ON shops(lat, lng) WHERE lat IS NOT NULL")
+    # shop name suggestions, most posted first (suggest.py)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shops_popular ON shops(post_count DESC, name) WHERE post_count > 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_shop ON posts(shop_id, id)")
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 6371.0 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def find(db, name, address=None, lat=None, lng=None):
+    """Id of the existing shop these details describe, or None."""
+    name_key = normalize_name(name)
+    if not name_key:
+        return None
+    address_key = normalize_address(address)
+    candidates = db.execute('SELECT id, address_key, lat, lng FROM shops WHERE name_key = ? ORDER BY post_count DESC, id', (name_key,)).fetchall()
+    for c in candidates:
+        if c[1] == address_key:
+            return c[0]
+    if lat is not None and lng is not None:
+        for c in candidates:
+            if c[2] is not None and c[3] is not None and distance_km(lat, lng, c[2], c[3]) <= MATCH_KM:
+                return c[0]
+    if not address_key and candidates:
+        return candidates[0][0]
+    for c in candidates:
+        if not c[1]:
+            return c[0]
+    return None
+
+
+def resolve(db, name, address=None, shop_category=None, url=None, hours=None, phone=None, price_range=None, lat=None, lng=None):
+    """Shop id for a shop_intro post, creating the shop or filling its missing details."""
+    if not normalize_name(name):
+        return None
+    shop_id = find(db, name, address, lat, lng)
+    if shop_id is None:
+        cur = db.execute('INSERT INTO shops (name, name_key, address, address_key, shop_category, url, hours, phone, price_range, lat, lng, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (name, normalize_name(name), address, normalize_address(address), shop_category, url, hours, phone, price_range, lat, lng, datetime.utcnow().isoformat()))
+        return cur.lastrowid
+    old = clusters.state(db, shop_id)
+    db.execute('''UPDATE shops SET
+                    address = COALESCE(address, ?),
+                    address_key = CASE WHEN address_key = '' THEN ? ELSE address_key END,
+                    shop_category = COALESCE(shop_category, ?),
+                    url = COALESCE(url, ?), hours = COALESCE(hours, ?), phone = COALESCE(phone, ?),
+                    price_range = COALESCE(price_range, ?),
+                    lat = COALESCE(lat, ?), lng = CASE WHEN lat IS NULL THEN ? ELSE lng END
+                  WHERE id = ?''',
+               (address, normalize_address(address), shop_category, url, hours, phone, price_range, lat, lng, shop_id))
+    clusters.update(db, shop_id, old, clusters.state(db, shop_id))
+    return shop_id
+
+
+def bump(db, shop_id, posts=0, likes=0):
+    if shop_id:
+        old = clusters.state(db, shop_id)
+        db.execute('UPDATE shops SET post_count = post_count + ?, likes = likes + ? WHERE id = ?', (posts, likes, shop_id))
+        clusters.update(db, shop_id, old, clusters.state(db, shop_id))
+
+
+def bump_post(db, post_id, likes, table='posts'):
+    # likes on a post also count for its shop; table: archive.posts for an archived post.
+    # Returns the shop id: its map tiles are left to clusters.rescore, run off the request
+    row = db.execute(f'SELECT shop_id FROM {table} WHERE id = ?', (post_id,)).fetchone()
+    if row and row[0]:
+        db.execute('UPDATE shops SET likes = likes + ? WHERE id = ?', (likes, row[0]))
+        return row[0]
+    return None
+
+
+def backfill(conn):
+    """Attach shop_intro posts without shop_id to shops (oldest first), then recount."""
+    rows = conn.execute("SELECT id, shop_name, shop_address, shop_category, shop_url, shop_hours, shop_phone, shop_price_range, shop_lat, shop_lng FROM posts WHERE category = 'shop_intro' AND shop_id IS NULL AND shop_name IS NOT NULL ORDER BY id").fetchall()
+    for r in rows:
+        shop_id = resolve(conn, r[1], r[2], r[3], r[4], r[5], r[6], r[7], r[8], r[9])
+        conn.execute('UPDATE posts SET shop_id = ? WHERE id = ?', (shop_id, r[0]))
+    if rows:
+        recount(conn)
+        clusters.rebuild(conn)
+    return len(rows)
+
+
+def recount(conn):
+    # archived posts still count, as in counters.actual_counts: live + archive when the archive is attached
+    table = 'all_posts' if conn.execute("SELECT 1 FROM sqlite_temp_master WHERE type = 'view' AND name = 'all_posts'").fetchone() else 'posts'
+    conn.execute(f'UPDATE shops SET post_count = (SELECT COUNT(*) FROM {table} p WHERE p.shop_id = shops.id), likes = (SELECT COALESCE(SUM(likes), 0) FROM {table} p WHERE p.shop_id = shops.id)')
+
+
+def within(db, lat, lng, radius_km, limit=None):
+    """[(shop row, distance_km)] inside radius_km, nearest first; bounding box on idx_shops_geo.
+    With `limit`, only the nearest `limit` are kept while the cursor is read."""
+    dlat = radius_km / 111.0
+    dlng = radius_km / max(0.01, 111.0 * math.cos(math.radians(lat)))
+    cur = db.execute('SELECT * FROM shops WHERE lat BETWEEN ? AND ? AND lng BETWEEN ? AND ? AND lat IS NOT NULL',
+                     (lat - dlat, lat + dlat, lng - dlng, lng + dlng))
+
+    def hits():
+        for r in cur:
+            d = distance_km(lat, lng, r['lat'], r['lng'])
+            if d <= radius_km:
+                yield r, d
+
+    found = hits()
+    if limit is None:
+        return sorted(found, key=lambda x: x[1])
+    return heapq.nsmallest(limit, found, key=lambda x: x[1])
+
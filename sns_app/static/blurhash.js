@@ -0,0 +1,57 @@
+// Paints a blurred preview behind <img data-blurhash="..."> until the image has
+// loaded. Decoder for the BlurHash format written by images.blurhash() (sns_app/images.py).
+(function(){
+  const B83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~';
+  function d83(s) { let v = 0; for (const c of s) v = v * 83 + B83.indexOf(c); return v; }
+  function toLinear(v) { v /= 255; return v <= 0.04045 ? v / 12.92 : Math.pow((v + 0.055) / 1.055, 2.4); }
+  function toSrgb(v) { v = Math.max(0, Math.min(1, v)); return Math.round(v <= 0.0031308 ? v * 12.92 * 255 : (1.055 * Math.pow(v, 1 / 2.4) - 0.055) * 255); }
+  function signPow(v, e) { return Math.sign(v) * Math.pow(Math.abs(v), e); }
+
+  function decode(hash, w, h) {
+    const size = d83(hash[0]);
+    const nx = size % 9 + 1, ny = Math.floor(size / 9) + 1;
+    if (hash.length !== 4 + 2 * nx * ny) return null;
+    const maxValue = (d83(hash[1]) + 1) / 166;
+    const colors = [];
+    const dc = d83(hash.slice(2, 6));
+    colors.push([toLinear(dc >> 16), toLinear((dc >> 8) & 255), toLinear(dc & 255)]);
+    for (let i = 1; i < nx * ny; i++) {
+      const v = d83(hash.slice(4 + i * 2, 6 + i * 2));
+      colors.push([Math.floor(v / 361), Math.floor(v / 19) % 19, v % 19].map(q => signPow((q - 9) / 9, 2) * maxValue));
+    }
+    const px = new Uint8ClampedArray(w * h * 4);
+    for (let y = 0; y < h; y++) {
+      for (let x = 0; x < w; x++) {
+        let r = 0, g = 0, b = 0;
+        for (let j = 0; j < ny; j++) {
+          for (let i = 0; i < nx; i++) {
+            const basis = Math.cos(Math.PI * x * i / w) * Math.cos(Math.PI * y * j / h);
+            const c = colors[i + j * nx];
+            r += c[0] * basis; g += c[1] * basis; b += c[2] * basis;
+          }
+        }
+        const o = 4 * (x + y * w);
+        px[o] = toSrgb(r); px[o + 1] = toSrgb(g); px[o + 2] = toSrgb(b); px[o + 3] = 255;
+      }
+    }
+    return px;
+  }
+
+  function paint(img) {
+    if (img.complete && img.naturalWidth) return;
+    try {
+      const px = decode(img.dataset.blurhash, 32, 32);
+      if (!px) return;
+      const canvas = document.createElement('canvas');
+      canvas.width = 32; canvas.height = 32;
+      canvas.getContext('2d').putImageData(new ImageData(px, 32, 32), 0, 0);
+      img.style.backgroundImage = 'url(' + canvas.toDataURL() + ')';
+      img.style.backgroundSize = '100% 100%';
+      img.addEventListener('load', function(){ img.style.backgroundImage = ''; }, {once: true});
+    } catch (e) {
+      console.log('blurhash error', e);
+    }
+  }
+
+  document.querySelectorAll('img[data-blurhash]').forEach(paint);
+})();
@@ -0,0 +1,128 @@
+// Direct uploads for forms marked data-direct-upload="post|avatar"; the
+// script tag's data-mode says how:
+//   presigned: the file goes to a presigned URL from /api/uploads (the
+//              bucket, or /storage/upload on the local backend)
+//   chunked:   the file goes to /api/uploads/chunked in chunks; a failed
+//              chunk is retried, and a session left by an earlier attempt
+//              (same file) is resumed where it stopped
+// Either way the form then carries only the key (upload_key). Any failure
+// falls back to the plain multipart form.
+(function(){
+  const mode = (document.currentScript && document.currentScript.dataset.mode) || 'presigned';
+  const CHUNK_TRIES = 6;
+
+  function sleep(ms){ return new Promise(function(resolve){ setTimeout(resolve, ms); }); }
+
+  async function sha256(buf){
+    // only in secure contexts; the server computes its own when this is empty
+    if (!(window.crypto && crypto.subtle)) return '';
+    const sum = new Uint8Array(await crypto.subtle.digest('SHA-256', buf));
+    return Array.prototype.map.call(sum, function(b){ return b.toString(16).padStart(2, '0'); }).join('');
+  }
+
+  async function presigned(form, file, csrf){
+    const res = await fetch('/api/uploads', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json', 'X-CSRFToken': csrf},
+      body: JSON.stringify({kind: form.dataset.directUpload, content_type: file.type, size: file.size})
+    });
+    if (!res.ok) throw new Error('presign ' + res.status);
+    const grant = await res.json();
+    const body = new FormData();
+    Object.keys(grant.upload.fields).forEach(function(k){ body.append(k, grant.upload.fields[k]); });
+    body.append('file', file);  // must come last for S3
+    const up = await fetch(grant.upload.url, {method: 'POST', body: body});
+    if (!up.ok) throw new Error('upload ' + up.status);
+    return grant.key;
+  }
+
+  async function call(method, url, csrf, opts){
+    // JSON of a 2xx or 409 (the session's status) response; throws otherwise,
+    // retrying network errors and 5xx with backoff
+    for (let attempt = 1; ; attempt++) {
+      let res = null;
+      try {
+        const headers = Object.assign({'X-CSRFToken': csrf}, (opts && opts.headers) || {});
+        res = await fetch(url, Object.assign({}, opts || {}, {method: method, headers: headers}));
+      } catch (e) {
+        if (attempt >= CHUNK_TRIES) throw e;
+      }
+      if (res && (res.ok || res.status === 409)) return res.status === 204 ? {} : res.json();
+      if (res && (res.status < 500 || attempt >= CHUNK_TRIES)) throw new Error(method + ' ' + url + ' ' + res.status);
+      await sleep(Math.min(30000, 500 * Math.pow(2, attempt)));
+    }
+  }
+
+  function json(data){
+    return {headers: {'Content-Type': 'application/json'}, body: JSON.stringify(data)};
+  }
+
+  async function chunked(form, file, csrf){
+    const kind = form.dataset.directUpload;
+    const memo = ['sns-upload', kind, file.name, file.size, file.lastModified].join(':');
+    let st = null;
+    const saved = window.localStorage && localStorage.getItem(memo);
+    if (saved) {
+      try { st = await call('GET', '/api/uploads/chunked/' + saved, csrf); } catch (e) { st = null; }
+      if (st && st.error) st = null;
+    }
+    if (!st) {
+      st = await call('POST', '/api/uploads/chunked', csrf, json({kind: kind, content_type: file.type, size: file.size}));
+      if (st.error) throw new Error(st.error);
+      if (window.localStorage) localStorage.setItem(memo, st.id);
+    }
+    const base = '/api/uploads/chunked/' + st.id;
+    function forget(){ if (window.localStorage) localStorage.removeItem(memo); }
+    try {
+      while (!st.complete) {
+        const index = st.next_index;
+        const start = index * st.chunk_size;
+        const buf = await file.slice(start, Math.min(st.size, start + st.chunk_size)).arrayBuffer();
+        const headers = {'Content-Type': 'application/octet-stream'};
+        const sum = await sha256(buf);
+        if (sum) headers['X-Chunk-SHA256'] = sum;
+        st = await call('PUT', base + '/' + index, csrf, {headers: headers, body: buf});
+        // 409 out_of_order / complete: continue where the server is; anything else is fatal
+        if (st.error && st.error !== 'out_of_order' && st.error !== 'complete') throw new Error(st.error);
+      }
+      const done = await call('POST', base + '/finalize', csrf, json({}));
+      if (!done.key) throw new Error(done.error || 'finalize');
+      forget();
+      return done.key;
+    } catch (e) {
+      // keep the session for the next try unless the server refused it
+      if (st.error) forget();
+      throw e;
+    }
+  }
+
+  document.querySelectorAll('form[data-direct-upload]').forEach(function(form){
+    const input = form.querySelector('input[type="file"]');
+    if (!input || !window.fetch || !window.FormData) return;
+    if (mode === 'chunked' && !(window.Blob && Blob.prototype.arrayBuffer)) return;
+    let sending = false;
+    form.addEventListener('submit', async function(ev){
+      const file = input.files && input.files[0];
+      if (sending || !file) return;
+      ev.preventDefault();
+      sending = true;
+      const csrf = form.querySelector('input[name="csrf_token"]');
+      try {
+        const upload = mode === 'chunked' ? chunked : presigned;
+        const keyValue = await upload(form, file, csrf ? csrf.value : '');
+        let key = form.querySelector('input[name="upload_key"]');
+        if (!key) {
+          key = document.createElement('input');
+          key.type = 'hidden';
+          key.name = 'upload_key';
+          form.appendChild(key);
+        }
+        key.value = keyValue;
+        input.disabled = true;  // the bytes are already in storage
+      } catch (e) {
+        console.log('direct upload failed, sending the file with the form', e);
+      }
+      form.submit();
+    });
+  });
+})();
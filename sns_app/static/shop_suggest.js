@@ -0,0 +1,57 @@
+// Shop name autocomplete for the post/edit forms. Suggestions come from shops
+// that are already known (/api/shops/suggest); picking one fills the address,
+// subcategory and coordinates, so the form doesn't need /geocode for it.
+(function(){
+  const nameInput = document.querySelector('input[name="shop_name"]');
+  if (!nameInput) return;
+  const addrInput = document.querySelector('input[name="shop_address"]');
+  const catSel = document.querySelector('select[name="shop_category"]');
+  const latInput = document.getElementById('shop_lat');
+  const lngInput = document.getElementById('shop_lng');
+  const list = document.createElement('datalist');
+  list.id = 'shop-suggestions';
+  document.body.appendChild(list);
+  nameInput.setAttribute('list', list.id);
+  nameInput.setAttribute('autocomplete', 'off');
+  let shops = {};
+  let timer = null;
+  let lastPrefix = '';
+
+  function pick(s) {
+    if (addrInput && !addrInput.value && s.address) addrInput.value = s.address;
+    if (catSel && !catSel.value && s.shop_category) catSel.value = s.shop_category;
+    if (latInput && lngInput && s.lat != null && s.lng != null) {
+      latInput.value = s.lat;
+      lngInput.value = s.lng;
+      // geocodeByName() skips the lookup while name and address still match this shop
+      nameInput.dataset.knownShop = nameInput.value.trim() + '\n' + (addrInput ? addrInput.value.trim() : '');
+    }
+  }
+
+  nameInput.addEventListener('input', function(){
+    clearTimeout(timer);
+    if (shops[nameInput.value]) { pick(shops[nameInput.value]); return; }
+    const prefix = nameInput.value.trim();
+    if (!prefix || prefix === lastPrefix) return;
+    timer = setTimeout(async function(){
+      lastPrefix = prefix;
+      try {
+        const res = await fetch('/api/shops/suggest?prefix=' + encodeURIComponent(prefix));
+        if (!res.ok) return;
+        const j = await res.json();
+        shops = {};
+        list.innerHTML = '';
+        j.shops.forEach(function(s){
+          if (shops[s.name]) return;  // same name elsewhere: keep the most posted one
+          shops[s.name] = s;
+          const opt = document.createElement('option');
+          opt.value = s.name;
+          if (s.address) opt.label = s.address;
+          list.appendChild(opt);
+        });
+      } catch (e) {
+        console.log('suggest error', e);
+      }
+    }, 200);
+  });
+})();
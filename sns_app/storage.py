@@ -0,0 +1,244 @@
+"""Where uploaded images live: the local static directory or an S3-compatible bucket.
+
+Keys are paths relative to static/ ('uploads/<name>', 'uploads/thumbs/thumb_<name>',
+'uploads/avatars/<name>'), so the local backend is the existing directory layout
+and its URLs are the static route's.
+
+Browsers can send image bytes straight to storage: presign_upload() returns
+a URL plus form fields for a POST of one object under 'incoming/', limited in
+size and content type. The form then carries the key (upload_key), and the
+app fetches the object once for ingest (validation, re-encode, thumbnail),
+stores the results under their final keys and drops the incoming object.
+With S3 the bucket (or a CDN in front of it, SNS_S3_PUBLIC_URL) serves the
+images. The local backend accepts the same POST at /storage/upload, checked
+against an HMAC signature instead of a bucket policy, and keeps incoming
+objects in a directory of their own, outside static/.
+
+Ingest stays in the form's request, because the size and food-photo checks
+and duplicate detection need the pixels and their verdict is the form's
+answer. With S3, each direct upload therefore crosses the app twice: once
+down for ingest (take) and once up as the stored image and thumbnail. What
+direct uploads save is the browser's upload over the public link, which no
+longer holds a request thread. The two server-side transfers stay in the
+bucket's region. Moving ingest to a background task would put posts up
+before their image is checked.
+
+Incoming objects nobody claimed are deleted by expire_incoming() (on S3 a
+lifecycle rule on the incoming/ prefix does the same job).
+
+The disk maintenance commands (gc-uploads, recompress-images, the upload
+manifest of backups) and the /img derivatives work on the local directory.
+With S3 they see only what is still on local disk; the bucket needs its own
+lifecycle and versioning rules.
+
+Environment:
+  SNS_STORAGE            local (default) | s3
+  SNS_S3_BUCKET          bucket name
+  SNS_S3_PREFIX          key prefix inside the bucket (default none)
+  SNS_S3_ENDPOINT_URL    S3-compatible endpoint (MinIO etc.; default AWS)
+  SNS_S3_REGION          region (default from the AWS config)
+  SNS_S3_PUBLIC_URL      base URL the images are served from (default: the bucket URL)
+  SNS_UPLOAD_URL_TTL     seconds a presigned upload stays valid (default 600)
+"""
+import os
+import hmac
+import time
+import shutil
+import hashlib
+from urllib.parse import quote
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # optional: only SNS_STORAGE=s3 needs it
+    boto3 = None
+    ClientError = Exception
+
+INCOMING = 'incoming/'
+try:
+    UPLOAD_URL_TTL = int(os.environ.get('SNS_UPLOAD_URL_TTL', '600'))
+except ValueError:
+    UPLOAD_URL_TTL = 600
+CACHE_CONTROL = 'public, max-age=31536000, immutable'   # names are never reused
+
+
+class StorageError(Exception):
+    pass
+
+
+class LocalStorage:
+    local = True
+
+    def __init__(self, root, secret, incoming_dir, receive_url='/storage/upload'):
+        self.root = os.path.abspath(root)
+        # outside the static directory: unclaimed uploads are not served
+        self.incoming = os.path.abspath(incoming_dir)
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.receive_url = receive_url
+
+    def path(self, key):
+        root = self.root
+        if key.startswith(INCOMING):
+            root, key = self.incoming, key[len(INCOMING):]
+        p = os.path.abspath(os.path.join(root, key))
+        if not p.startswith(root + os.sep):
+            raise StorageError(f'bad key: {key}')
+        return p
+
+    def url(self, key):
+        # None: served by the app's own static route
+        return None
+
+    def put_file(self, key, path, content_type=None):
+        """Move the file at `path` into storage as `key`."""
+        dest = self.path(key)
+        if os.path.abspath(path) != dest:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(path, dest)
+
+    def take(self, key, dest):
+        """Move `key` out of storage to the local file `dest`."""
+        src = self.path(key)
+        if os.path.abspath(dest) != src:
+            shutil.move(src, dest)  # a rename when incoming/ is on the same disk
+
+    def stat(self, key):
+        """Size of `key` in bytes, None if it does not exist."""
+        try:
+            return os.path.getsize(self.path(key))
+        except (OSError, StorageError):
+            return None
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _sign(self, key, content_type, max_bytes, expires):
+        msg = f'{key}\n{content_type}\n{max_bytes}\n{expires}'.encode()
+        return hmac.new(self.secret, msg, hashlib.sha256).hexdigest()
+
+    def presign_upload(self, key, content_type, max_bytes, ttl=None):
+        expires = int(time.time()) + (ttl or UPLOAD_URL_TTL)
+        fields = {'key': key, 'Content-Type': content_type, 'max_bytes': str(max_bytes), 'expires': str(expires)}
+        fields['signature'] = self._sign(key, content_type, max_bytes, expires)
+        return {'url': self.receive_url, 'fields': fields}
+
+    def receive(self, form, file):
+        """Store the file of a presigned POST after checking its fields. Returns the key."""
+        try:
+            key, content_type = form['key'], form['Content-Type']
+            max_bytes, expires = int(form['max_bytes']), int(form['expires'])
+        except (KeyError, ValueError):
+            raise StorageError('missing fields')
+        if not hmac.compare_digest(self._sign(key, content_type, max_bytes, expires), form.get('signature', '')):
+            raise StorageError('bad signature')
+        if expires < time.time():
+            raise StorageError('expired')
+        if not key.startswith(INCOMING) or file is None:
+            raise StorageError('bad request')
+        if (file.mimetype or '') != content_type:
+            raise StorageError('content type does not match the policy')
+        dest = self.path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        size = 0
+        with open(dest + '.part', 'wb') as out:
+            for block in iter(lambda: file.stream.read(1 << 16), b''):
+                size += len(block)
+                if size > max_bytes:
+                    break
+                out.write(block)
+        if not 0 < size <= max_bytes:
+            os.remove(dest + '.part')
+            raise StorageError('size outside the policy')
+        os.replace(dest + '.part', dest)
+        return key
+
+    def expire_incoming(self, max_age):
+        removed = 0
+        now = time.time()
+        for dirpath, _, files in os.walk(self.incoming):
+            for n in files:
+                p = os.path.join(dirpath, n)
+                try:
+                    if now - os.path.getmtime(p) > max_age:
+                        os.remove(p)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+class S3Storage:
+    local = False
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, public_url=None):
+        if boto3 is None:
+            raise StorageError('SNS_STORAGE=s3 needs boto3 (pip install boto3)')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        if public_url:
+            self.base = public_url.rstrip('/') + '/'
+        elif endpoint_url:
+            self.base = f"{endpoint_url.rstrip('/')}/{bucket}/"
+        else:
+            self.base = f'https://{bucket}.s3.amazonaws.com/'
+
+    def url(self, key):
+        return self.base + quote(self.prefix + key)
+
+    def put_file(self, key, path, content_type=None):
+        """Upload the file at `path` as `key` and remove the local copy."""
+        extra = {'CacheControl': CACHE_CONTROL}
+        if content_type:
+            extra['ContentType'] = content_type
+        else:
+            extra['ContentType'] = {'png': 'image/png', 'webp': 'image/webp'}.get(key.rsplit('.', 1)[-1].lower(), 'image/jpeg')
+        self.client.upload_file(path, self.bucket, self.prefix + key, ExtraArgs=extra)
+        os.remove(path)
+
+    def take(self, key, dest):
+        self.client.download_file(self.bucket, self.prefix + key, dest)
+        self.delete(key)
+
+    def stat(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)['ContentLength']
+        except ClientError:
+            return None
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def presign_upload(self, key, content_type, max_bytes, ttl=None):
+        # a presigned POST, unlike a presigned PUT, lets the bucket enforce the size limit
+        return self.client.generate_presigned_post(
+            self.bucket, self.prefix + key,
+            Fields={'Content-Type': content_type},
+            Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, max_bytes]],
+            ExpiresIn=ttl or UPLOAD_URL_TTL)
+
+    def expire_incoming(self, max_age):
+        removed = 0
+        now = time.time()
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix + INCOMING)
+        for page in pages:
+            old = [{'Key': o['Key']} for o in page.get('Contents', []) if now - o['LastModified'].timestamp() > max_age]
+            if old:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': old, 'Quiet': True})
+                removed += len(old)
+        return removed
+
+
+def from_env(static_dir, secret, incoming_dir):
+    """The backend selected by SNS_STORAGE."""
+    if os.environ.get('SNS_STORAGE', 'local') == 's3':
+        return S3Storage(
+            os.environ.get('SNS_S3_BUCKET', ''),
+            prefix=os.environ.get('SNS_S3_PREFIX', ''),
+            endpoint_url=os.environ.get('SNS_S3_ENDPOINT_URL') or None,
+            region=os.environ.get('SNS_S3_REGION') or None,
+            public_url=os.environ.get('SNS_S3_PUBLIC_URL') or None)
+    return LocalStorage(static_dir, secret, incoming_dir)
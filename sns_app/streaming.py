@@ -0,0 +1,100 @@
+"""Streamed result pages (search, near).
+
+A broad search used to fetch every match and render the whole page before
+sending anything. Instead, `Results` reads its sources lazily, a batch at a
+time, and stops at a hard cap. The page template iterates it batch by batch
+inside a streamed response, so rendered cards go out while later rows are
+still being read. Neither the rows nor the HTML of the whole result are held
+in memory. Past the cap, the page ends with a "more" link that continues
+after the last row shown.
+
+Environment:
+  SNS_RESULT_CAP    results per streamed page (default 200)
+  SNS_RESULT_BATCH  rows read (and rendered) per batch (default 25)
+"""
+import os
+from itertools import islice
+
+
+def _int_env(name, default):
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+CAP = _int_env('SNS_RESULT_CAP', 200)
+BATCH = _int_env('SNS_RESULT_BATCH', 25)
+FLUSH_BYTES = 8192
+
+
+class Results:
+    """Rows of `sources` read in order, at most `cap` of them.
+
+    sources: (tag, callable returning an iterable of rows) pairs; a source is
+    only opened once the ones before it are used up. Iterating yields lists
+    of rows (after `transform`, if given). Once iteration is over, `more`
+    tells whether rows were left, and `next_url` is `more_url(tag, last row)`
+    for the last row before the cap."""
+
+    def __init__(self, sources, cap=None, batch=None, transform=None, more_url=None):
+        self.sources = sources
+        self.cap = cap or CAP
+        self.batch = batch or BATCH
+        self.transform = transform
+        self.more_url = more_url
+        self.more = False
+        self.next_url = None
+        self.count = 0
+
+    def __iter__(self):
+        opened = []
+        try:
+            sources = iter(self.sources)
+            last = None
+            for tag, open_ in sources:
+                rows = open_()
+                opened.append(rows)
+                it = iter(rows)
+                while self.count < self.cap:
+                    chunk = list(islice(it, min(self.batch, self.cap - self.count)))
+                    if not chunk:
+                        break
+                    self.count += len(chunk)
+                    last = (tag, chunk[-1])
+                    if self.transform:
+                        chunk = self.transform(chunk)
+                    if chunk:
+                        yield chunk
+                if self.count >= self.cap:
+                    # is there anything past the cap, here or in a later source?
+                    self.more = next(it, None) is not None
+                    for _, open_ in sources:
+                        if self.more:
+                            break
+                        rows = open_()
+                        opened.append(rows)
+                        self.more = next(iter(rows), None) is not None
+                    break
+            if self.more and self.more_url and last:
+                self.next_url = self.more_url(*last)
+        finally:
+            # unfinished cursors would keep their read transaction open
+            for rows in opened:
+                close = getattr(rows, 'close', None)
+                if close:
+                    close()
+
+
+def buffered(chunks, size=None):
+    """Join the small strings a streamed template yields into writes of about `size` bytes."""
+    size = size or FLUSH_BYTES
+    buf, n = [], 0
+    for s in chunks:
+        buf.append(s)
+        n += len(s)
+        if n >= size:
+            yield ''.join(buf)
+            buf, n = [], 0
+    if buf:
+        yield ''.join(buf)
@@ -0,0 +1,101 @@
+"""Shop name autocomplete.
+
+An in-memory sorted list of (folded key, shop id) answers prefix queries with
+two bisects. Keys are folded so that width, case and katakana/hiragana do not
+matter ("ﾗｰﾒﾝ", "ラーメン" and "らーめん" are one key), and every word of a
+multi-word name is indexed too, so "ABC" finds "麺屋 ABC".
+
+The list is built on first use and then kept current incrementally: every
+query first indexes the shops created since the last one (id above the last
+seen), whichever worker process wrote them. Coordinates and counts are read
+from the shops table per query, so they are never stale, and the ranking
+(most posted first) is over every match of the prefix: up to MAX_CANDIDATES
+matches are ranked in one IN query, a broader prefix by walking the shops in
+popularity order until enough of them match.
+"""
+import re
+import bisect
+import threading
+import unicodedata
+
+MAX_CANDIDATES = 200
+
+_SEP = re.compile(r'[\s・･/／]+')
+_DROP = re.compile(r'[\s・･.,，、。\'"’”「」『』()（）\[\]【】!！?？&＆/／_-]+')
+
+
+def fold(text):
+    s = unicodedata.normalize('NFKC', text or '').casefold()
+    # katakana -> hiragana (ァ..ヶ); the long vowel mark ー is kept as is
+    s = ''.join(chr(ord(ch) - 0x60) if 'ァ' <= ch <= 'ヶ' else ch for ch in s)
+    return _DROP.sub('', s)
+
+
+def keys_for(name):
+    keys = {fold(name)}
+    words = [w for w in _SEP.split(unicodedata.normalize('NFKC', name or '')) if w]
+    if len(words) > 1:
+        keys.update(fold(w) for w in words)
+    keys.discard('')
+    return keys
+
+
+class ShopIndex:
+    def __init__(self):
+        self.entries = []   # sorted [(key, shop_id)]
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def refresh(self, db):
+        """Index shops created since the last call (ids only grow; writers are serialized)."""
+        with self.lock:
+            rows = db.execute('SELECT id, name FROM shops WHERE id > ? ORDER BY id', (self.last_id,)).fetchall()
+            if not rows:
+                return
+            new = [(k, r[0]) for r in rows for k in keys_for(r[1])]
+            if len(new) > 64:
+                self.entries = sorted(self.entries + new)
+            else:
+                for e in new:
+                    bisect.insort(self.entries, e)
+            self.last_id = rows[-1][0]
+
+    def lookup(self, prefix):
+        """Shop ids whose folded name (or a word of it) starts with prefix."""
+        p = fold(prefix)
+        if not p:
+            return []
+        with self.lock:
+            i = bisect.bisect_left(self.entries, (p,))
+            j = bisect.bisect_left(self.entries, (p + '\U0010ffff',))
+            ids = []
+            seen = set()
+            for _, sid in self.entries[i:j]:
+                if sid not in seen:
+                    seen.add(sid)
+                    ids.append(sid)
+        return ids
+
+
+_index = ShopIndex()
+
+
+def suggest(db, prefix, limit=10):
+    """Matching shops, most posted first, as dicts ready for JSON."""
+    _index.refresh(db)
+    ids = _index.lookup(prefix)
+    if not ids:
+        return []
+    cols = 'id, name, address, shop_category, lat, lng, post_count'
+    if len(ids) <= MAX_CANDIDATES:
+        rows = db.execute(f"SELECT {cols} FROM shops WHERE id IN ({','.join('?' * len(ids))}) AND post_count > 0 ORDER BY post_count DESC, name LIMIT ?", (*ids, limit)).fetchall()
+    else:
+        # a short prefix: most posted shops first (idx_shops_popular) until `limit` of them match
+        wanted = set(ids)
+        rows = []
+        for r in db.execute(f'SELECT {cols} FROM shops WHERE post_count > 0 ORDER BY post_count DESC, name'):
+            if r[0] in wanted:
+                rows.append(r)
+                if len(rows) >= limit:
+                    break
+    return [{'id': r[0], 'name': r[1], 'address': r[2], 'shop_category': r[3], 'lat': r[4], 'lng': r[5], 'posts': r[6]} for r in rows]
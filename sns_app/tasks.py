@@ -0,0 +1,129 @@
+"""Tiny in-process background task runner.
+
+A single daemon thread drains a queue of callables. Submitting a key that is
+still pending is a no-op, so bursts (e.g. many moves in one list) collapse
+into one run. `every()` registers periodic jobs on the same thread.
+Jobs must open their own DB connection; exceptions are logged and dropped.
+
+Periodic jobs must run in one process only. A forked worker calls
+after_fork(), which drops the jobs it inherited (the parent keeps running
+them). Processes started on their own (uvicorn workers, several run.py)
+each register the jobs; with scheduler_lock(path) set, only the one holding
+an flock on that file runs them, and another takes over when it exits
+(POSIX only; elsewhere every process runs them).
+"""
+import os
+import sys
+import time
+import queue
+import threading
+import traceback
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+_q = queue.Queue()
+_pending = set()
+_periodic = []
+_lock = threading.Lock()
+_thread = None
+_lock_path = None
+_lock_fd = None
+
+
+def _run(key, fn, args):
+    try:
+        fn(*args)
+    except Exception:
+        print(f'[tasks] {key!r} failed', file=sys.stderr)
+        traceback.print_exc()
+
+
+def _loop():
+    while True:
+        timeout = 1.0
+        if _periodic:
+            timeout = max(0.0, min(job['next'] for job in _periodic) - time.time())
+        try:
+            key, fn, args = _q.get(timeout=timeout)
+        except queue.Empty:
+            key = None
+        if key is not None:
+            with _lock:
+                _pending.discard(key)
+            _run(key, fn, args)
+        now = time.time()
+        for job in list(_periodic):
+            if job['next'] <= now:
+                job['next'] = now + job['interval']
+                if _is_scheduler():
+                    _run(job['key'], job['fn'], ())
+
+
+def _is_scheduler():
+    global _lock_fd
+    if _lock_path is None or fcntl is None or _lock_fd is not None:
+        return True
+    try:
+        fd = os.open(_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    # kept open (and locked) for the life of the process
+    _lock_fd = fd
+    return True
+
+
+def _ensure_thread():
+    global _thread
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_loop, name='sns-tasks', daemon=True)
+            _thread.start()
+
+
+def submit(key, fn, *args):
+    """Queue fn(*args) unless a job with the same key is already waiting."""
+    with _lock:
+        if key in _pending:
+            return False
+        _pending.add(key)
+    _q.put((key, fn, args))
+    _ensure_thread()
+    return True
+
+
+def every(interval, fn, key=None):
+    """Run fn() roughly every `interval` seconds (first run after one interval)."""
+    key = key or getattr(fn, '__name__', repr(fn))
+    with _lock:
+        if any(job['key'] == key for job in _periodic):
+            return
+        _periodic.append({'key': key, 'fn': fn, 'interval': interval, 'next': time.time() + interval})
+    _ensure_thread()
+
+
+def scheduler_lock(path):
+    """Run periodic jobs only in the process holding an flock on `path`."""
+    global _lock_path
+    _lock_path = path
+
+
+def after_fork():
+    """Forget the parent's queue, thread and periodic jobs in a forked child."""
+    global _q, _lock, _thread, _lock_fd
+    _q = queue.Queue()
+    _lock = threading.Lock()
+    _thread = None
+    _pending.clear()
+    del _periodic[:]
+    if _lock_fd is not None:
+        # the parent's flock stays with the parent
+        os.close(_lock_fd)
+        _lock_fd = None
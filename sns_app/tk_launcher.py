@@ -3,10 +3,12 @@ import os
 import subprocess
 import webbrowser
 import threading
-import queue
 import time
+import json
 import urllib.request
 import urllib.error
+from collections import deque
+from itertools import islice
 import tkinter as tk
 
 HERE = os.path.dirname(os.path.abspath(__file__))
@@ -14,12 +16,18 @@ PY = sys.executable
 PROJECT_ROOT = os.path.dirname(HERE)
 PORT = int(os.environ.get('SNS_PORT', '5000'))
 BASE_URL = f'http://127.0.0.1:{PORT}'
+LOG_LINES = 20000      # server output kept by the launcher (oldest lines are dropped)
+VISIBLE_LINES = 500    # lines the log view holds at once
 
 
 class ServerManager:
     def __init__(self):
         self.proc = None
-        self._q = queue.Queue()
+        # ring buffer of (seq, tag, line). The reader threads never wait on it:
+        # a blocked reader would fill the pipe and stall the server's writes
+        self.logs = deque(maxlen=LOG_LINES)
+        self.seq = 0
+        self._lock = threading.Lock()
         self._threads = []
 
     def start(self):
@@ -48,19 +56,24 @@ class ServerManager:
             for line in iter(stream.readline, ''):
                 if not line:
                     break
-                self._q.put((tag, line.rstrip('\n')))
+                if '/metrics.json' in line:
+                    # access log of the launcher's own polling
+                    continue
+                with self._lock:
+                    self.seq += 1
+                    self.logs.append((self.seq, tag, line.rstrip('\n')))
         except Exception:
             pass
 
-    def read_logs(self):
-        lines = []
-        while True:
-            try:
-                item = self._q.get_nowait()
-            except queue.Empty:
-                break
-            lines.append(item)
-        return lines
+    def read_logs(self, after=0):
+        """Buffered lines with a sequence number above `after`, oldest first."""
+        with self._lock:
+            n = min(len(self.logs), self.seq - after)
+            return list(islice(self.logs, len(self.logs) - n, None)) if n > 0 else []
+
+    def dropped(self):
+        with self._lock:
+            return self.seq - len(self.logs)
 
     def stop(self):
         if not self.proc:
@@ -82,13 +95,46 @@ class ServerManager:
         return self.proc is not None and self.proc.poll() is None
 
 
-def health_check(timeout=0.5):
-    url = f'{BASE_URL}/health'
+def fetch_metrics(timeout=0.5):
+    # /metrics.json of the running server; None while it is not answering
+    url = f'{BASE_URL}/metrics.json'
     try:
         with urllib.request.urlopen(url, timeout=timeout) as r:
-            return r.status == 200
+            if r.status != 200:
+                return None
+            return json.loads(r.read().decode('utf-8'))
     except Exception:
-        return False
+        return None
+
+
+class MetricsPoller:
+    # polls /metrics.json from a background thread so a slow server never freezes the UI
+    def __init__(self, mgr, interval=1.0):
+        self.mgr = mgr
+        self.interval = interval
+        self.latest = None
+        self.stopped = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.latest = fetch_metrics(timeout=0.8) if self.mgr.is_running() else None
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def format_metrics(m):
+    if not m:
+        return '-'
+    lat = m.get('latency_ms') or {}
+    db = m.get('db') or {}
+    ms = lambda v: '-' if v is None else f'{v:g}'
+    return (f"リクエスト/秒: {m['rps_10s']:g} (10秒) / {m['rps_60s']:g} (60秒)   合計 {m['requests']}  エラー {m['errors']}\n"
+            f"レイテンシ(ms): p50 {ms(lat.get('p50'))} / p90 {ms(lat.get('p90'))} / p99 {ms(lat.get('p99'))} / max {ms(lat.get('max'))}  (直近 {lat.get('samples', 0)} 件)\n"
+            f"DB接続: 使用中 {db.get('open', 0)}  累計 {db.get('opened', 0)}  接続時間 {ms(db.get('avg_connect_ms'))} ms   "
+            f"スレッド {m.get('threads', '-')}  稼働 {int(m.get('uptime', 0))} 秒")
 
 
 def open_browser():
@@ -97,10 +143,11 @@ def open_browser():
 
 def main():
     mgr = ServerManager()
+    poller = MetricsPoller(mgr)
 
     root = tk.Tk()
     root.title('Mini SNS Launcher')
-    root.geometry('640x420')
+    root.geometry('760x560')
 
     top = tk.Frame(root, padx=12, pady=8)
     top.pack(fill='x')
@@ -134,14 +181,64 @@ def main():
     btn_stop = tk.Button(btn_frame, text='サーバ停止', width=16, command=stop_cb)
     btn_stop.pack(side='left', padx=6)
 
-    # Log area
-    log_label = tk.Label(root, text='サーバログ')
-    log_label.pack(anchor='w', padx=12)
-    log_text = tk.Text(root, height=14, wrap='none')
-    log_text.pack(fill='both', expand=True, padx=12, pady=(0,12))
+    # Live performance panel (/metrics.json)
+    perf = tk.LabelFrame(root, text='パフォーマンス', padx=8, pady=4)
+    perf.pack(fill='x', padx=12, pady=(0, 8))
+    metrics_var = tk.StringVar(value='-')
+    tk.Label(perf, textvariable=metrics_var, justify='left', anchor='w', font=('Consolas', 9)).pack(fill='x')
+
+    # Log area: the last VISIBLE_LINES lines of the ring buffer that match the filter
+    log_bar = tk.Frame(root, padx=12)
+    log_bar.pack(fill='x')
+    tk.Label(log_bar, text='サーバログ').pack(side='left')
+    filter_var = tk.StringVar()
+    err_only = tk.BooleanVar(value=False)
+    log_info = tk.StringVar()
+    tk.Label(log_bar, textvariable=log_info).pack(side='right')
+    tk.Checkbutton(log_bar, text='ERRのみ', variable=err_only).pack(side='right')
+    tk.Entry(log_bar, textvariable=filter_var, width=24).pack(side='right', padx=6)
+    tk.Label(log_bar, text='絞り込み:').pack(side='right')
+    log_frame = tk.Frame(root)
+    log_frame.pack(fill='both', expand=True, padx=12, pady=(0, 12))
+    log_scroll = tk.Scrollbar(log_frame)
+    log_scroll.pack(side='right', fill='y')
+    log_text = tk.Text(log_frame, height=14, wrap='none', yscrollcommand=log_scroll.set)
+    log_text.pack(side='left', fill='both', expand=True)
+    log_scroll.config(command=log_text.yview)
+    log_text.tag_config('ERR', foreground='#b00020')
+    last_seq = [0]
+
+    def matches(tag, line):
+        if err_only.get() and tag != 'ERR':
+            return False
+        needle = filter_var.get().strip().lower()
+        return not needle or needle in line.lower()
+
+    def show(lines, replace=False):
+        # append (at most VISIBLE_LINES of a flood), then trim the widget back to VISIBLE_LINES
+        at_end = log_text.yview()[1] >= 0.999
+        if replace:
+            log_text.delete('1.0', 'end')
+        for tag, line in lines[-VISIBLE_LINES:]:
+            log_text.insert('end', f'[{tag}] {line}\n', (tag,))
+        excess = int(log_text.index('end-1c').split('.')[0]) - 1 - VISIBLE_LINES
+        if excess > 0:
+            log_text.delete('1.0', f'{excess + 1}.0')
+        if at_end or replace:
+            log_text.see('end')
+        log_info.set(f'保持 {len(mgr.logs)} 行 / 破棄 {mgr.dropped()} 行')
+
+    def refilter(*_):
+        items = mgr.read_logs()
+        if items:
+            last_seq[0] = items[-1][0]
+        show([(tag, line) for _, tag, line in items if matches(tag, line)], replace=True)
+
+    filter_var.trace_add('write', refilter)
+    err_only.trace_add('write', refilter)
 
     def poll_health():
-        if mgr.is_running() and health_check(timeout=0.3):
+        if mgr.is_running() and poller.latest is not None:
             status_var.set('サーバ: 起動中 (ready)')
             btn_open.config(state='normal')
         else:
@@ -154,13 +251,20 @@ def main():
                 btn_open.config(state='disabled')
 
     def poll_logs_periodic():
-        for tag, line in mgr.read_logs():
-            t = f'[{tag}] {line}\n'
-            log_text.insert('end', t)
-            log_text.see('end')
+        items = mgr.read_logs(last_seq[0])
+        if items:
+            last_seq[0] = items[-1][0]
+            lines = [(tag, line) for _, tag, line in items if matches(tag, line)]
+            if lines:
+                show(lines)
         root.after(200, poll_logs_periodic)
 
+    def poll_metrics():
+        metrics_var.set(format_metrics(poller.latest))
+        root.after(1000, poll_metrics)
+
     def on_close():
+        poller.stop()
         try:
             mgr.stop()
         except Exception:
@@ -169,6 +273,7 @@ def main():
 
     root.protocol('WM_DELETE_WINDOW', on_close)
     root.after(200, poll_logs_periodic)
+    root.after(1000, poll_metrics)
     root.mainloop()
 
 
@@ -0,0 +1,98 @@
+"""Time-decayed "hot" scores for the trending feed.
+
+Every post carries `posts.hot_score`; a like adds exp((t - epoch) / TAU) to it
+and a new post starts with POST_WEIGHT of the same. Because every increment
+is scaled by the same growing factor, `ORDER BY hot_score DESC` always equals
+the order of the exponentially decayed like counts, without touching old
+rows. `rebase()` (periodic, see REBASE_INTERVAL) multiplies all scores down
+and moves the epoch to now so the numbers stay small; scores that decayed to
+nothing are zeroed so they fall out of the trending indexes.
+
+Environment:
+  SNS_TRENDING_HALF_LIFE_HOURS  hours after which a like counts half (default 24)
+"""
+import os
+import math
+import time
+from datetime import datetime, timezone
+
+HALF_LIFE_HOURS = float(os.environ.get('SNS_TRENDING_HALF_LIFE_HOURS', '24') or 24)
+TAU = HALF_LIFE_HOURS * 3600 / math.log(2)
+REBASE_INTERVAL = 3600
+POST_WEIGHT = 1.0   # a new post counts like one like
+LIKE_WEIGHT = 1.0
+FLOOR = 1e-4        # decayed scores below this are dropped to 0
+
+
+def create_tables(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS trending_state (id INTEGER PRIMARY KEY CHECK (id = 1), epoch REAL NOT NULL)')
+    conn.execute('INSERT OR IGNORE INTO trending_state (id, epoch) VALUES (1, ?)', (time.time(),))
+
+
+def create_indexes(conn):
+    # one index per trending list: all posts, per category, per shop subcategory
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_hot ON posts(hot_score DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_category_hot ON posts(category, hot_score DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_shop_category_hot ON posts(shop_category, hot_score DESC, id DESC) WHERE category = 'shop_intro'")
+
+
+def epoch(db):
+    row = db.execute('SELECT epoch FROM trending_state WHERE id = 1').fetchone()
+    return row[0] if row else time.time()
+
+
+def weight(db, w, ts=None):
+    ts = time.time() if ts is None else ts
+    return w * math.exp((ts - epoch(db)) / TAU)
+
+
+def add(db, post_id, w):
+    """Add w (now) to a post's score inside the caller's transaction.
+
+    Call it after the transaction's first write, so a concurrent rebase
+    cannot move the epoch between reading it and updating the score.
+    """
+    db.execute('UPDATE posts SET hot_score = COALESCE(hot_score, 0) + ? WHERE id = ?', (weight(db, w), post_id))
+
+
+def _timestamp(created_at):
+    try:
+        return datetime.fromisoformat(created_at).replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def backfill(conn):
+    """Score posts without a hot_score; likes are assumed to be as old as the post."""
+    e = epoch(conn)
+    rows = conn.execute('SELECT id, created_at, likes FROM posts WHERE hot_score IS NULL').fetchall()
+    updates = []
+    for post_id, created_at, likes in rows:
+        ts = _timestamp(created_at)
+        score = 0.0
+        if ts is not None:
+            x = (min(ts, time.time()) - e) / TAU
+            score = (POST_WEIGHT + (likes or 0) * LIKE_WEIGHT) * math.exp(x) if x > -50 else 0.0
+        updates.append((score, post_id))
+    conn.executemany('UPDATE posts SET hot_score = ? WHERE id = ?', updates)
+    return len(updates)
+
+
+def rebase(conn, force=False):
+    """Decay all scores to the current time and move the epoch; returns True if it ran."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        now = time.time()
+        e = epoch(conn)
+        if not force and now - e < REBASE_INTERVAL:
+            conn.rollback()
+            return False
+        factor = math.exp(-(now - e) / TAU)
+        conn.execute('UPDATE posts SET hot_score = CASE WHEN hot_score * ? < ? THEN 0 ELSE hot_score * ? END WHERE hot_score > 0',
+                     (factor, FLOOR, factor))
+        conn.execute('UPDATE trending_state SET epoch = ? WHERE id = 1', (now,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
@@ -0,0 +1,32 @@
+import os
+import sys
+import importlib
+
+import pytest
+
+# tests import the package as `sns_app`, from a checkout (no install step)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+sns = importlib.import_module('sns_app.app')  # the module; sns_app.app is also the Flask app
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    # the app on a fresh database in tmp_path
+    monkeypatch.setattr(sns, 'DB_PATH', str(tmp_path / 'sns.db'))
+    monkeypatch.setattr(sns, 'ARCHIVE_DB_PATH', str(tmp_path / 'sns_archive.db'))
+    monkeypatch.setattr(sns, 'TASKS_LOCK_PATH', str(tmp_path / 'sns_tasks.lock'))
+    monkeypatch.setattr(sns, '_db_initialized', False)
+    # the notify thread outlives the test and would write through the restored DB_PATH
+    monkeypatch.setattr(sns.notify, '_connect', None)
+    monkeypatch.setattr(sns, 'admission_limiter', sns.ratelimit.Limiter(1000, 100000))
+    monkeypatch.setitem(sns.app.config, 'WTF_CSRF_ENABLED', False)
+    client = sns.app.test_client()
+    client.get('/')
+    conn = sns.connect_db()
+    conn.execute("INSERT INTO users (username, password_hash, email, is_verified) VALUES ('@alice', 'x', 'a@example.com', 1)")
+    conn.commit()
+    with client.session_transaction() as s:
+        s['user_id'] = 1
+    yield client, conn
+    conn.close()
@@ -0,0 +1,44 @@
+import pytest
+
+
+@pytest.fixture
+def premium(site):
+    client, conn = site
+    conn.execute('UPDATE users SET is_premium = 1 WHERE id = 1')
+    ids = [conn.execute("INSERT INTO posts (user_id, content, image, created_at) VALUES (1, ?, 'x.jpg', ?)", (f'p{i}', f'2026-01-0{i + 1}')).lastrowid
+           for i in range(3)]
+    conn.commit()
+    return client, conn, ids
+
+
+def order(conn):
+    return [r[0] for r in conn.execute('SELECT post_id FROM bookmarks WHERE user_id = 1 ORDER BY rank_key')]
+
+
+def test_move_between_neighbours(premium):
+    client, conn, ids = premium
+    for pid in ids:
+        client.post(f'/bookmark/{pid}')
+    first = order(conn)
+    r = client.post('/bookmarks/reorder', json={'post_id': first[2], 'after': None, 'before': first[0]})
+    assert r.status_code == 200
+    assert order(conn) == [first[2], first[0], first[1]]
+
+
+def test_move_without_neighbours_is_refused(premium):
+    client, conn, ids = premium
+    for pid in ids:
+        client.post(f'/bookmark/{pid}')
+    before = order(conn)
+    for body in ({'post_id': before[0]}, {'post_id': before[0], 'after': None, 'before': None}):
+        r = client.post('/bookmarks/reorder', json=body)
+        assert r.status_code == 400 and r.json['error'] == 'bad_move'
+    assert order(conn) == before
+
+
+def test_move_of_the_only_bookmark_needs_no_neighbours(premium):
+    client, conn, ids = premium
+    client.post(f'/bookmark/{ids[0]}')
+    r = client.post('/bookmarks/reorder', json={'post_id': ids[0], 'after': None, 'before': None})
+    assert r.status_code == 200
+    assert order(conn) == [ids[0]]
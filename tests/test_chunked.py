@@ -0,0 +1,162 @@
+import os
+import hashlib
+
+import pytest
+
+from sns_app import chunked
+from sns_app.chunked import ChunkError
+
+CHUNK = chunked.MIN_CHUNK_BYTES
+
+
+@pytest.fixture
+def staging(tmp_path):
+    return chunked.Staging(str(tmp_path / 'staging'))
+
+
+def payload(size):
+    return bytes((i * 7 + i // 251) % 256 for i in range(size))
+
+
+def chunks_of(data):
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def start(staging, data):
+    return staging.create(1, 'post', 'image/jpeg', 'jpg', len(data), chunk_size=CHUNK)['id']
+
+
+def session_dir(staging, upload_id):
+    return os.path.join(staging.root, '1', upload_id)
+
+
+def test_chunks_in_order_assemble_the_file(staging):
+    data = payload(CHUNK * 2 + 1000)
+    upload_id = start(staging, data)
+    for index, chunk in enumerate(chunks_of(data)):
+        status = staging.append(1, upload_id, index, chunk, hashlib.sha256(chunk).hexdigest())
+        assert status['next_index'] == index + 1
+    assert status['complete'] and status['received'] == len(data)
+    meta, path = staging.finalize(1, upload_id, hashlib.sha256(data).hexdigest())
+    assert meta['size'] == len(data)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_retried_chunk_is_accepted_without_appending_twice(staging):
+    data = payload(CHUNK * 2)
+    upload_id = start(staging, data)
+    first = chunks_of(data)[0]
+    staging.append(1, upload_id, 0, first)
+    status = staging.append(1, upload_id, 0, first)
+    assert status['next_index'] == 1 and status['received'] == CHUNK
+
+
+def test_retried_chunk_with_other_bytes_is_refused(staging):
+    data = payload(CHUNK * 2)
+    upload_id = start(staging, data)
+    staging.append(1, upload_id, 0, chunks_of(data)[0])
+    with pytest.raises(ChunkError) as e:
+        staging.append(1, upload_id, 0, bytes(CHUNK))
+    assert str(e.value) == 'chunk_mismatch' and e.value.status == 409
+
+
+def test_out_of_order_chunk_reports_where_to_continue(staging):
+    data = payload(CHUNK * 3)
+    upload_id = start(staging, data)
+    staging.append(1, upload_id, 0, chunks_of(data)[0])
+    with pytest.raises(ChunkError) as e:
+        staging.append(1, upload_id, 2, chunks_of(data)[2])
+    assert str(e.value) == 'out_of_order' and e.value.status == 409
+    assert e.value.info['next_index'] == 1
+
+
+def test_chunk_checksum_and_size_are_checked(staging):
+    data = payload(CHUNK * 2)
+    upload_id = start(staging, data)
+    with pytest.raises(ChunkError) as e:
+        staging.append(1, upload_id, 0, chunks_of(data)[0], '0' * 64)
+    assert str(e.value) == 'checksum_mismatch' and e.value.status == 400
+    with pytest.raises(ChunkError) as e:
+        staging.append(1, upload_id, 0, data[:100])
+    assert str(e.value) == 'bad_chunk_size' and e.value.info['expected'] == CHUNK
+
+
+def test_no_chunk_after_the_last_one(staging):
+    data = payload(CHUNK)
+    upload_id = start(staging, data)
+    staging.append(1, upload_id, 0, data)
+    with pytest.raises(ChunkError) as e:
+        staging.append(1, upload_id, 1, b'x')
+    assert str(e.value) == 'complete'
+
+
+def test_finalize_needs_every_chunk(staging):
+    data = payload(CHUNK * 2)
+    upload_id = start(staging, data)
+    staging.append(1, upload_id, 0, chunks_of(data)[0])
+    with pytest.raises(ChunkError) as e:
+        staging.finalize(1, upload_id)
+    assert str(e.value) == 'incomplete' and e.value.info['next_index'] == 1
+
+
+def test_finalize_detects_changed_bytes_and_wrong_file_checksum(staging):
+    data = payload(CHUNK * 2)
+    upload_id = start(staging, data)
+    for index, chunk in enumerate(chunks_of(data)):
+        staging.append(1, upload_id, index, chunk)
+    with pytest.raises(ChunkError) as e:
+        staging.finalize(1, upload_id, '0' * 64)
+    assert str(e.value) == 'checksum_mismatch' and e.value.status == 422
+    with open(os.path.join(session_dir(staging, upload_id), 'data'), 'r+b') as f:
+        f.seek(CHUNK + 10)
+        f.write(b'\xff\x00')
+    with pytest.raises(ChunkError) as e:
+        staging.finalize(1, upload_id)
+    assert str(e.value) == 'corrupt' and e.value.info['index'] == 1
+
+
+def test_append_recovers_from_an_interrupted_chunk(staging):
+    # the bytes of chunk 1 reached the data file but its log line was torn
+    data = payload(CHUNK * 2 + 10)
+    upload_id = start(staging, data)
+    parts = chunks_of(data)
+    staging.append(1, upload_id, 0, parts[0])
+    d = session_dir(staging, upload_id)
+    with open(os.path.join(d, 'data'), 'ab') as f:
+        f.write(parts[1][:1000])
+    with open(os.path.join(d, 'chunks'), 'a') as f:
+        f.write('1 655')
+    assert staging.status(1, upload_id)['next_index'] == 1
+    staging.append(1, upload_id, 1, parts[1])
+    staging.append(1, upload_id, 2, parts[2])
+    _, path = staging.finalize(1, upload_id)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_sessions_per_user_are_limited(staging):
+    for _ in range(chunked.MAX_SESSIONS):
+        staging.create(1, 'post', 'image/jpeg', 'jpg', 10)
+    with pytest.raises(ChunkError) as e:
+        staging.create(1, 'post', 'image/jpeg', 'jpg', 10)
+    assert str(e.value) == 'too_many_uploads' and e.value.status == 429
+    staging.create(2, 'post', 'image/jpeg', 'jpg', 10)
+
+
+def test_unknown_or_foreign_session_is_not_found(staging):
+    upload_id = start(staging, payload(10))
+    for user_id, name in ((1, 'nope'), (1, '../1'), (2, upload_id)):
+        with pytest.raises(ChunkError) as e:
+            staging.status(user_id, name)
+        assert e.value.status == 404
+
+
+def test_discard_and_expire_remove_sessions(staging):
+    kept = start(staging, payload(10))
+    dropped = start(staging, payload(10))
+    staging.discard(1, dropped)
+    assert not os.path.exists(session_dir(staging, dropped))
+    assert staging.expire() == 0
+    assert staging.expire(ttl=-1) == 1
+    assert not os.path.exists(session_dir(staging, kept))
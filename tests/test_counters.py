@@ -0,0 +1,98 @@
+import importlib
+
+import pytest
+
+from sns_app import archive, counters
+
+sns = importlib.import_module('sns_app.app')
+
+
+def add_post(conn, category, created_at, user_id=1):
+    # as post() does: the row and its counters in one transaction
+    cur = conn.execute('INSERT INTO posts (user_id, content, image, category, created_at) VALUES (?, ?, ?, ?, ?)',
+                       (user_id, 'x', 'x.jpg', category, created_at))
+    counters.bump(conn, counters.post_keys(user_id, category), 1)
+    conn.commit()
+    return cur.lastrowid
+
+
+def drift(conn):
+    return counters.reconcile(conn, fix=False)
+
+
+def test_archiving_keeps_the_counts(site):
+    client, conn = site
+    for i in range(6):
+        add_post(conn, ('food_photo', 'recipe_intro')[i % 2], f'2020-01-0{i + 1}T00:00:00')
+    add_post(conn, 'food_photo', '2999-01-01T00:00:00')
+    sns.archive_posts()
+    assert conn.execute('SELECT COUNT(*) FROM archive.posts').fetchone()[0] == 6
+    assert drift(conn) == []
+    assert counters.get(conn, 'posts') == 7
+    assert counters.get(conn, 'posts:cat:recipe_intro') == 3
+
+
+@pytest.mark.parametrize('created_at', ['2020-01-01T00:00:00', '2999-01-01T00:00:00'], ids=['archived', 'live'])
+def test_delete_keeps_the_counts(site, created_at):
+    client, conn = site
+    post_id = add_post(conn, 'recipe_intro', created_at)
+    add_post(conn, 'food_photo', created_at)
+    sns.archive_posts()
+    assert client.post(f'/delete/{post_id}').status_code == 302
+    assert archive.holder(conn, post_id) is None
+    assert drift(conn) == []
+    assert counters.get(conn, 'posts') == 1
+    assert counters.get(conn, 'posts:cat:recipe_intro') == 0
+
+
+def test_like_and_category_edit_of_an_archived_post_keep_the_counts(site):
+    client, conn = site
+    post_id = add_post(conn, 'food_photo', '2020-01-01T00:00:00')
+    sns.archive_posts()
+    client.post(f'/like/{post_id}')
+    client.post(f'/edit/{post_id}', data={'content': 'y', 'category': 'recipe_intro'})
+    assert tuple(conn.execute('SELECT likes, category FROM archive.posts WHERE id = ?', (post_id,)).fetchone()) == (1, 'recipe_intro')
+    assert archive.holder(conn, post_id) == 'archive.posts'
+    assert drift(conn) == []
+    assert counters.get(conn, 'posts:cat:recipe_intro') == 1
+
+
+def test_reconcile_repairs_drift(site):
+    client, conn = site
+    add_post(conn, 'food_photo', '2020-01-01T00:00:00')
+    sns.archive_posts()
+    counters.bump(conn, ['posts', 'posts:user:1'], 2)
+    conn.commit()
+    assert drift(conn) == [('posts', 3, 1), ('posts:user:1', 3, 1)]
+    counters.reconcile(conn)
+    assert drift(conn) == []
+
+
+def test_shop_recount_includes_archived_posts(site):
+    client, conn = site
+    shop_id = sns.shops.resolve(conn, '食堂', '東京都港区1-1', '和食', None, None, None, None, None, None)
+    for created_at, likes in (('2020-01-01T00:00:00', 2), ('2999-01-01T00:00:00', 3)):
+        conn.execute("INSERT INTO posts (user_id, content, category, shop_name, shop_id, likes, created_at) VALUES (1, 'x', 'shop_intro', '食堂', ?, ?, ?)",
+                     (shop_id, likes, created_at))
+    conn.commit()
+    sns.archive_posts()
+    sns.shops.recount(conn)
+    assert tuple(conn.execute('SELECT post_count, likes FROM shops WHERE id = ?', (shop_id,)).fetchone()) == (2, 5)
+
+
+def test_requests_attach_the_archive_once_it_has_posts(site):
+    client, conn = site
+    post_id = add_post(conn, 'food_photo', '2020-01-01T00:00:00')
+    with sns.app.test_request_context():
+        db = sns.get_db()
+        assert not archive.attached(db)
+        assert archive.holder(db, post_id) == 'main.posts'
+        assert db.execute('SELECT COUNT(*) FROM all_posts').fetchone()[0] == 1
+    sns.archive_posts()
+    with sns.app.test_request_context():
+        db = sns.get_db()
+        assert archive.attached(db)
+        assert archive.holder(db, post_id) == 'archive.posts'
+        assert db.execute('SELECT COUNT(*) FROM all_posts').fetchone()[0] == 1
+    assert client.get('/notifications').status_code == 200
+    assert client.get('/search?q=x&archived=1').status_code == 200
@@ -0,0 +1,19 @@
+import socket
+import importlib
+
+sns = importlib.import_module('sns_app.app')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_events_without_a_hub_is_a_204_not_a_redirect(site, monkeypatch):
+    client, conn = site
+    monkeypatch.setenv('SNS_EVENTS_HOST', '127.0.0.1')
+    monkeypatch.setenv('SNS_EVENTS_PORT', str(free_port()))
+    r = client.get('/events')
+    assert r.status_code == 204
+    assert 'Location' not in r.headers
@@ -0,0 +1,32 @@
+import io
+import importlib
+
+from PIL import Image
+
+sns = importlib.import_module('sns_app.app')
+
+
+def food_photo():
+    buf = io.BytesIO()
+    Image.new('RGB', (300, 300), (200, 90, 40)).save(buf, 'PNG')
+    buf.seek(0)
+    return buf
+
+
+def test_failed_ingest_leaves_no_files(site, tmp_path, monkeypatch):
+    client, conn = site
+    uploads = tmp_path / 'uploads'
+    thumbs = uploads / 'thumbs'
+    thumbs.mkdir(parents=True)
+    monkeypatch.setattr(sns, 'UPLOAD_DIR', str(uploads))
+    monkeypatch.setattr(sns, 'THUMB_DIR', str(thumbs))
+
+    def broken(img):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(sns.images, 'describe', broken)
+    r = client.post('/post', data={'content': 'x', 'category': 'food_photo', 'image': (food_photo(), 'a.png')})
+    assert r.status_code == 302
+    assert sorted(p.name for p in uploads.iterdir()) == ['thumbs']
+    assert list(thumbs.iterdir()) == []
+    assert conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0] == 0
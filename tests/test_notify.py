@@ -0,0 +1,17 @@
+import importlib
+
+from sns_app import notify
+
+sns = importlib.import_module('sns_app.app')
+
+
+def test_likes_and_bookmarks_of_an_archived_post_notify_the_owner(site):
+    client, conn = site
+    conn.execute("INSERT INTO users (username, password_hash, email, is_verified) VALUES ('@bob', 'x', 'b@example.com', 1)")
+    post_id = conn.execute("INSERT INTO posts (user_id, content, category, created_at) VALUES (1, 'x', 'food_photo', '2020-01-01T00:00:00')").lastrowid
+    conn.commit()
+    sns.archive_posts()
+    with conn:
+        notify._write(conn, [('like', post_id, 2, None, '2026-01-01T00:00:00'), ('bookmark', post_id, 2, None, '2026-01-01T00:00:01')])
+    rows = conn.execute('SELECT kind, post_id, actor_id FROM notifications WHERE user_id = 1 ORDER BY kind').fetchall()
+    assert [tuple(r) for r in rows] == [('bookmark', post_id, 2), ('like', post_id, 2)]
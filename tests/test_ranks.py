@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from sns_app import ranks
+
+
+def check(a, key, b):
+    assert (a is None or a < key) and (b is None or key < b)
+    assert not key.endswith('0')
+
+
+def test_key_between_open_ends():
+    first = ranks.key_between(None, None)
+    check(None, first, None)
+    check(None, ranks.key_between(None, first), first)
+    check(first, ranks.key_between(first, None), None)
+
+
+@pytest.mark.parametrize('a, b', [('1', '2'), ('V', 'W'), ('z', 'zz'), ('A', 'A1'), ('A0001', 'A001'), ('zzzy', 'zzzz'), (None, '01'), (None, '001')])
+def test_key_between_close_neighbours(a, b):
+    check(a, ranks.key_between(a, b), b)
+
+
+def test_key_between_refuses_out_of_order_neighbours():
+    with pytest.raises(ValueError):
+        ranks.key_between('B', 'A')
+    with pytest.raises(ValueError):
+        ranks.key_between('B', 'B')
+
+
+def test_repeated_inserts_at_one_place_keep_the_order():
+    # always in front, always at the end, always right after the first key
+    for pick in (lambda keys: (None, keys[0]), lambda keys: (keys[-1], None), lambda keys: (keys[0], keys[1])):
+        keys = [ranks.key_between(None, None), ranks.key_after(ranks.key_between(None, None))]
+        for _ in range(200):
+            a, b = pick(keys)
+            key = ranks.key_between(a, b)
+            check(a, key, b)
+            keys = sorted(keys + [key])
+        assert len(set(keys)) == len(keys)
+
+
+def test_random_moves_match_a_plain_list():
+    rnd = random.Random(7)
+    expected = []
+    keyed = {}
+    for item in range(300):
+        pos = rnd.randint(0, len(expected))
+        a = keyed[expected[pos - 1]] if pos else None
+        b = keyed[expected[pos]] if pos < len(expected) else None
+        keyed[item] = ranks.key_between(a, b)
+        check(a, keyed[item], b)
+        expected.insert(pos, item)
+    assert sorted(keyed, key=keyed.get) == expected
+
+
+def test_spread_keys_are_ordered_and_leave_room_at_the_end():
+    for n in (1, 2, 10, 61, 62, 1000):
+        keys = ranks.spread_keys(n)
+        assert len(keys) == n and keys == sorted(set(keys))
+        assert all(k and not k.endswith('0') for k in keys)
+        assert keys[-1] < ranks.key_after(None)
+        check(None, ranks.key_between(None, keys[0]), keys[0])
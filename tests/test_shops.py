@@ -0,0 +1,35 @@
+import importlib
+
+from sns_app import shops
+
+sns = importlib.import_module('sns_app.app')
+
+
+def test_within_keeps_the_nearest(site):
+    client, conn = site
+    for i in range(8):
+        shops.resolve(conn, f'店{i}', f'東京都港区{i}-1', lat=35.0 + (7 - i) * 0.001, lng=139.0)
+    shops.resolve(conn, '遠い店', '大阪府大阪市1-1', lat=34.7, lng=135.5)
+    conn.commit()
+    everything = shops.within(conn, 35.0, 139.0, 2)
+    assert [r['name'] for r, _ in everything] == [f'店{i}' for i in range(7, -1, -1)]
+    assert shops.within(conn, 35.0, 139.0, 2, limit=3) == everything[:3]
+
+
+def test_like_rescores_the_shop_tiles_in_a_job(site, monkeypatch):
+    client, conn = site
+    jobs = []
+    monkeypatch.setattr(sns.tasks, 'submit', lambda key, fn, *args: jobs.append((key, fn, args)))
+    shop_id = shops.resolve(conn, '食堂', '東京都港区1-1', lat=35.0, lng=139.0)
+    post_id = conn.execute("INSERT INTO posts (user_id, content, category, shop_name, shop_id, created_at) VALUES (1, 'x', 'shop_intro', '食堂', ?, '2999-01-01T00:00:00')",
+                           (shop_id,)).lastrowid
+    shops.bump(conn, shop_id, posts=1)
+    conn.commit()
+    for _ in range(2):
+        client.post(f'/like/{post_id}')
+    assert conn.execute('SELECT likes FROM shops WHERE id = ?', (shop_id,)).fetchone()[0] == 2
+    assert {r[0] for r in conn.execute('SELECT top_score FROM shop_tiles')} == {1}
+    assert [key for key, _, _ in jobs] == [('rescore_shop', shop_id)] * 2
+    key, fn, args = jobs[0]
+    fn(*args)
+    assert {r[0] for r in conn.execute('SELECT top_score FROM shop_tiles')} == {3}
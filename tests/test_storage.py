@@ -0,0 +1,92 @@
+import io
+import json
+import base64
+import importlib
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from sns_app import storage
+
+sns = importlib.import_module('sns_app.app')
+
+
+@pytest.fixture
+def local(site, tmp_path, monkeypatch):
+    store = storage.LocalStorage(str(tmp_path / 'static'), 'secret', str(tmp_path / 'incoming'))
+    monkeypatch.setattr(sns, 'upload_store', store)
+    return site[0], store
+
+
+def send(client, upload, body=b'jpegbytes', **changes):
+    fields = {**upload['fields'], **changes}
+    return client.post(upload['url'], data={**fields, 'file': (io.BytesIO(body), 'a.jpg', fields['Content-Type'])})
+
+
+def test_presigned_post_policy(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='sns-images')
+        store = storage.S3Storage('sns-images', prefix='site', region='us-east-1')
+        upload = store.presign_upload('incoming/post/1/x.jpg', 'image/jpeg', 5000)
+    assert upload['fields']['key'] == 'site/incoming/post/1/x.jpg'
+    policy = json.loads(base64.b64decode(upload['fields']['policy']))
+    conditions = policy['conditions']
+    assert ['content-length-range', 1, 5000] in conditions
+    assert {'Content-Type': 'image/jpeg'} in conditions
+    assert {'key': 'site/incoming/post/1/x.jpg'} in conditions
+    assert {'bucket': 'sns-images'} in conditions
+
+
+def test_s3_take_moves_the_object_out(monkeypatch, tmp_path):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='sns-images')
+        store = storage.S3Storage('sns-images', region='us-east-1')
+        store.client.put_object(Bucket='sns-images', Key='incoming/post/1/x.jpg', Body=b'jpegbytes')
+        store.take('incoming/post/1/x.jpg', str(tmp_path / 'x.jpg'))
+        assert store.stat('incoming/post/1/x.jpg') is None
+    assert (tmp_path / 'x.jpg').read_bytes() == b'jpegbytes'
+
+
+def test_local_upload_checks_the_signature(local):
+    client, store = local
+    upload = store.presign_upload('incoming/post/1/x.jpg', 'image/jpeg', 100)
+    assert send(client, upload, key='incoming/post/2/x.jpg').status_code == 403
+    assert send(client, upload, max_bytes='1000000').status_code == 403
+    assert send(client, upload, signature='0' * 64).status_code == 403
+    assert send(client, upload, body=b'x' * 101).status_code == 403
+    assert store.stat('incoming/post/1/x.jpg') is None
+    assert send(client, upload).status_code == 204
+    assert store.stat('incoming/post/1/x.jpg') == len(b'jpegbytes')
+
+
+def test_local_upload_expires(local):
+    client, store = local
+    upload = store.presign_upload('incoming/post/1/x.jpg', 'image/jpeg', 100, ttl=-1)
+    r = send(client, upload)
+    assert r.status_code == 403 and r.get_json() == {'error': 'expired'}
+    assert store.stat('incoming/post/1/x.jpg') is None
+
+
+@pytest.mark.parametrize('key', ['incoming/post/2/x.jpg', 'incoming/icon/1/x.jpg', 'incoming/post/1/../2/x.jpg', 'uploads/x.jpg', 'incoming/post/1/missing.jpg'])
+def test_claim_refuses_other_keys(local, key):
+    client, store = local
+    # objects exist under every incoming prefix but the missing one, so only the checks refuse them
+    for k in ('incoming/post/1/x.jpg', 'incoming/post/2/x.jpg', 'incoming/icon/1/x.jpg'):
+        assert send(client, store.presign_upload(k, 'image/jpeg', 100)).status_code == 204
+    with sns.app.test_request_context(method='POST', data={'upload_key': key}):
+        assert sns.claimed_upload({'id': 1}, 'post') is None
+
+
+def test_claim_takes_the_object(local, tmp_path):
+    client, store = local
+    assert send(client, store.presign_upload('incoming/post/1/x.jpg', 'image/jpeg', 100)).status_code == 204
+    with sns.app.test_request_context(method='POST', data={'upload_key': 'incoming/post/1/x.jpg'}):
+        upload = sns.claimed_upload({'id': 1}, 'post')
+    upload.save(str(tmp_path / 'x.jpg'))
+    assert (tmp_path / 'x.jpg').read_bytes() == b'jpegbytes'
+    assert store.stat('incoming/post/1/x.jpg') is None